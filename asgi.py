@@ -0,0 +1,14 @@
+import os
+
+# Точка входа ASGI: Flask выполняется в пуле потоков asgiref.
+# Миграции uvicorn не запускает — перед стартом выполните flask init-db.
+#
+#   uvicorn asgi:application --workers 4
+#
+# Воркеров несколько — кэш по умолчанию общий, как в wsgi.py
+os.environ.setdefault('CACHE_BACKEND', 'sqlite')
+
+from asgiref.wsgi import WsgiToAsgi
+from app import create_app
+
+application = WsgiToAsgi(create_app())
@@ -0,0 +1,111 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from flask_login import UserMixin
+from sqlalchemy import event, inspect
+from werkzeug.security import check_password_hash
+from cache import MISSING
+
+
+class SessionUser(UserMixin):
+    # Лёгкая копия строки User для current_user: не привязана к сессии SQLAlchemy
+    # и безопасно переиспользуется между запросами и потоками
+    def __init__(self, id, username, is_admin, session_version):
+        self.id = id
+        self.username = username
+        self.is_admin = bool(is_admin)
+        self.session_version = session_version
+
+    def get_id(self):
+        return f'{self.id}:{self.session_version}'
+
+
+def parse_session_id(user_id):
+    # "id:версия"; у сессий, созданных до появления версий, только id
+    user_id, _, version = str(user_id).partition(':')
+    try:
+        return int(user_id), int(version or 1)
+    except ValueError:
+        return None, None
+
+
+class IdentityCache:
+    # Кэш личности пользователя по id; версия сессии хранится в значении и сверяется
+    # с версией из cookie, поэтому смена пароля или прав сразу даёт промах
+    def __init__(self, backend, session, model):
+        self.backend = backend
+        self.session = session
+        self.model = model
+
+    def load(self, user_id):
+        user_id, version = parse_session_id(user_id)
+        if user_id is None:
+            return None
+        identity = self.backend.get(user_id)
+        if identity is MISSING or (identity is not None and identity.session_version != version):
+            user = self.session.get(self.model, user_id)
+            identity = None if user is None else SessionUser(
+                user.id, user.username, user.is_admin, user.session_version
+            )
+            self.backend.set(user_id, identity)
+        if identity is None or identity.session_version != version:
+            return None
+        return identity
+
+    def invalidate(self, user_id):
+        self.backend.delete(user_id)
+
+
+def register_identity_invalidation(session, model, identity_cache):
+    # Новый пароль или права администратора обнуляют все выданные сессии пользователя
+    def bump_session_version(target, value, oldvalue, initiator):
+        if inspect(target).has_identity and value != oldvalue:
+            target.session_version = (target.session_version or 1) + 1
+        return value
+
+    event.listen(model.password, 'set', bump_session_version, retval=True)
+    event.listen(model.is_admin, 'set', bump_session_version, retval=True)
+
+    @event.listens_for(session, 'after_flush')
+    def collect_changes(session, flush_context):
+        changed = session.info.setdefault('identity_changed_users', set())
+        for instance in list(session.dirty) + list(session.deleted):
+            if isinstance(instance, model):
+                changed.add(instance.id)
+
+    @event.listens_for(session, 'after_commit')
+    def invalidate(session):
+        for user_id in session.info.pop('identity_changed_users', set()):
+            identity_cache.invalidate(user_id)
+
+    @event.listens_for(session, 'after_rollback')
+    def discard(session):
+        session.info.pop('identity_changed_users', None)
+
+
+class PoolSaturated(Exception):
+    pass
+
+
+class PasswordVerifier:
+    # Проверка хэша пароля (pbkdf2) в отдельном ограниченном пуле потоков.
+    # hashlib отпускает GIL на время вычисления, поэтому потоки чтения не простаивают,
+    # а одновременно считается не больше max_workers хэшей. Если в очереди уже
+    # max_pending запросов, новый сразу получает отказ (429) вместо ожидания.
+    def __init__(self, max_workers=2, max_pending=8, timeout=10):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='password')
+        self.slots = threading.BoundedSemaphore(max_workers + max_pending)
+        self.timeout = timeout
+
+    def verify(self, password_hash, password):
+        if not self.slots.acquire(blocking=False):
+            raise PoolSaturated()
+        try:
+            future = self.executor.submit(check_password_hash, password_hash, password)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            raise PoolSaturated()
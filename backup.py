@@ -0,0 +1,324 @@
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import time
+from datetime import datetime, timezone
+
+# Резервные копии базы и загрузок без остановки приложения.
+#
+#  - База копируется online backup API SQLite порциями по pages страниц с паузой
+#    между ними. Всё копирование читает один снимок (транзакция чтения на исходном
+#    соединении): без неё каждая запись другого соединения начинает копию заново,
+#    и под нагрузкой она не заканчивается. В режиме WAL снимок писателей не блокирует.
+#  - Загрузки складываются в общее для всех снимков хранилище objects/ по sha256
+#    содержимого: файл, который уже есть в хранилище, повторно не копируется, а
+#    неизменившийся (тот же размер и mtime, что в прошлом снимке) — не хэшируется.
+#  - manifest.json снимка: sha256 и число строк по таблицам копии базы, список загрузок.
+#    Снимок собирается в каталоге <имя>.part и переименовывается только целиком.
+#  - Базы кампаний (campaigns.py) копируются так же, каждая из своего снимка: данные
+#    кампаний друг с другом не связаны.
+#
+#   instance/backups/20261018T120000Z/{app.db, campaigns/<slug>.db, manifest.json}
+#   instance/backups/objects/ab/ab12...
+
+MANIFEST = 'manifest.json'
+DATABASE_FILE = 'app.db'
+CAMPAIGNS = 'campaigns'
+OBJECTS = 'objects'
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class BackupError(Exception):
+    pass
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source:
+        while True:
+            chunk = source.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def copy_database(source_path, target_path, pages, sleep, busy_timeout=5.0, progress=None):
+    # Online backup из одного снимка; progress(скопировано страниц, всего) после каждой порции
+    source = sqlite3.connect(source_path, timeout=busy_timeout, isolation_level=None)
+    target = sqlite3.connect(target_path, isolation_level=None)
+    steps = 0
+
+    def report(status, remaining, total):
+        nonlocal steps
+        steps += 1
+        if progress is not None:
+            progress(total - remaining, total)
+
+    try:
+        source.execute("BEGIN")
+        source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()  # Снимок фиксируется первым чтением
+        source.backup(target, pages=pages, progress=report, sleep=sleep)
+        source.execute("COMMIT")
+        # Копия — один самодостаточный файл: открывается только для чтения без -wal и -shm
+        target.execute("PRAGMA journal_mode = DELETE")
+    finally:
+        target.close()
+        source.close()
+    return steps
+
+
+def table_counts(connection):
+    # Строки обычных таблиц; виртуальные (FTS) не считаем — их данные лежат в теневых таблицах
+    tables = [row[0] for row in connection.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' "
+        "AND sql NOT LIKE 'CREATE VIRTUAL TABLE%' ORDER BY name"
+    )]
+    return {table: connection.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0] for table in tables}
+
+
+def open_read_only(path):
+    return sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+
+
+def database_summary(path):
+    connection = open_read_only(path)
+    try:
+        return {
+            'user_version': connection.execute("PRAGMA user_version").fetchone()[0],
+            'counts': table_counts(connection),
+        }
+    finally:
+        connection.close()
+
+
+def database_entry(path, file):
+    # Запись манифеста о копии базы; file — путь внутри снимка
+    return dict(database_summary(path), file=file, bytes=os.path.getsize(path), sha256=file_sha256(path))
+
+
+def object_path(folder, sha256):
+    return os.path.join(folder, OBJECTS, sha256[:2], sha256)
+
+
+def snapshot_uploads(upload_folder, folder, previous=None):
+    # Файлы загрузок -> записи манифеста; новые содержимые копируются в хранилище
+    known = {entry['path']: entry for entry in (previous or [])}
+    entries = []
+    copied = 0
+    copied_bytes = 0
+    if not os.path.isdir(upload_folder):
+        return entries, copied, copied_bytes
+    for directory, _, filenames in os.walk(upload_folder):
+        for filename in sorted(filenames):
+            if filename.endswith('.part'):
+                continue  # Загрузка, которая ещё пишется (images.store_upload)
+            path = os.path.join(directory, filename)
+            relative = os.path.relpath(path, upload_folder).replace(os.sep, '/')
+            stat = os.stat(path)
+            entry = known.get(relative)
+            if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+                entry = {'path': relative, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                         'sha256': file_sha256(path)}
+            stored = object_path(folder, entry['sha256'])
+            if not os.path.exists(stored):
+                os.makedirs(os.path.dirname(stored), exist_ok=True)
+                shutil.copyfile(path, stored + '.part')
+                os.replace(stored + '.part', stored)
+                copied += 1
+                copied_bytes += entry['size']
+            entries.append(entry)
+    entries.sort(key=lambda item: item['path'])
+    return entries, copied, copied_bytes
+
+
+def read_manifest(folder, name):
+    path = os.path.join(folder, name, MANIFEST)
+    if not os.path.exists(path):
+        raise BackupError(f'No backup named {name}.')
+    with open(path, encoding='utf-8') as source:
+        return json.load(source)
+
+
+def list_backups(folder):
+    # Готовые снимки от старых к новым (имена — время UTC, сортируются как строки)
+    if not os.path.isdir(folder):
+        return []
+    return sorted(
+        name for name in os.listdir(folder)
+        if name != OBJECTS and not name.endswith('.part') and os.path.exists(os.path.join(folder, name, MANIFEST))
+    )
+
+
+def latest_backup(folder):
+    names = list_backups(folder)
+    if not names:
+        raise BackupError(f'No backups in {folder}.')
+    return names[-1]
+
+
+def create_backup(database_path, upload_folder, folder, pages=4096, sleep=0.005, uploads=True, progress=None,
+                  campaigns=None):
+    # campaigns — {slug: путь к базе кампании}
+    started = time.perf_counter()
+    name = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    while os.path.exists(os.path.join(folder, name)):
+        name += '-1'
+    directory = os.path.join(folder, name)
+    os.makedirs(directory + '.part')
+    try:
+        database = os.path.join(directory + '.part', DATABASE_FILE)
+        steps = copy_database(database_path, database, pages, sleep, progress=progress)
+        copied_at = time.perf_counter()
+        manifest = {
+            'name': name,
+            'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'database': database_entry(database, DATABASE_FILE),
+            'campaigns': {},
+            'uploads': [],
+        }
+        timings = {'database_seconds': copied_at - started, 'database_steps': steps}
+        if campaigns:
+            os.makedirs(os.path.join(directory + '.part', CAMPAIGNS))
+            campaigns_started = time.perf_counter()
+            for slug, path in sorted(campaigns.items()):
+                file = f'{CAMPAIGNS}/{slug}.db'
+                copy_database(path, os.path.join(directory + '.part', file), pages, sleep)
+                manifest['campaigns'][slug] = database_entry(os.path.join(directory + '.part', file), file)
+            timings['campaigns_seconds'] = time.perf_counter() - campaigns_started
+        if uploads:
+            uploads_started = time.perf_counter()
+            names = list_backups(folder)
+            previous = read_manifest(folder, names[-1])['uploads'] if names else None
+            entries, copied, copied_bytes = snapshot_uploads(upload_folder, folder, previous)
+            manifest['uploads'] = entries
+            timings.update(uploads_seconds=time.perf_counter() - uploads_started, uploads_copied=copied,
+                           uploads_copied_bytes=copied_bytes)
+        timings['total_seconds'] = time.perf_counter() - started
+        manifest['timings'] = timings
+        with open(os.path.join(directory + '.part', MANIFEST), 'w', encoding='utf-8') as output:
+            json.dump(manifest, output, indent=1)
+        os.replace(directory + '.part', directory)
+    except BaseException:
+        shutil.rmtree(directory + '.part', ignore_errors=True)
+        raise
+    return manifest
+
+
+def verify_database(folder, name, entry, quick):
+    database = os.path.join(folder, name, entry['file'])
+    if not os.path.exists(database):
+        return [f"{entry['file']} is missing."]
+    problems = []
+    if file_sha256(database) != entry['sha256']:
+        problems.append(f"{entry['file']}: checksum does not match the manifest.")
+    connection = open_read_only(database)
+    try:
+        check = connection.execute("PRAGMA quick_check" if quick else "PRAGMA integrity_check").fetchall()
+        if check != [('ok',)]:
+            problems.extend(f"{entry['file']}: integrity: {row[0]}" for row in check[:20])
+        else:
+            counts = table_counts(connection)
+            for table, expected in entry['counts'].items():
+                if counts.get(table) != expected:
+                    problems.append(f"{entry['file']}: {table}: {counts.get(table)} rows, manifest says {expected}.")
+    except sqlite3.DatabaseError as error:
+        problems.append(f"{entry['file']}: integrity: {error}")
+    finally:
+        connection.close()
+    return problems
+
+
+def verify_backup(folder, name, quick=False, check_objects=False):
+    # Список проблем снимка; пустой — снимок цел. quick — PRAGMA quick_check вместо
+    # integrity_check (без сверки индексов с таблицами), check_objects — перехэшировать загрузки
+    manifest = read_manifest(folder, name)
+    problems = []
+    for entry in [manifest['database'], *manifest.get('campaigns', {}).values()]:
+        problems.extend(verify_database(folder, name, entry, quick))
+    for entry in manifest['uploads']:
+        stored = object_path(folder, entry['sha256'])
+        if not os.path.exists(stored) or os.path.getsize(stored) != entry['size']:
+            problems.append(f"Upload {entry['path']} is missing from the object store.")
+        elif check_objects and file_sha256(stored) != entry['sha256']:
+            problems.append(f"Upload {entry['path']} does not match its checksum.")
+    return problems
+
+
+def restore_database(backup_path, database_path, name, busy_timeout=30.0):
+    # Копия записывается в рабочую базу тем же backup API за один шаг: другие соединения
+    # ждут блокировку и затем видят восстановленную базу целиком. Номера ленты изменений
+    # продолжаются после прежних, а событие restore говорит клиентам перечитать данные
+    source = open_read_only(backup_path)
+    target = sqlite3.connect(database_path, timeout=busy_timeout, isolation_level=None)
+    try:
+        try:
+            last_seq = target.execute("SELECT MAX(seq) FROM sqlite_sequence WHERE name = 'change_event'").fetchone()[0]
+        except sqlite3.OperationalError:
+            last_seq = None  # Базы ещё нет или она старше ленты изменений
+        source.backup(target)
+        if target.execute("SELECT 1 FROM sqlite_master WHERE name = 'change_event'").fetchone():
+            restored_seq = target.execute(
+                "SELECT MAX(seq) FROM sqlite_sequence WHERE name = 'change_event'"
+            ).fetchone()[0]
+            # Явный seq больше обоих: AUTOINCREMENT продолжит нумерацию с него
+            target.execute("INSERT INTO change_event (seq, created_at, data) VALUES (?, ?, ?)", (
+                max(last_seq or 0, restored_seq or 0) + 1, time.time(),
+                json.dumps({'op': 'restore', 'backup': name})
+            ))
+    finally:
+        target.close()
+        source.close()
+
+
+def restore_uploads(folder, entries, upload_folder):
+    # Недостающие и отличающиеся файлы — из хранилища; лишние файлы не удаляются
+    restored = 0
+    for entry in entries:
+        path = os.path.join(upload_folder, *entry['path'].split('/'))
+        if os.path.exists(path) and os.path.getsize(path) == entry['size'] and file_sha256(path) == entry['sha256']:
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(object_path(folder, entry['sha256']), path + '.part')
+        os.replace(path + '.part', path)
+        restored += 1
+    return restored
+
+
+def restore_backup(database_path, upload_folder, folder, name, uploads=True, campaign_folder=None):
+    # Базы кампаний восстанавливаются в campaign_folder вместе с реестром кампаний в основной
+    # базе; файлы кампаний, созданных после снимка, остаются на месте (их нет в реестре)
+    problems = verify_backup(folder, name, quick=True)
+    if problems:
+        raise BackupError(f'Backup {name} failed verification: ' + '; '.join(problems[:5]))
+    manifest = read_manifest(folder, name)
+    if manifest.get('campaigns') and campaign_folder is None:
+        raise BackupError(f'Backup {name} has campaign databases: pass campaign_folder.')
+    started = time.perf_counter()
+    restore_database(os.path.join(folder, name, manifest['database']['file']), database_path, name)
+    for slug, entry in manifest.get('campaigns', {}).items():
+        os.makedirs(campaign_folder, exist_ok=True)
+        restore_database(os.path.join(folder, name, entry['file']), os.path.join(campaign_folder, f'{slug}.db'), name)
+    result = {'name': name, 'database_seconds': time.perf_counter() - started, 'uploads_restored': 0,
+              'campaigns': len(manifest.get('campaigns', {}))}
+    if uploads:
+        result['uploads_restored'] = restore_uploads(folder, manifest['uploads'], upload_folder)
+    result['total_seconds'] = time.perf_counter() - started
+    return result
+
+
+def prune_backups(folder, keep):
+    # Остаются keep последних снимков; из хранилища удаляются объекты, на которые они не ссылаются
+    names = list_backups(folder)
+    removed = names[:-keep] if keep > 0 else []
+    for name in removed:
+        shutil.rmtree(os.path.join(folder, name))
+    referenced = {entry['sha256'] for name in names[len(removed):] for entry in read_manifest(folder, name)['uploads']}
+    objects = os.path.join(folder, OBJECTS)
+    for directory, _, filenames in os.walk(objects):
+        for filename in filenames:
+            if filename not in referenced:
+                os.remove(os.path.join(directory, filename))
+    return removed
@@ -0,0 +1,136 @@
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+from backup import create_backup, restore_backup, verify_backup
+from benchmarks.common import percentile, seeded_copy
+
+# Резервное копирование под нагрузкой записи: скорость online backup, задержки
+# писателя во время копирования (в сравнении с работой без копирования), проверка,
+# восстановление и повторный снимок загрузок, где копируются только новые файлы.
+# Для базы в несколько ГБ — --characters 5000000 (заполненная база кэшируется в --data-dir).
+#
+#   python -m benchmarks.bench_backup --characters 5000000 --uploads 2000
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Online backup, verify and restore throughput.')
+    parser.add_argument('--characters', type=int, default=1000000)
+    parser.add_argument('--pages', type=int, default=4096, help='Pages copied per backup step.')
+    parser.add_argument('--sleep', type=float, default=0.005, help='Pause between backup steps.')
+    parser.add_argument('--uploads', type=int, default=1000, help='Fake upload files.')
+    parser.add_argument('--upload-kb', type=int, default=64)
+    parser.add_argument('--changed', type=float, default=0.01, help='Share of uploads changed between backups.')
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'character-bench'))
+    parser.add_argument('--reseed', action='store_true')
+    return parser.parse_args()
+
+
+def write_loop(database, characters, stop, results):
+    # Писатель: короткие транзакции UPDATE, как правки через форму; задержка каждой
+    connection = sqlite3.connect(database, timeout=30, isolation_level=None)
+    connection.execute("PRAGMA journal_mode = WAL")
+    rng = random.Random(os.getpid())
+    latencies = []
+    while not stop.is_set():
+        started = time.perf_counter()
+        connection.execute("BEGIN IMMEDIATE")
+        connection.execute("UPDATE character SET current_hp = current_hp + 1, version = version + 1 WHERE id = ?",
+                           (rng.randint(1, characters),))
+        connection.execute("COMMIT")
+        latencies.append(time.perf_counter() - started)
+        time.sleep(0.001)
+    connection.close()
+    results.put(latencies)
+
+
+def with_writer(database, characters, action):
+    # action() при работающем писателе в отдельном процессе -> (результат, задержки писателя)
+    stop = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    writer = multiprocessing.Process(target=write_loop, args=(database, characters, stop, results))
+    writer.start()
+    time.sleep(0.5)
+    try:
+        result = action()
+    finally:
+        stop.set()
+        latencies = results.get()
+        writer.join()
+    return result, latencies
+
+
+def report_writes(label, latencies):
+    print(f'{label:<22} {len(latencies):6} writes  p50 {percentile(latencies, 0.5) * 1000:6.2f} ms  '
+          f'p99 {percentile(latencies, 0.99) * 1000:7.2f} ms  max {max(latencies) * 1000:7.2f} ms')
+
+
+def make_uploads(folder, count, size):
+    os.makedirs(folder, exist_ok=True)
+    for index in range(count):
+        with open(os.path.join(folder, f'{index:06}.png'), 'wb') as output:
+            output.write(os.urandom(size))
+
+
+def change_uploads(folder, count, share, size):
+    # share файлов переписываются, столько же добавляется
+    changed = max(1, int(count * share))
+    for index in random.Random(1).sample(range(count), changed):
+        with open(os.path.join(folder, f'{index:06}.png'), 'wb') as output:
+            output.write(os.urandom(size))
+    make_uploads(os.path.join(folder, 'new'), changed, size)
+    return changed
+
+
+def main():
+    options = parse_args()
+    with tempfile.TemporaryDirectory(dir=options.data_dir if os.path.isdir(options.data_dir) else None) as directory:
+        database = seeded_copy(options.data_dir, options.characters, os.path.join(directory, 'app.db'),
+                               reseed=options.reseed)
+        size = os.path.getsize(database) / 2 ** 20
+        uploads = os.path.join(directory, 'uploads')
+        folder = os.path.join(directory, 'backups')
+        make_uploads(uploads, options.uploads, options.upload_kb * 1024)
+        print(f'database {size:.0f} MiB, {options.uploads} uploads x {options.upload_kb} KiB')
+
+        _, idle = with_writer(database, options.characters, lambda: time.sleep(3))
+        report_writes('writes without backup', idle)
+
+        def backup():
+            return create_backup(database, uploads, folder, options.pages, options.sleep)
+        manifest, during = with_writer(database, options.characters, backup)
+        timings = manifest['timings']
+        print(f"backup                 {timings['database_seconds']:6.1f} s  "
+              f"{size / timings['database_seconds']:7.1f} MiB/s  {timings['database_steps']} steps of "
+              f"{options.pages} pages")
+        report_writes('writes during backup', during)
+        print(f"uploads, first         {timings['uploads_seconds']:6.2f} s  "
+              f"{timings['uploads_copied']} copied")
+
+        changed = change_uploads(uploads, options.uploads, options.changed, options.upload_kb * 1024)
+        manifest = create_backup(database, uploads, folder, options.pages, 0)
+        timings = manifest['timings']
+        print(f"uploads, incremental   {timings['uploads_seconds']:6.2f} s  "
+              f"{timings['uploads_copied']} copied ({changed} changed, {changed} added)")
+
+        for quick in (True, False):
+            started = time.perf_counter()
+            problems = verify_backup(folder, manifest['name'], quick=quick)
+            elapsed = time.perf_counter() - started
+            assert not problems, problems
+            label = 'verify, quick_check' if quick else 'verify, integrity'
+            print(f'{label:<22} {elapsed:6.1f} s  {size / elapsed:7.1f} MiB/s')
+
+        shutil.rmtree(uploads)
+        result = restore_backup(database, uploads, folder, manifest['name'])
+        print(f"restore                {result['database_seconds']:6.1f} s  "
+              f"{size / result['database_seconds']:7.1f} MiB/s  {result['uploads_restored']} uploads written "
+              f"(quick_check before it not counted)")
+
+
+if __name__ == '__main__':
+    main()
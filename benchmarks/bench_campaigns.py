@@ -0,0 +1,113 @@
+import argparse
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from benchmarks.common import PASSWORD, USERNAME, make_app, percentile
+
+# Кампании в отдельных базах: задержка страницы кампании, чья база открыта (LRU) и
+# нет, запрос по всем кампаниям последовательно и в пуле потоков, запись в одну
+# кампанию, пока другая держит блокировку записи.
+#
+#   python -m benchmarks.bench_campaigns --campaigns 200 --characters 2000
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Per-campaign databases: routing, LRU and fan-out.')
+    parser.add_argument('--campaigns', type=int, default=200)
+    parser.add_argument('--characters', type=int, default=2000, help='Characters per campaign.')
+    parser.add_argument('--max-open', type=int, default=64, help='CAMPAIGN_MAX_OPEN.')
+    parser.add_argument('--workers', type=int, default=8, help='CAMPAIGN_FANOUT_WORKERS.')
+    parser.add_argument('--rounds', type=int, default=200)
+    return parser.parse_args()
+
+
+def seed(app, campaigns, characters):
+    from werkzeug.security import generate_password_hash
+    from models import db, Character, User, init_db
+    from generator import generate_characters
+    from campaigns import create_campaign, use_campaign
+    registry = app.extensions['campaigns']
+    started = time.perf_counter()
+    with app.app_context():
+        init_db()
+        db.session.add(User(username=USERNAME, password=generate_password_hash(PASSWORD, method='pbkdf2:sha256'),
+                            is_admin=True))
+        db.session.commit()
+        generate_characters(db.session, Character.__table__, characters, 0)
+    for number in range(campaigns):
+        with app.app_context():
+            slug = f'campaign-{number:04}'
+            create_campaign(registry, slug, slug)
+            use_campaign(registry.get(slug))
+            generate_characters(db.session, Character.__table__, characters, number + 1)
+    print(f'{campaigns} campaigns x {characters} characters in {time.perf_counter() - started:.1f}s')
+
+
+def timed(client, paths, rounds):
+    latencies = []
+    for index in range(rounds):
+        started = time.perf_counter()
+        response = client.get(paths[index % len(paths)], headers={'Accept': 'application/json'})
+        latencies.append(time.perf_counter() - started)
+        assert response.status_code == 200, response.status_code
+    return latencies
+
+
+def report(label, latencies):
+    print(f'{label:<34} p50 {percentile(latencies, 0.5) * 1000:7.2f} ms  p95 {percentile(latencies, 0.95) * 1000:7.2f} ms')
+
+
+def main():
+    options = parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        app = make_app(os.path.join(directory, 'app.db'), WTF_CSRF_ENABLED=False, TEMPLATES_PRECOMPILE=False,
+                       CAMPAIGN_FOLDER=os.path.join(directory, 'campaigns'), CAMPAIGN_MAX_OPEN=options.max_open,
+                       CAMPAIGN_FANOUT_WORKERS=options.workers, JOBS_DATABASE=os.path.join(directory, 'jobs.db'))
+        seed(app, options.campaigns, options.characters)
+        registry = app.extensions['campaigns']
+        client = app.test_client()
+        client.post('/login', data={'username': USERNAME, 'password': PASSWORD})
+        slugs = [f'campaign-{number:04}' for number in range(options.campaigns)]
+
+        report('main database list', timed(client, ['/api/characters'], options.rounds))
+        hot = slugs[:max(1, options.max_open // 2)]
+        timed(client, [f'/api/c/{slug}/characters' for slug in hot], len(hot))  # Открываем
+        report(f'campaign list, open ({len(hot)} campaigns)',
+               timed(client, [f'/api/c/{slug}/characters' for slug in hot], options.rounds))
+        evicted = registry.evicted
+        report(f'campaign list, cycling {len(slugs)}',
+               timed(client, [f'/api/c/{slug}/characters' for slug in slugs], options.rounds))
+        print(f'{registry.evicted - evicted} evictions, {registry.stats()["open"]} open '
+              f'(limit {options.max_open})')
+
+        # По индексу (время — в Python, GIL) и с фильтром по навыкам (проход по строкам в SQLite без GIL)
+        paths = {'index': '/campaigns/characters?sort_by=level&order=desc&limit=50',
+                 'skills scan': '/campaigns/characters?sort_by=level&order=desc&limit=50&skills=Stealth,Arcana'}
+        fan_out_rounds = max(5, options.rounds // 20)
+        for threads in (options.workers, 1):
+            registry.executor = ThreadPoolExecutor(threads)
+            for label, path in paths.items():
+                report(f'fan-out {label}, {threads} threads', timed(client, [path], fan_out_rounds))
+
+        # Блокировка записи одной кампании не задерживает запись в другую
+        locked = sqlite3.connect(registry.path(slugs[0]), isolation_level=None, check_same_thread=False)
+        locked.execute("BEGIN IMMEDIATE")
+        holder = threading.Timer(1.0, lambda: locked.execute("COMMIT"))
+        holder.start()
+        with app.app_context():
+            from models import db, Character
+            from campaigns import use_campaign
+            use_campaign(registry.get(slugs[1]))
+            started = time.perf_counter()
+            db.session.query(Character).filter(Character.id == 1).update({'current_hp': Character.current_hp + 1})
+            db.session.commit()
+            print(f'write to another campaign while one is locked: {(time.perf_counter() - started) * 1000:.2f} ms')
+        holder.join()
+        locked.close()
+
+
+if __name__ == '__main__':
+    main()
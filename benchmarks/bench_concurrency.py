@@ -0,0 +1,120 @@
+import argparse
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+from benchmarks.common import PASSWORD, USERNAME, make_app, seed_database
+
+# Пропускная способность чтения при идущей записи: N процессов-читателей
+# (GET /api/characters и /character/<id> через test client приложения) и один
+# процесс, непрерывно изменяющий персонажей. Для каждого числа читателей
+# печатает чтения/с, записи/с и число ошибок "database is locked".
+#
+#   python -m benchmarks.bench_concurrency --characters 20000 --workers 1 2 4 8 --duration 5
+
+def load_app(database):
+    return make_app(database, WTF_CSRF_ENABLED=False,
+                    PROPAGATE_EXCEPTIONS=True)  # Ошибки базы ловим сами, а не получаем 500
+
+
+def is_locked(error):
+    return 'database is locked' in str(error)
+
+
+def reader(database, characters, ready, go, duration, results):
+    app = load_app(database)
+    from sqlalchemy.exc import OperationalError
+    client = app.test_client()
+    client.post('/login', data={'username': USERNAME, 'password': PASSWORD})
+    paths = ['/api/characters?per_page=50&race=Elf', '/api/characters?per_page=50&sort_by=level&order=desc']
+    rng = random.Random(os.getpid())
+    client.get(paths[0])  # Прогрев: импорт шаблонов, соединения пула
+    ready.put(True)
+    go.wait()
+
+    reads = errors = 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        if rng.random() < 0.5:
+            path = rng.choice(paths)
+        else:
+            path = f'/character/{rng.randint(1, characters)}'
+        try:
+            client.get(path)
+            reads += 1
+        except OperationalError as error:
+            if not is_locked(error):
+                raise
+            errors += 1
+    results.put(('read', reads, errors))
+
+
+def writer(database, characters, ready, go, stop, results):
+    app = load_app(database)
+    from sqlalchemy.exc import OperationalError
+    from models import db, Character
+    rng = random.Random(0)
+    ready.put(True)
+    go.wait()
+
+    writes = errors = 0
+    with app.app_context():
+        while not stop.is_set():
+            try:
+                character = db.session.get(Character, rng.randint(1, characters))
+                character.current_hp = rng.randint(1, character.max_hp)
+                db.session.commit()
+                writes += 1
+            except OperationalError as error:
+                db.session.rollback()
+                if not is_locked(error):
+                    raise
+                errors += 1
+    results.put(('write', writes, errors))
+
+
+def run(database, characters, workers, duration):
+    context = multiprocessing.get_context('spawn')
+    ready, results = context.Queue(), context.Queue()
+    go, stop = context.Event(), context.Event()
+    processes = [context.Process(target=writer, args=(database, characters, ready, go, stop, results))]
+    processes += [
+        context.Process(target=reader, args=(database, characters, ready, go, duration, results))
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    for _ in processes:
+        ready.get()
+    go.set()
+    time.sleep(duration)
+    stop.set()
+
+    totals = {'read': [0, 0], 'write': [0, 0]}
+    for _ in processes:
+        kind, done, errors = results.get()
+        totals[kind][0] += done
+        totals[kind][1] += errors
+    for process in processes:
+        process.join()
+    print(f'readers={workers}: reads {totals["read"][0] / duration:.0f}/s, '
+          f'writes {totals["write"][0] / duration:.0f}/s, '
+          f'locked errors: reads {totals["read"][1]}, writes {totals["write"][1]}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Read throughput vs reader processes with a concurrent writer.')
+    parser.add_argument('--characters', type=int, default=20000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--duration', type=float, default=5)
+    options = parser.parse_args()
+
+    database = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    seed_database(database, options.characters)
+    for workers in options.workers:
+        run(database, options.characters, workers, options.duration)
+
+
+if __name__ == '__main__':
+    main()
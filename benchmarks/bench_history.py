@@ -0,0 +1,152 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+import history
+from benchmarks.common import make_app, percentile, seeded_copy
+
+# История правок: задержка правки и доля записи истории в ней (первая правка
+# пишет ещё и снимок исходной версии), сборка прошлых версий, поиск версии на
+# момент времени и место, которое история занимает в базе, в сравнении с
+# хранением полной копии строки на каждую версию.
+#
+#   python -m benchmarks.bench_history --characters 1000000 --edits 20000
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Edit history: write overhead, rebuild latency and storage.')
+    parser.add_argument('--characters', type=int, default=100000)
+    parser.add_argument('--edits', type=int, default=10000, help='Edits of characters without history.')
+    parser.add_argument('--hot', type=int, default=100, help='Characters edited over and over.')
+    parser.add_argument('--hot-edits', type=int, default=200, help='Versions written per hot character.')
+    parser.add_argument('--lookups', type=int, default=2000)
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'character-bench'))
+    parser.add_argument('--reseed', action='store_true')
+    return parser.parse_args()
+
+
+def timed_history_writes(spent):
+    # Время SQL истории внутри каждой правки: обёртки над функциями, которые вызывают события history.py
+    def timed(function):
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                spent[0] += time.perf_counter() - started
+        return wrapper
+    history.write_baselines = timed(history.write_baselines)
+    history.write_rows = timed(history.write_rows)
+
+
+def report(label, latencies, extra=''):
+    print(f'{label:<30} p50 {percentile(latencies, 0.5) * 1000:7.3f} ms  '
+          f'p99 {percentile(latencies, 0.99) * 1000:7.3f} ms{extra}')
+
+
+def table_bytes(session, table):
+    # Страницы таблицы и её индексов (dbstat); без dbstat — None
+    from sqlalchemy import text
+    try:
+        return session.execute(text(
+            "SELECT SUM(pgsize) FROM dbstat WHERE name IN (SELECT name FROM sqlite_master WHERE tbl_name = :table)"
+        ), {'table': table}).scalar()
+    except Exception:
+        session.rollback()
+        return None
+
+
+def main():
+    options = parse_args()
+    with tempfile.TemporaryDirectory(dir=options.data_dir if os.path.isdir(options.data_dir) else None) as directory:
+        database = seeded_copy(options.data_dir, options.characters, os.path.join(directory, 'app.db'),
+                               reseed=options.reseed)
+        app = make_app(database, TEMPLATES_PRECOMPILE=False, JOBS_DATABASE=os.path.join(directory, 'jobs.db'),
+                       CAMPAIGN_FOLDER=os.path.join(directory, 'campaigns'))
+        rng = random.Random(1)
+        spent = [0.0]
+        timed_history_writes(spent)
+        with app.app_context():
+            from sqlalchemy import text
+            from models import db, Character, init_db
+            from updates import bulk_update
+            init_db()  # Миграция истории на базе из кэша
+            session = db.session
+
+            def edit(character_id):
+                spent[0] = 0.0
+                started = time.perf_counter()
+                character = session.get(Character, character_id)
+                character.current_hp = rng.randint(1, character.max_hp)
+                character.experience += rng.randint(1, 500)
+                session.commit()
+                return time.perf_counter() - started, spent[0]
+
+            fresh = rng.sample(range(1, options.characters + 1), options.edits)
+            first = [edit(character_id) for character_id in fresh]
+            report('first edit (base + change)', [total for total, _ in first],
+                   f'  history {sum(part for _, part in first) / sum(total for total, _ in first):6.1%} of the time')
+
+            hot = rng.sample(range(1, options.characters + 1), options.hot)
+            repeat = [edit(character_id) for _ in range(options.hot_edits) for character_id in hot]
+            report('repeat edit (change only)', [total for total, _ in repeat],
+                   f'  history {sum(part for _, part in repeat) / sum(total for total, _ in repeat):6.1%} of the time')
+
+            started = time.perf_counter()
+            updated = bulk_update(session, {'race': 'Elf', 'level': str(rng.randint(1, 20))},
+                                  {'current_hp': {'copy': 'max_hp'}})
+            session.commit()
+            print(f'bulk update                    {updated} characters in {time.perf_counter() - started:.3f} s')
+
+            versions = {character_id: session.get(Character, character_id).version for character_id in hot}
+            latencies = []
+            for _ in range(options.lookups):
+                character_id = rng.choice(hot)
+                version = rng.randint(1, versions[character_id])
+                started = time.perf_counter()
+                entry = history.character_version(session, character_id, version)
+                latencies.append(time.perf_counter() - started)
+                assert entry is not None and entry.version == version
+            report(f'rebuild version (<= {history.SNAPSHOT_INTERVAL - 1} changes)', latencies)
+
+            oldest, newest = session.execute(
+                text("SELECT MIN(created_at), MAX(created_at) FROM character_history")
+            ).one()
+            latencies = []
+            for _ in range(options.lookups):
+                character_id = rng.choice(hot)
+                started = time.perf_counter()
+                history.version_at(session, character_id, rng.uniform(oldest, newest))
+                latencies.append(time.perf_counter() - started)
+            report('version at a time', latencies)
+
+            latencies = []
+            for _ in range(options.lookups // 10):
+                started = time.perf_counter()
+                history.character_versions(session, rng.choice(hot), app.config['HISTORY_PER_PAGE'])
+                latencies.append(time.perf_counter() - started)
+            report(f"history page ({app.config['HISTORY_PER_PAGE']} versions)", latencies)
+            session.rollback()
+
+            rows, data_bytes = history.history_size(session.connection())
+            snapshots = session.execute(text("SELECT COUNT(*), SUM(LENGTH(CAST(data AS BLOB))) "
+                                              "FROM character_history WHERE snapshot = 1")).one()
+            snapshot_bytes = snapshots[1] / snapshots[0]
+            print(f'history rows                   {rows} ({snapshots[0]} snapshots), '
+                  f'{data_bytes / rows:.0f} B of data per row, full row {snapshot_bytes:.0f} B')
+            print(f'full copy per version          {rows * snapshot_bytes / 2 ** 20:.1f} MiB of data vs '
+                  f'{data_bytes / 2 ** 20:.1f} MiB ({data_bytes / (rows * snapshot_bytes):.0%})')
+            history_pages = table_bytes(session, 'character_history')
+            character_pages = table_bytes(session, 'character')
+            if history_pages is not None:
+                print(f'on disk                        history {history_pages / 2 ** 20:.1f} MiB, '
+                      f'characters with indexes {character_pages / 2 ** 20:.1f} MiB, '
+                      f'database {os.path.getsize(database) / 2 ** 20:.1f} MiB')
+            session.rollback()
+            for engine in db.engines.values():
+                engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
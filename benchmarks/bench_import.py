@@ -0,0 +1,52 @@
+import argparse
+import io
+import json
+import os
+import tempfile
+import time
+
+# Замер пакетного импорта: NDJSON из N персонажей -> временная база SQLite.
+#
+#   python -m benchmarks.bench_import --rows 200000
+
+
+def make_ndjson(rows):
+    buffer = io.BytesIO()
+    for number in range(rows):
+        record = {
+            "id": number, "name": f"Imported {number}", "race": "Elf", "character_class": "Wizard",
+            "level": number % 20 + 1, "experience": number, "strength": 10, "dexterity": 12,
+            "constitution": 14, "intelligence": 18, "wisdom": 11, "charisma": 9,
+            "max_hp": 40, "current_hp": 35, "skills": "Arcana, Stealth", "description": "Benchmark character",
+        }
+        buffer.write(json.dumps(record).encode('utf-8') + b'\n')
+    buffer.seek(0)
+    return buffer
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure bulk NDJSON import throughput.')
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    options = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(directory, 'bench.db')
+    from app import create_app
+    from models import db, Character, init_db
+    app = create_app()
+    from importer import import_characters
+
+    stream = make_ndjson(options.rows)
+    with app.app_context():
+        init_db()
+        started = time.perf_counter()
+        report = import_characters(stream, db.session, Character.__table__, batch_size=options.batch_size)
+        elapsed = time.perf_counter() - started
+
+    print(f'imported {report.imported} rows ({report.failed} failed) in {elapsed:.2f}s: '
+          f'{report.imported / elapsed:,.0f} rows/sec')
+
+
+if __name__ == '__main__':
+    main()
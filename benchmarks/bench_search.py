@@ -0,0 +1,119 @@
+import argparse
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import numpy as np
+from benchmarks.common import PASSWORD, USERNAME, make_app, percentile, seeded_copy
+
+# Задержка /search на базе с осмысленными описаниями: у сгенерированных
+# персонажей описание одно на всех, поэтому здесь оно заменяется случайным
+# "лором" (слова с распределением Ципфа, как в живом тексте). Заполненная
+# база кэшируется в --data-dir.
+#
+#   python -m benchmarks.bench_search --characters 1000000 --rounds 50
+
+WORDS = (
+    'necromancer exiled northern keep ancient dragon shadow blade temple oath vengeance forest river mountain '
+    'storm king queen thief guild merchant sailor pirate witch curse blood moon sun star fire ice stone iron '
+    'silver gold tower ruins crypt undead spirit ghost raven wolf bear elf dwarf orc goblin giant wizard scholar '
+    'library tome scroll rune sigil portal abyss demon angel paladin crusade heresy prophecy chosen orphan '
+    'village city harbor desert jungle swamp cave mine forge hammer bow arrow spear shield armor helm cloak '
+    'poison potion alchemy herb healer plague war battle siege army mercenary captain spy assassin noble '
+    'rebel exile prison escape hunt beast monster kraken wyvern griffin unicorn phoenix oracle seer dream '
+    'nightmare memory lost found betrayal love revenge honor debt redemption secret hidden map treasure'
+).split()
+QUERIES = {
+    'rare_term': 'kraken',
+    'common_term': 'necromancer',
+    'two_terms': 'necromancer exiled',
+    'phrase': '"northern keep"',
+    'prefix': 'drag*',
+    'long_query': 'necromancer exiled from the northern keep',
+    'filtered': 'dragon&race=Elf&character_class=Wizard',
+    'no_match': 'xylophone',
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Full-text search latency.')
+    parser.add_argument('--characters', type=int, default=1000000)
+    parser.add_argument('--rounds', type=int, default=50)
+    parser.add_argument('--vocabulary', type=int, default=20000, help='Distinct words in descriptions.')
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'character-bench'))
+    parser.add_argument('--reseed', action='store_true')
+    return parser.parse_args()
+
+
+def vocabulary(size, rng):
+    # Частые слова из WORDS и длинный хвост редких искусственных слов
+    syllables = np.array(['ka', 'ra', 'el', 'dor', 'mir', 'th', 'an', 'ul', 'zo', 'ri', 'gar', 'wyn', 'ol', 'is'])
+    tail = [''.join(rng.choice(syllables, rng.integers(2, 5))) for _ in range(size - len(WORDS))]
+    return np.array(WORDS + tail, dtype=object)
+
+
+def fill_descriptions(database, characters, size):
+    rng = np.random.default_rng(1)
+    words = vocabulary(size, rng)
+    connection = sqlite3.connect(database)
+    started = time.perf_counter()
+    block = 50000
+    for start in range(1, characters + 1, block):
+        ids = range(start, min(start + block, characters + 1))
+        lengths = rng.integers(15, 60, len(ids))
+        ranks = np.minimum(rng.zipf(1.3, lengths.sum()), len(words)) - 1
+        text = words[ranks]
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        rows = [(' '.join(text[offsets[i]:offsets[i + 1]]).capitalize() + '.', character_id)
+                for i, character_id in enumerate(ids)]
+        # Триггер обновления поддерживает индекс поиска, как при обычной правке
+        with connection:
+            connection.executemany("UPDATE character SET description = ? WHERE id = ?", rows)
+    connection.execute("INSERT INTO character_search_fts (character_search_fts) VALUES ('optimize')")
+    connection.commit()
+    connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    connection.close()
+    print(f'descriptions for {characters} characters in {time.perf_counter() - started:.1f}s')
+
+
+def lore_copy(options, target):
+    source = os.path.join(options.data_dir, f'lore-{options.characters}-{options.vocabulary}.db')
+    if options.reseed or not os.path.exists(source):
+        seeded_copy(options.data_dir, options.characters, source + '.part', reseed=options.reseed)
+        # База могла быть заполнена до появления индекса поиска: догоняем миграции
+        from models import db, init_db
+        app = make_app(source + '.part', TEMPLATES_PRECOMPILE=False)
+        with app.app_context():
+            init_db()
+            for engine in db.engines.values():
+                engine.dispose()
+        fill_descriptions(source + '.part', options.characters, options.vocabulary)
+        os.replace(source + '.part', source)
+    shutil.copyfile(source, target)
+    return target
+
+
+def main():
+    options = parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        database = lore_copy(options, os.path.join(directory, 'search.db'))
+        app = make_app(database, WTF_CSRF_ENABLED=False)
+        client = app.test_client()
+        client.post('/login', data={'username': USERNAME, 'password': PASSWORD})
+        for name, query in QUERIES.items():
+            path = f'/search?q={query}'
+            client.get(path, headers={'Accept': 'application/json'})  # Прогрев страниц индекса
+            latencies = []
+            for _ in range(options.rounds):
+                started = time.perf_counter()
+                response = client.get(path, headers={'Accept': 'application/json'})
+                latencies.append(time.perf_counter() - started)
+                assert response.status_code == 200, response.status_code
+            hits = len(response.get_json()['items'])
+            print(f'{name:<12} p50 {percentile(latencies, 0.5) * 1000:7.2f} ms  '
+                  f'p95 {percentile(latencies, 0.95) * 1000:7.2f} ms  {hits} results on page')
+
+
+if __name__ == '__main__':
+    main()
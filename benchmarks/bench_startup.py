@@ -0,0 +1,108 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Время старта приложения:
+#  - импорт wsgi по `python -X importtime` (сумма модулей верхнего уровня);
+#  - время до первого ответа: новый процесс интерпретатора -> create_app() -> GET /login.
+# Каждый замер — в отдельном процессе, берётся медиана. Если медиана превышает
+# бюджет, скрипт завершается с кодом 1 — его можно запускать в CI.
+#
+#   python -m benchmarks.bench_startup --repeat 5 --import-budget-ms 800 --first-response-budget-ms 1500
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FIRST_RESPONSE = '''
+import json, sys, time
+started = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+app = create_app()
+created = time.perf_counter()
+response = app.test_client().get('/login')
+finished = time.perf_counter()
+json.dump({
+    'status': response.status_code,
+    'import_ms': (imported - started) * 1000,
+    'create_app_ms': (created - imported) * 1000,
+    'request_ms': (finished - created) * 1000,
+}, sys.stdout)
+'''
+
+
+def parse_importtime(stderr):
+    # Строки "import time: self [us] | cumulative | имя"; вложенность — отступом имени (по 2 пробела)
+    total = 0
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0:
+            total += int(cumulative)  # Вложенные импорты уже входят в верхний уровень
+        elif depth <= 2:
+            modules.append((int(cumulative), name.strip()))  # Импорты wsgi/app и их прямые зависимости
+    return total / 1000, sorted(modules, reverse=True)
+
+
+def measure_import(env):
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import wsgi'],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True
+    )
+    return parse_importtime(result.stderr)
+
+
+def measure_first_response(env):
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-c', FIRST_RESPONSE], cwd=ROOT, env=env, capture_output=True, text=True, check=True
+    )
+    phases = json.loads(result.stdout)
+    phases['total_ms'] = (time.perf_counter() - started) * 1000  # Вместе с запуском интерпретатора
+    if phases['status'] != 200:
+        raise RuntimeError(f"GET /login returned {phases['status']}")
+    return phases
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure import time and time to first response.')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--import-budget-ms', type=float, default=None)
+    parser.add_argument('--first-response-budget-ms', type=float, default=None)
+    parser.add_argument('--top', type=int, default=10, help='Slowest imports of the application to print.')
+    options = parser.parse_args()
+
+    env = dict(os.environ)
+    env['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+    imports = [measure_import(env) for _ in range(options.repeat)]
+    import_ms = statistics.median(total for total, _ in imports)
+    print(f'import wsgi: {import_ms:.0f} ms (median of {options.repeat})')
+    for cumulative, name in imports[-1][1][:options.top]:
+        print(f'  {cumulative / 1000:8.1f} ms  {name}')
+
+    runs = [measure_first_response(env) for _ in range(options.repeat)]
+    first_response_ms = statistics.median(run['total_ms'] for run in runs)
+    print(f'first response: {first_response_ms:.0f} ms (median of {options.repeat}), of which')
+    for phase in ('import_ms', 'create_app_ms', 'request_ms'):
+        print(f'  {phase[:-3]}: {statistics.median(run[phase] for run in runs):.0f} ms')
+
+    failed = False
+    if options.import_budget_ms is not None and import_ms > options.import_budget_ms:
+        print(f'FAIL import time {import_ms:.0f} ms > budget {options.import_budget_ms:.0f} ms')
+        failed = True
+    if options.first_response_budget_ms is not None and first_response_ms > options.first_response_budget_ms:
+        print(f'FAIL first response {first_response_ms:.0f} ms > budget {options.first_response_budget_ms:.0f} ms')
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,107 @@
+import os
+import shutil
+import socket
+import sqlite3
+import statistics
+import time
+
+# Общие части бенчмарков: конфигурация приложения на временной базе, кэш
+# заранее заполненных баз и статистика задержек.
+
+USERNAME = 'bench'
+PASSWORD = 'password1'
+
+
+def bench_config(database, **overrides):
+    # Config с базой бенчмарка; overrides — ключи конфигурации (WTF_CSRF_ENABLED и т.п.)
+    from config import Config
+    attributes = {'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + database, 'TEMPLATES_BYTECODE_CACHE': ''}
+    attributes.update(overrides)
+    return type('BenchConfig', (Config,), attributes)
+
+
+def make_app(database, **overrides):
+    from app import create_app
+    return create_app(bench_config(database, **overrides))
+
+
+def seed_database(database, characters, seed=1):
+    # Схема, администратор USERNAME и characters персонажей из генератора (детерминированно по seed)
+    from werkzeug.security import generate_password_hash
+    from models import db, Character, User, init_db
+    from generator import generate_characters
+    app = make_app(database, TEMPLATES_PRECOMPILE=False)
+    with app.app_context():
+        init_db()
+        db.session.add(User(username=USERNAME, password=generate_password_hash(PASSWORD, method='pbkdf2:sha256'),
+                            is_admin=True))
+        db.session.commit()
+        generate_characters(db.session, Character.__table__, characters, seed)
+        for engine in db.engines.values():
+            engine.dispose()
+
+
+def seeded_copy(data_dir, characters, target, seed=1, reseed=False):
+    # Заполненная база хранится в data_dir и переиспользуется между запусками
+    # (1M персонажей генерируются десятки секунд); бенчмарк работает с копией
+    os.makedirs(data_dir, exist_ok=True)
+    source = os.path.join(data_dir, f'characters-{characters}-{seed}.db')
+    if reseed or not os.path.exists(source):
+        started = time.perf_counter()
+        partial = source + '.part'
+        if os.path.exists(partial):
+            os.remove(partial)
+        seed_database(partial, characters, seed)
+        # Весь WAL — в основной файл, чтобы базу можно было копировать одним файлом
+        connection = sqlite3.connect(partial)
+        connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        connection.execute("PRAGMA journal_mode = DELETE")
+        connection.close()
+        os.replace(partial, source)
+        print(f'seeded {characters} characters in {time.perf_counter() - started:.1f}s -> {source}')
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(target + suffix):
+            os.remove(target + suffix)
+    shutil.copyfile(source, target)
+    return target
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def summarize(latencies, duration=None):
+    # Секунды -> словарь для JSON-отчёта
+    summary = {
+        'n': len(latencies),
+        'min': min(latencies),
+        'mean': statistics.mean(latencies),
+        'p50': percentile(latencies, 0.5),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+        'max': max(latencies),
+    }
+    summary['stdev'] = statistics.stdev(latencies) if len(latencies) > 1 else 0.0
+    if duration:
+        summary['rps'] = len(latencies) / duration
+    else:
+        summary['rps'] = 1 / summary['mean'] if summary['mean'] else 0.0
+    return summary
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('server did not start')
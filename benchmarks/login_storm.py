@@ -0,0 +1,113 @@
+import argparse
+import http.client
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from benchmarks.common import free_port, percentile, wait_for
+
+# Нагрузочный тест: задержка GET / (p50/p99), пока другие клиенты непрерывно
+# отправляют POST /login. Сервер запускается отдельным процессом на временной базе.
+#
+#   python -m benchmarks.login_storm --readers 8 --logins 32 --duration 10
+
+
+def serve(database, port):
+    os.environ['DATABASE_URL'] = 'sqlite:///' + database
+    from werkzeug.security import generate_password_hash
+    from werkzeug.serving import make_server
+    from app import create_app
+    from models import db, User, init_db
+    app = create_app()
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    with app.app_context():
+        init_db()
+        if not User.query.filter_by(username='storm').first():
+            db.session.add(User(username='storm', password=generate_password_hash('password1', method='pbkdf2:sha256')))
+            db.session.commit()
+    make_server('127.0.0.1', port, app, threaded=True).serve_forever()
+
+
+def reader(port, stop, latencies):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    while not stop.is_set():
+        started = time.perf_counter()
+        connection.request('GET', '/')
+        connection.getresponse().read()
+        latencies.append(time.perf_counter() - started)
+
+
+def login_storm(port, stop, statuses):
+    body = urllib.parse.urlencode({'username': 'storm', 'password': 'password1'})
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    while not stop.is_set():
+        connection.request('POST', '/login', body=body, headers=headers)
+        response = connection.getresponse()
+        response.read()
+        statuses.append(response.status)
+        # Без cookie каждый запрос — новая попытка входа
+        connection.close()
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+
+
+def run_phase(port, readers, logins, duration):
+    stop = threading.Event()
+    latencies = []
+    statuses = []
+    threads = [threading.Thread(target=reader, args=(port, stop, latencies)) for _ in range(readers)]
+    threads += [threading.Thread(target=login_storm, args=(port, stop, statuses)) for _ in range(logins)]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return latencies, statuses
+
+
+def report(label, latencies, statuses, duration):
+    line = (f'{label}: GET / n={len(latencies)} p50={percentile(latencies, 0.5) * 1000:.1f}ms '
+            f'p99={percentile(latencies, 0.99) * 1000:.1f}ms mean={statistics.mean(latencies) * 1000:.1f}ms')
+    if statuses:
+        counts = {status: statuses.count(status) for status in sorted(set(statuses))}
+        line += f' | logins {len(statuses) / duration:.0f}/s statuses={counts}'
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='p99 latency of / while /login is hammered.')
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--logins', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--database', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.serve:
+        serve(options.database, options.port)
+        return
+
+    database = os.path.join(tempfile.mkdtemp(), 'storm.db')
+    port = free_port()
+    server = subprocess.Popen([sys.executable, '-m', 'benchmarks.login_storm', '--serve',
+                               '--database', database, '--port', str(port)])
+    try:
+        wait_for(port)
+        latencies, statuses = run_phase(port, options.readers, 0, options.duration)
+        report('baseline', latencies, statuses, options.duration)
+        latencies, statuses = run_phase(port, options.readers, options.logins, options.duration)
+        report('login storm', latencies, statuses, options.duration)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == '__main__':
+    main()
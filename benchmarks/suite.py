@@ -0,0 +1,413 @@
+import argparse
+import http.client
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+from datetime import datetime, timezone
+from benchmarks.common import (PASSWORD, USERNAME, free_port, make_app, seeded_copy, summarize, wait_for)
+
+# Набор бенчмарков всех страниц приложения на базах заданных размеров.
+#
+# micro — запросы через test client в одном процессе: для каждого сценария
+#         WARMUP разогревающих и --rounds замеряемых запросов подряд.
+# macro — сервер запускается отдельным процессом (werkzeug или gunicorn),
+#         --clients процессов-клиентов в течение --duration секунд шлют смесь
+#         запросов MACRO_MIX по HTTP с keep-alive.
+#
+# Результаты пишутся в JSON (--output). С --baseline медиана задержки (и для
+# macro — пропускная способность) сравнивается с сохранённым прогоном; при
+# ухудшении больше --tolerance скрипт завершается с кодом 1.
+#
+#   python -m benchmarks.suite --sizes 1000 100000 --output results.json
+#   python -m benchmarks.suite --sizes 1000 --baseline results.json
+#   python -m benchmarks.suite --sizes 1000000 --levels macro --clients 16 --server gunicorn
+
+WARMUP = 5
+RACES = ['Human', 'Elf', 'Dwarf', 'Halfling']
+CLASSES = ['Barbarian', 'Bard', 'Cleric', 'Druid', 'Fighter', 'Monk',
+           'Paladin', 'Ranger', 'Rogue', 'Sorcerer', 'Warlock', 'Wizard']
+
+# Сочетания фильтров и сортировок index(): индексные пути, FTS, LIKE и курсор
+INDEX_QUERIES = {
+    'index': '/',
+    'index:race': '/?race=Elf',
+    'index:class_level': '/?character_class=Wizard&level=10',
+    'index:race_class_level': '/?race=Dwarf&character_class=Cleric&level=5',
+    'index:name_fts': '/?name=Hum',
+    'index:name_like': '/?name=El',
+    'index:sort_level_desc': '/?sort_by=level&order=desc',
+    'index:sort_experience': '/?sort_by=experience',
+    'index:skills_any': '/?skills=Stealth,Arcana&skills_match=any',
+    'index:skills_all_race': '/?skills=Stealth,Arcana&race=Elf',
+}
+
+
+def character_form(rng, name):
+    data = {
+        'name': name, 'race': rng.choice(RACES), 'character_class': rng.choice(CLASSES),
+        'level': rng.randint(1, 20), 'experience': rng.randint(1, 10000),
+        'max_hp': 50, 'current_hp': rng.randint(1, 50), 'description': 'Benchmark character',
+    }
+    for ability in ('strength', 'dexterity', 'constitution', 'intelligence', 'wisdom', 'charisma'):
+        data[ability] = rng.randint(8, 18)
+    data['stealth'] = 'y'
+    return data
+
+
+def character_file(rng):
+    record = character_form(rng, f'Uploaded {rng.randrange(1 << 30)}')
+    record['skills'] = 'Stealth, Arcana'
+    return json.dumps(record).encode('utf-8')
+
+
+class Scenario:
+    # request(rng, context) -> (метод, путь, аргументы test client)
+    def __init__(self, name, request, expect=200, rounds=None, uncached_lists=False, anonymous=False):
+        self.name = name
+        self.request = request
+        self.expect = expect
+        self.rounds = rounds
+        self.uncached_lists = uncached_lists
+        self.anonymous = anonymous
+
+
+def get(path):
+    return lambda rng, context: ('GET', path, {})
+
+
+def random_id(rng, context):
+    return rng.randint(1, context['characters'])
+
+
+MICRO_SCENARIOS = [
+    # Списки без кэша: перед каждым запросом поколение кэша списков сбрасывается
+    *[Scenario(name, get(path), uncached_lists=True) for name, path in INDEX_QUERIES.items()],
+    Scenario('index:page2', lambda rng, context: ('GET', '/?cursor=' + context['cursor'], {}), uncached_lists=True),
+    Scenario('index:cached', get('/')),
+    Scenario('character_details', lambda rng, context: ('GET', f'/character/{random_id(rng, context)}', {})),
+    Scenario('download_character', lambda rng, context: ('GET', f'/download/{random_id(rng, context)}', {})),
+    Scenario('api:list', get('/api/characters?per_page=50&race=Elf')),
+    Scenario('api:batch', lambda rng, context: (
+        'GET', '/api/characters?ids=' + ','.join(str(random_id(rng, context)) for _ in range(50)), {}
+    )),
+    Scenario('stats', get('/stats')),
+    # 10 000 боёв 4 на 4 на запрос; медленнее остальных, поэтому замеров меньше
+    Scenario('simulate', lambda rng, context: (
+        'GET', '/simulate?trials=10000&seed=1&party_a={}&party_b={}'.format(
+            *[','.join(str(random_id(rng, context)) for _ in range(4)) for _ in range(2)]
+        ), {'headers': {'Accept': 'application/json'}}
+    ), rounds=20),
+    Scenario('upload_character', lambda rng, context: (
+        'POST', '/upload', {'data': {'file': (io.BytesIO(character_file(rng)), 'character.json')}}
+    ), expect=302, rounds=50),
+    Scenario('add_character', lambda rng, context: (
+        'POST', '/add', {'data': character_form(rng, f'Added {rng.randrange(1 << 30)}')}
+    ), expect=302, rounds=50),
+    Scenario('edit_character', lambda rng, context: (
+        'POST', f'/edit/{random_id(rng, context)}', {'data': character_form(rng, f'Edited {rng.randrange(1 << 30)}')}
+    ), expect=302, rounds=50),
+    # Вход — это проверка pbkdf2, поэтому замеров меньше
+    Scenario('login', lambda rng, context: (
+        'POST', '/login', {'data': {'username': USERNAME, 'password': PASSWORD}}
+    ), expect=302, rounds=10, anonymous=True),
+]
+
+# Смесь запросов macro: (вес, сценарий); чтение преобладает, как у живых пользователей
+MACRO_MIX = [
+    (40, 'index'), (25, 'character_details'), (10, 'api:list'), (5, 'download_character'),
+    (5, 'stats'), (5, 'edit_character'), (10, 'index:page2'),
+]
+
+
+def micro_context(client, characters):
+    cursor = client.get('/api/characters?per_page=50&fields=name').get_json()['next_cursor']
+    return {'characters': characters, 'cursor': cursor}
+
+
+def run_micro(database, characters, rounds, seed, selected):
+    app = make_app(database, WTF_CSRF_ENABLED=False)
+    character_cache = app.extensions['character_cache']
+    client = app.test_client()
+    client.post('/login', data={'username': USERNAME, 'password': PASSWORD})
+    context = micro_context(client, characters)
+
+    results = []
+    for scenario in MICRO_SCENARIOS:
+        if not selected(scenario.name):
+            continue
+        rng = random.Random(seed)
+        latencies = []
+        for index in range(WARMUP + (scenario.rounds or rounds)):
+            if scenario.uncached_lists:
+                with app.app_context():
+                    character_cache.invalidate((), lists=True)
+            scenario_client = app.test_client() if scenario.anonymous else client
+            method, path, kwargs = scenario.request(rng, context)
+            started = time.perf_counter()
+            response = scenario_client.open(path, method=method, **kwargs)
+            elapsed = time.perf_counter() - started
+            if response.status_code != scenario.expect:
+                raise RuntimeError(f'{scenario.name}: {method} {path} returned {response.status_code}')
+            if index >= WARMUP:
+                latencies.append(elapsed)
+        stats = summarize(latencies)
+        print(f'micro {characters:>8} {scenario.name:<24} p50 {stats["p50"] * 1000:8.2f} ms  '
+              f'p95 {stats["p95"] * 1000:8.2f} ms  {stats["rps"]:8.0f}/s')
+        results.append({'level': 'micro', 'size': characters, 'scenario': scenario.name, 'stats': stats})
+    return results
+
+
+class HttpClient:
+    # Keep-alive соединение с собственными cookie и CSRF-токеном формы входа
+    def __init__(self, port):
+        self.port = port
+        self.cookies = {}
+        self.csrf_token = None
+        self.connect()
+
+    def connect(self):
+        self.connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+
+    def request(self, method, path, form=None):
+        headers = {}
+        body = None
+        if form is not None:
+            form = dict(form, csrf_token=self.csrf_token)
+            body = urllib.parse.urlencode(form)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        if self.cookies:
+            headers['Cookie'] = '; '.join(f'{name}={value}' for name, value in self.cookies.items())
+        try:
+            self.connection.request(method, path, body=body, headers=headers)
+            response = self.connection.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            self.connect()
+            raise
+        for header in response.headers.get_all('Set-Cookie') or []:
+            name, _, rest = header.partition('=')
+            self.cookies[name] = rest.split(';', 1)[0]
+        return response.status, data
+
+    def login(self):
+        _, page = self.request('GET', '/login')
+        self.csrf_token = re.search(rb'name="csrf_token"[^>]*value="([^"]+)"', page).group(1).decode()
+        status, _ = self.request('POST', '/login', {'username': USERNAME, 'password': PASSWORD})
+        if status != 302:
+            raise RuntimeError(f'login returned {status}')
+
+
+def macro_request(name, rng, context):
+    if name == 'index':
+        return 'GET', rng.choice(list(INDEX_QUERIES.values())), None
+    if name == 'index:page2':
+        return 'GET', '/?cursor=' + context['cursor'], None
+    if name == 'character_details':
+        return 'GET', f'/character/{random_id(rng, context)}', None
+    if name == 'download_character':
+        return 'GET', f'/download/{random_id(rng, context)}', None
+    if name == 'api:list':
+        return 'GET', '/api/characters?per_page=50&race=Elf', None
+    if name == 'stats':
+        return 'GET', '/stats', None
+    if name == 'edit_character':
+        return 'POST', f'/edit/{random_id(rng, context)}', character_form(rng, f'Edited {rng.randrange(1 << 30)}')
+    raise ValueError(name)
+
+
+def macro_client(port, characters, duration, seed, start_at):
+    client = HttpClient(port)
+    client.login()
+    _, body = client.request('GET', '/api/characters?per_page=50&fields=name')
+    context = {'characters': characters, 'cursor': json.loads(body)['next_cursor']}
+    rng = random.Random(seed)
+    names = [name for _, name in MACRO_MIX]
+    weights = [weight for weight, _ in MACRO_MIX]
+    latencies = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+
+    time.sleep(max(0.0, start_at - time.time()))
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        name = rng.choices(names, weights)[0]
+        method, path, form = macro_request(name, rng, context)
+        started = time.perf_counter()
+        try:
+            status, _ = client.request(method, path, form)
+        except (OSError, http.client.HTTPException):
+            errors[name] += 1
+            continue
+        elapsed = time.perf_counter() - started
+        if status >= 400:
+            errors[name] += 1
+        else:
+            latencies[name].append(elapsed)
+    return latencies, errors
+
+
+def start_server(server, database, port, workers):
+    if server == 'gunicorn':
+        env = dict(os.environ, DATABASE_URL='sqlite:///' + database, BIND=f'127.0.0.1:{port}',
+                   WEB_CONCURRENCY=str(workers))
+        return subprocess.Popen(['gunicorn', '-c', 'gunicorn.conf.py', 'wsgi:application'], env=env)
+    return subprocess.Popen([sys.executable, '-m', 'benchmarks.suite', '--serve',
+                             '--database', database, '--port', str(port)])
+
+
+def serve(database, port):
+    import logging
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)  # Без строки в журнале на каждый запрос
+    app = make_app(database, PASSWORD_MAX_PENDING=1000)
+    make_server('127.0.0.1', port, app, threaded=True).serve_forever()
+
+
+def run_macro(database, characters, options):
+    port = free_port()
+    server = start_server(options.server, database, port, options.workers)
+    try:
+        wait_for(port)
+        context = multiprocessing.get_context('spawn')
+        start_at = time.time() + 2 + options.clients * 0.2  # Клиенты начинают одновременно, после входа
+        with context.Pool(options.clients) as pool:
+            outcomes = pool.starmap(macro_client, [
+                (port, characters, options.duration, options.seed + number, start_at)
+                for number in range(options.clients)
+            ])
+    finally:
+        server.terminate()
+        server.wait()
+
+    results = []
+    merged = {}
+    errors = {}
+    for latencies, client_errors in outcomes:
+        for name, values in latencies.items():
+            merged.setdefault(name, []).extend(values)
+            errors[name] = errors.get(name, 0) + client_errors[name]
+    merged['total'] = [value for values in merged.values() for value in values]
+    errors['total'] = sum(errors.values())
+    for name, values in merged.items():
+        if not values:
+            continue
+        stats = summarize(values, options.duration)
+        stats['errors'] = errors[name]
+        print(f'macro {characters:>8} {name:<24} p50 {stats["p50"] * 1000:8.2f} ms  '
+              f'p99 {stats["p99"] * 1000:8.2f} ms  {stats["rps"]:8.0f}/s  errors {stats["errors"]}')
+        results.append({
+            'level': 'macro', 'size': characters, 'scenario': name, 'stats': stats,
+            'clients': options.clients, 'server': options.server,
+        })
+    return results
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'commit': commit or None,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'sqlite': sqlite3.sqlite_version,
+    }
+
+
+def result_key(result):
+    return result['level'], result['size'], result['scenario']
+
+
+def compare(results, baseline, tolerance):
+    # Медиана задержки растёт или пропускная способность macro падает больше чем на tolerance
+    previous = {result_key(result): result for result in baseline['results']}
+    regressions = []
+    print(f'\ncomparison with baseline {baseline["environment"].get("commit")} (tolerance {tolerance:.0%}):')
+    for result in results:
+        old = previous.get(result_key(result))
+        if old is None:
+            continue
+        ratio = result['stats']['p50'] / old['stats']['p50'] if old['stats']['p50'] else 1.0
+        worse = ratio > 1 + tolerance
+        line = f'  {result["level"]} {result["size"]:>8} {result["scenario"]:<24} p50 x{ratio:5.2f}'
+        if result['level'] == 'macro':
+            rps_ratio = result['stats']['rps'] / old['stats']['rps'] if old['stats']['rps'] else 1.0
+            worse = worse or rps_ratio < 1 - tolerance
+            line += f'  rps x{rps_ratio:5.2f}'
+        if worse:
+            regressions.append(result_key(result))
+            line += '  REGRESSION'
+        print(line)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro and macro benchmarks for every route.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000], help='Characters in the seeded database.')
+    parser.add_argument('--levels', nargs='+', choices=['micro', 'macro'], default=['micro', 'macro'])
+    parser.add_argument('--scenarios', nargs='+', default=None, help='Run only scenarios containing these names.')
+    parser.add_argument('--rounds', type=int, default=100, help='Measured requests per micro scenario.')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds of macro load.')
+    parser.add_argument('--clients', type=int, default=8, help='Concurrent macro client processes.')
+    parser.add_argument('--server', choices=['werkzeug', 'gunicorn'], default='werkzeug')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn workers.')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'character-benchmarks'),
+                        help='Where seeded databases are kept between runs.')
+    parser.add_argument('--reseed', action='store_true')
+    parser.add_argument('--output', help='Write results as JSON.')
+    parser.add_argument('--baseline', help='JSON results to compare with.')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed slowdown against the baseline.')
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--database', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.serve:
+        serve(options.database, options.port)
+        return 0
+
+    def selected(name):
+        return not options.scenarios or any(part in name for part in options.scenarios)
+
+    work_dir = tempfile.mkdtemp()
+    results = []
+    for characters in options.sizes:
+        for level in options.levels:
+            # Каждый уровень — на свежей копии: micro добавляет и меняет персонажей
+            database = seeded_copy(options.data_dir, characters, os.path.join(work_dir, f'{level}.db'),
+                                   options.seed, options.reseed)
+            if level == 'micro':
+                results += run_micro(database, characters, options.rounds, options.seed, selected)
+            else:
+                results += run_macro(database, characters, options)
+
+    report = {'environment': environment(), 'options': vars(options), 'results': results}
+    if options.output:
+        with open(options.output, 'w', encoding='utf-8') as output:
+            json.dump(report, output, indent=2)
+        print(f'results written to {options.output}')
+    if options.baseline:
+        with open(options.baseline, encoding='utf-8') as source:
+            regressions = compare(results, json.load(source), options.tolerance)
+        if regressions:
+            print(f'{len(regressions)} regressions')
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,150 @@
+from sqlalchemy import func, insert, select, text
+from history import next_character_id
+from skills import LEGACY_SKILLS, save_legacy_skills
+
+# {имя таблицы: id, после которого начинаются вставленные строки} для
+# коммитящейся транзакции BulkInserter. Сырые executemany (columns=...) идут
+# мимо событий ORM, поэтому подписчики before_commit/after_commit (кэш,
+# сводная статистика) узнают о пакетной записи отсюда.
+BULK_TABLES = 'bulk_inserted_tables'
+
+
+class BulkInserter:
+    # Пакетная вставка строк Character: executemany по batch_size строк,
+    # commit каждые commit_rows строк. На время транзакции триггеры FTS
+    # приостановлены, а индексы имён и поиска дописываются одним запросом
+    # на индекс перед commit.
+    #
+    # defer_indexes=True — для загрузок, сравнимых с размером таблицы: вторичные
+    # индексы удаляются в начале транзакции и строятся заново перед commit.
+    # Построение индекса сортировкой в разы быстрее вставки в него по строке.
+    #
+    # columns=[...] — строки передаются кортежами в этом порядке и уходят прямо
+    # в executemany драйвера без обработки параметров SQLAlchemy. Значения по
+    # умолчанию при этом не подставляются: все нужные колонки передаёт вызывающий.
+    def __init__(self, session, table, batch_size=1000, commit_rows=50000, defer_indexes=False, columns=None):
+        self.session = session
+        self.table = table
+        self.statement = insert(table)
+        self.raw_sql = None
+        self.first_raw_sql = None
+        if columns is not None:
+            dialect = session.get_bind().dialect
+            self.raw_sql = str(self.statement.compile(dialect=dialect, column_keys=columns))
+            self.first_raw_sql = str(self.statement.compile(dialect=dialect, column_keys=['id', *columns]))
+        self.batch_size = batch_size
+        self.commit_rows = commit_rows
+        self.batch = []
+        self.pending = 0
+        self.inserted = 0
+        self.start_id = None
+        self.first_id = None
+        self.defer_indexes = defer_indexes
+        self.dropped_indexes = []
+
+    def add(self, mapping):
+        self.batch.append(mapping)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def add_rows(self, rows):
+        # Готовый блок кортежей (режим columns=...) уходит одним executemany
+        self.batch.extend(rows)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+        if self.start_id is None:
+            self._begin()
+        batch = self.batch
+        legacy = self._pop_legacy_skills(batch)
+        if self.first_id is not None:
+            self._insert_first(batch[0])
+            batch = batch[1:]
+        if batch and self.raw_sql is None:
+            self.session.execute(self.statement, batch)
+        elif batch:
+            self.session.connection().exec_driver_sql(self.raw_sql, batch)
+        save_legacy_skills(self.session.connection(), legacy)
+        self.inserted += len(self.batch)
+        self.pending += len(self.batch)
+        self.batch = []
+        if self.pending >= self.commit_rows:
+            self.commit()
+
+    def commit(self):
+        if self.start_id is not None:
+            self._restore_indexes()
+            self._sync_fts()
+            self.session.info.setdefault(BULK_TABLES, {})[self.table.name] = self.start_id
+        try:
+            self.session.commit()
+        finally:
+            self.session.info.pop(BULK_TABLES, None)
+        self.pending = 0
+        self.start_id = None
+
+    def finish(self):
+        self.flush()
+        self.commit()
+        return self.inserted
+
+    def _begin(self):
+        # Сначала запись: транзакция переходит на соединение писателя, и максимум id
+        # читается уже под его блокировкой. Новые строки получат id больше максимума.
+        self.session.execute(text("INSERT INTO fts_sync_pause DEFAULT VALUES"))
+        self.start_id = self.session.execute(select(func.coalesce(func.max(self.table.c.id), 0))).scalar()
+        # Последние id принадлежали удалённым персонажам с историей (history.py): первая строка
+        # получает id за ними явно, остальные SQLite нумерует после неё
+        self.first_id = next_character_id(self.session.connection())
+        if self.first_id is not None:
+            self.start_id = self.first_id - 1
+        if self.defer_indexes:
+            self._drop_indexes()
+
+    def _pop_legacy_skills(self, batch):
+        # Исходная строка навыков (skills.py) — не колонка таблицы. Id строк транзакции
+        # идут подряд после start_id, по ним строки сохраняются в character_skills_legacy
+        if self.raw_sql is not None:
+            return []
+        first = self.start_id + self.pending + 1
+        legacy = []
+        for index, row in enumerate(batch):
+            skills = row.pop(LEGACY_SKILLS, None)
+            if skills is not None:
+                legacy.append((first + index, skills))
+        return legacy
+
+    def _insert_first(self, row):
+        if self.raw_sql is None:
+            self.session.execute(self.statement, [dict(row, id=self.first_id)])
+        else:
+            self.session.connection().exec_driver_sql(self.first_raw_sql, [(self.first_id, *row)])
+        self.first_id = None
+
+    def _drop_indexes(self):
+        self.dropped_indexes = self.session.execute(
+            text("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = :table AND sql IS NOT NULL"),
+            {'table': self.table.name}
+        ).all()
+        for name, _ in self.dropped_indexes:
+            self.session.execute(text(f'DROP INDEX "{name}"'))
+
+    def _restore_indexes(self):
+        for _, sql in self.dropped_indexes:
+            self.session.execute(text(sql))
+        self.dropped_indexes = []
+
+    def _sync_fts(self):
+        self.session.execute(
+            text("INSERT INTO character_name_fts (rowid, name) SELECT id, name FROM character WHERE id > :start_id"),
+            {'start_id': self.start_id}
+        )
+        self.session.execute(
+            text("INSERT INTO character_search_fts (rowid, name, description, skills) "
+                 "SELECT id, name, description, skills FROM character_search_source WHERE id > :start_id"),
+            {'start_id': self.start_id}
+        )
+        self.session.execute(text("DELETE FROM fts_sync_pause"))
@@ -0,0 +1,245 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from sqlalchemy import event
+from bulk import BULK_TABLES
+
+# Маркер промаха: None тоже может быть закэшированным значением
+MISSING = object()
+
+
+class CacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def to_dict(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
+
+
+class LRUCache:
+    # Кэш в памяти процесса: LRU по числу записей плюс TTL у каждой записи
+    def __init__(self, max_entries=1024, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = CacheStats()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats.misses += 1
+                return MISSING
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self.entries[key]
+                self.stats.misses += 1
+                self.stats.evictions += 1
+                return MISSING
+            self.entries.move_to_end(key)
+            self.stats.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self.lock:
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.stats.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self.stats.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.stats.invalidations += len(self.entries)
+            self.entries.clear()
+
+    def size(self):
+        return len(self.entries)
+
+
+class SQLiteCache:
+    # Общий для всех процессов на машине кэш в отдельном файле SQLite —
+    # локальная замена memcached/redis. Значения сериализуются pickle.
+    def __init__(self, path, max_entries=10000, ttl=300):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.local = threading.local()
+        self.stats = CacheStats()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = self._connection()
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache_entry ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL)"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS ix_cache_entry_expires_at ON cache_entry (expires_at)")
+
+    def _connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=OFF")  # Потеря кэша при сбое не страшна
+            self.local.connection = connection
+        return connection
+
+    def get(self, key):
+        row = self._connection().execute(
+            "SELECT value, expires_at FROM cache_entry WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            self.stats.misses += 1
+            return MISSING
+        value, expires_at = row
+        if expires_at is not None and expires_at <= time.time():
+            self._connection().execute("DELETE FROM cache_entry WHERE key = ?", (key,))
+            self.stats.misses += 1
+            self.stats.evictions += 1
+            return MISSING
+        self.stats.hits += 1
+        return pickle.loads(value)
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.time() + ttl if ttl else None
+        connection = self._connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO cache_entry (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), expires_at)
+        )
+        overflow = connection.execute("SELECT COUNT(*) FROM cache_entry").fetchone()[0] - self.max_entries
+        if overflow > 0:
+            # Вытесняем записи, которые истекают раньше всех (вечные — в последнюю очередь)
+            connection.execute(
+                "DELETE FROM cache_entry WHERE key IN (SELECT key FROM cache_entry "
+                "ORDER BY expires_at IS NULL, expires_at LIMIT ?)", (overflow,)
+            )
+            self.stats.evictions += overflow
+
+    def delete(self, key):
+        cursor = self._connection().execute("DELETE FROM cache_entry WHERE key = ?", (key,))
+        self.stats.invalidations += cursor.rowcount
+
+    def clear(self):
+        cursor = self._connection().execute("DELETE FROM cache_entry")
+        self.stats.invalidations += cursor.rowcount
+
+    def size(self):
+        return self._connection().execute("SELECT COUNT(*) FROM cache_entry").fetchone()[0]
+
+
+def make_cache(config):
+    if config.get('CACHE_BACKEND', 'memory') == 'sqlite':
+        return SQLiteCache(config['CACHE_SQLITE_PATH'], config['CACHE_MAX_ENTRIES'], config['CACHE_TTL'])
+    return LRUCache(config['CACHE_MAX_ENTRIES'], config['CACHE_TTL'])
+
+
+class CharacterCache:
+    # Кэш страниц персонажей поверх любого бэкенда:
+    #  - фрагмент карточки хранится вместе с версией персонажа (Character.version);
+    #  - результаты списка лежат под ключом с поколением, которое меняется при любой записи.
+    # namespace — префикс ключей: у кампаний (campaigns.py) общий бэкенд, но свои id
+    def __init__(self, backend, namespace=''):
+        self.backend = backend
+        self.namespace = namespace
+
+    def detail_key(self, character_id):
+        return f'{self.namespace}character:{character_id}'
+
+    def get_detail(self, character_id, version):
+        entry = self.backend.get(self.detail_key(character_id))
+        if entry is MISSING or entry[0] != version:
+            return None
+        return entry[1]
+
+    def set_detail(self, character_id, version, fragment):
+        self.backend.set(self.detail_key(character_id), (version, fragment))
+
+    def list_generation(self):
+        # Случайное поколение: если ключ вытеснен, новое значение не совпадёт со старыми
+        generation = self.backend.get(f'{self.namespace}list:generation')
+        if generation is MISSING:
+            generation = uuid.uuid4().hex
+            self.backend.set(f'{self.namespace}list:generation', generation, ttl=0)
+        return generation
+
+    def list_key(self, params):
+        # Ключ берётся до запроса к базе: если запись случится во время запроса,
+        # результат ляжет под старое поколение и не будет прочитан
+        return f'{self.namespace}list:{self.list_generation()}:{params}'
+
+    def get_list(self, key):
+        entry = self.backend.get(key)
+        return None if entry is MISSING else entry
+
+    def set_list(self, key, value):
+        self.backend.set(key, value)
+
+    def invalidate(self, character_ids, lists=True):
+        for character_id in character_ids:
+            self.backend.delete(self.detail_key(character_id))
+        if lists:
+            self.backend.set(f'{self.namespace}list:generation', uuid.uuid4().hex, ttl=0)
+            self.backend.stats.invalidations += 1
+
+    def stats(self):
+        data = self.backend.stats.to_dict()
+        data['size'] = self.backend.size()
+        data['backend'] = type(self.backend).__name__
+        return data
+
+
+def register_invalidation(session, model, character_cache):
+    # Точечная инвалидация через события сессии SQLAlchemy: изменённые id
+    # собираются при flush и сбрасываются из кэша только после commit
+    table_name = model.__table__.name
+
+    @event.listens_for(session, 'after_flush')
+    def collect_changes(session, flush_context):
+        changed = session.info.setdefault('cache_changed_characters', set())
+        for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+            if isinstance(instance, model):
+                changed.add(instance.id)
+                session.info['cache_lists_dirty'] = True
+
+    @event.listens_for(session, 'do_orm_execute')
+    def collect_bulk_changes(orm_execute_state):
+        # Пакетные insert/update/delete (BulkInserter и т.п.) идут мимо flush
+        if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+            statement_table = getattr(orm_execute_state.statement, 'table', None)
+            if statement_table is not None and statement_table.name == table_name:
+                orm_execute_state.session.info['cache_lists_dirty'] = True
+
+    @event.listens_for(session, 'after_commit')
+    def invalidate(session):
+        changed = session.info.pop('cache_changed_characters', set())
+        lists_dirty = session.info.pop('cache_lists_dirty', False) or table_name in session.info.get(BULK_TABLES, ())
+        if changed or lists_dirty:
+            character_cache.invalidate(changed, lists=lists_dirty)
+
+    @event.listens_for(session, 'after_rollback')
+    def discard(session):
+        session.info.pop('cache_changed_characters', None)
+        session.info.pop('cache_lists_dirty', None)
@@ -0,0 +1,282 @@
+import heapq
+import itertools
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from flask import abort, current_app, g, session
+from sqlalchemy import select, text
+from sqlalchemy.orm import Session
+from database import CAMPAIGN, READER, SHARED_TABLES, create_engines, create_file_reader
+from models import db, Campaign, utcnow
+from migrations import upgrade
+from cache import CharacterCache
+from changes import make_change_feed
+
+# Кампании: персонажи каждой группы игроков живут в своём файле SQLite
+# (instance/campaigns/<slug>.db) со схемой основной базы — своими индексами,
+# поиском, сводками и журналом изменений. Запись в большую кампанию не держит
+# блокировку остальных, а кампания архивируется одним файлом.
+#
+#  - Пользователи и реестр кампаний (таблица campaign) — в основной базе, её
+#    персонажи — кампания по умолчанию (адреса без префикса).
+#  - Кампанию выбирает префикс URL /c/<slug>/..., без него — кампания из сессии
+#    (/campaigns/<slug>/use). RoutingSession (database.py) отправляет запросы к
+#    персонажам в движки кампании, к user и campaign — в основную базу.
+#  - Открытые базы держит LRU на CAMPAIGN_MAX_OPEN кампаний: вытесненная закрывает
+#    соединения и поток ленты, и тысячи кампаний не исчерпывают дескрипторы файлов.
+#  - Запросы администратора по всем кампаниям выполняются параллельно в пуле потоков,
+#    а отсортированные результаты кампаний сливаются в один порядок (heapq.merge).
+
+DEFAULT_CAMPAIGN = 'default'  # Персонажи основной базы
+SLUG = re.compile(r'[a-z0-9][a-z0-9-]{0,49}')
+URL_PREFIX = '/c/<campaign>'
+
+
+class CampaignError(ValueError):
+    pass
+
+
+class CampaignDatabase:
+    # Открытая база кампании: писатель и пул читателей, кэш страниц, лента изменений
+    def __init__(self, slug, engines, character_cache, change_feed):
+        self.slug = slug
+        self.engines = engines
+        self.character_cache = character_cache
+        self.change_feed = change_feed
+        self.checked_at = time.monotonic()
+
+    def close(self):
+        # Соединения, которые сейчас заняты запросом, закроются, когда он их вернёт
+        self.change_feed.stop()
+        for engine in self.engines.values():
+            engine.dispose()
+
+
+def campaign_tables():
+    return [table for table in db.metadata.sorted_tables if table.name not in SHARED_TABLES]
+
+
+def sqlite_uri(path):
+    return 'sqlite:///' + path
+
+
+class CampaignRegistry:
+    def __init__(self, config, cache_backend):
+        self.config = config
+        self.folder = config['CAMPAIGN_FOLDER']
+        self.max_open = config['CAMPAIGN_MAX_OPEN']
+        self.check_interval = config['CAMPAIGN_CHECK_INTERVAL']
+        self.cache_backend = cache_backend  # Общий с основной базой, ключи с префиксом кампании
+        self.open = OrderedDict()  # slug -> CampaignDatabase, от давно использованных к недавним
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(config['CAMPAIGN_FANOUT_WORKERS'], thread_name_prefix='campaign-fanout')
+        self.fan_out_path = threading.local()
+        self.fan_out_engine = create_file_reader(config, lambda: self.fan_out_path.value)
+        self.opened = 0
+        self.evicted = 0
+
+    def path(self, slug):
+        return os.path.join(self.folder, f'{slug}.db')
+
+    def is_active(self, slug):
+        return db.session.execute(
+            select(Campaign.id).where(Campaign.slug == slug, Campaign.archived_at.is_(None))
+        ).first() is not None
+
+    def get(self, slug):
+        # Открытая база кампании; None — кампании нет или она в архиве. Реестр сверяется
+        # не чаще раза в CAMPAIGN_CHECK_INTERVAL: так архивация в другом процессе
+        # закрывает базу и здесь, а обычный запрос не ходит в основную базу
+        now = time.monotonic()
+        with self.lock:
+            database = self.open.get(slug)
+            if database is not None and now - database.checked_at < self.check_interval:
+                self.open.move_to_end(slug)
+                return database
+        active = self.is_active(slug) and os.path.exists(self.path(slug))
+        with self.lock:
+            database = self.open.get(slug)
+            if not active:
+                if database is not None:
+                    del self.open[slug]
+                    database.close()
+                return None
+            if database is None:
+                database = self._open(slug)
+                self.open[slug] = database
+                while len(self.open) > self.max_open:
+                    _, evicted = self.open.popitem(last=False)
+                    evicted.close()
+                    self.evicted += 1
+            database.checked_at = now
+            self.open.move_to_end(slug)
+            return database
+
+    def _open(self, slug):
+        engines = create_engines(sqlite_uri(self.path(slug)), self.config, self.config['CAMPAIGN_READ_POOL_SIZE'])
+        upgrade(engines[None])  # Миграции, появившиеся после создания кампании; иначе одно чтение user_version
+        if self.config['METRICS_ENABLED']:
+            from metrics import register_query_hooks
+            for engine in engines.values():
+                register_query_hooks(engine)
+        self.opened += 1
+        return CampaignDatabase(
+            slug, engines, CharacterCache(self.cache_backend, f'campaign:{slug}:'),
+            make_change_feed(self.config, engines, READER)
+        )
+
+    def close(self, slug):
+        with self.lock:
+            database = self.open.pop(slug, None)
+        if database is not None:
+            database.close()
+
+    def reader(self, slug, main_engine):
+        # Движок для запроса по всем кампаниям. У открытой базы — её пул читателей, для
+        # остальных — общий движок без пула: проход по тысячам кампаний не вытесняет из
+        # LRU базы, с которыми работают пользователи, и не держит их файлы открытыми
+        if slug == DEFAULT_CAMPAIGN:
+            return main_engine
+        with self.lock:
+            database = self.open.get(slug)
+        if database is not None:
+            return database.engines[READER]
+        self.fan_out_path.value = self.path(slug)  # Соединение откроется в этом же потоке
+        return self.fan_out_engine
+
+    def fan_out(self, slugs, function, main_engine):
+        # function(session) по каждой кампании в пуле потоков -> [(slug, результат)] в порядке slugs
+        def run(slug):
+            with Session(self.reader(slug, main_engine)) as reader_session:
+                return slug, function(reader_session)
+
+        return list(self.executor.map(run, slugs))
+
+    def stats(self):
+        with self.lock:
+            return {'open': len(self.open), 'max_open': self.max_open, 'opened': self.opened,
+                    'evicted': self.evicted}
+
+
+def make_campaign_registry(config, cache_backend):
+    os.makedirs(config['CAMPAIGN_FOLDER'], exist_ok=True)
+    return CampaignRegistry(config, cache_backend)
+
+
+def use_campaign(database):
+    # Кампания для оставшейся части запроса (или задачи): движки сессии, кэш и лента
+    g.campaign = database
+    db.session.info[CAMPAIGN] = database
+
+
+def campaign_slug():
+    campaign = g.get('campaign')
+    return campaign.slug if campaign is not None else DEFAULT_CAMPAIGN
+
+
+def select_campaign(endpoint, values):
+    # url_value_preprocessor: <campaign> из URL (и убирается из аргументов view), иначе из сессии
+    if endpoint == 'static':
+        return
+    slug = values.pop('campaign', None) if values else None
+    if slug is not None:
+        g.campaign_url = slug
+    else:
+        slug = session.get('campaign')
+    if not slug or slug == DEFAULT_CAMPAIGN:
+        return
+    database = current_app.extensions['campaigns'].get(slug) if SLUG.fullmatch(slug) else None
+    if database is None:
+        if g.get('campaign_url'):
+            abort(404)
+        session.pop('campaign', None)  # Кампанию из сессии архивировали
+        return
+    use_campaign(database)
+
+
+def add_campaign_to_url(endpoint, values):
+    # url_defaults: ссылки со страницы /c/<slug>/... ведут в ту же кампанию
+    slug = g.get('campaign_url')
+    if slug and 'campaign' not in values and current_app.url_map.is_endpoint_expecting(endpoint, 'campaign'):
+        values['campaign'] = slug
+
+
+def active_campaigns():
+    return Campaign.query.filter(Campaign.archived_at.is_(None)).order_by(Campaign.slug).all()
+
+
+def create_campaign(registry, slug, name):
+    # Файл базы со схемой создаётся до строки реестра: кампания из реестра всегда готова
+    slug = (slug or '').strip().lower()
+    name = (name or '').strip() or slug
+    if not SLUG.fullmatch(slug) or slug == DEFAULT_CAMPAIGN:
+        raise CampaignError('Campaign id: 1-50 lowercase letters, digits and dashes.')
+    if len(name) > 100:
+        raise CampaignError('Campaign name is longer than 100 characters.')
+    if Campaign.query.filter_by(slug=slug).first() is not None or os.path.exists(registry.path(slug)):
+        raise CampaignError(f'Campaign {slug} already exists.')
+    engine = create_engines(sqlite_uri(registry.path(slug)), registry.config, 0)[None]
+    try:
+        db.metadata.create_all(engine, tables=campaign_tables())
+        upgrade(engine)
+    finally:
+        engine.dispose()
+    campaign = Campaign(slug=slug, name=name)
+    db.session.add(campaign)
+    db.session.commit()
+    return campaign
+
+
+# Триггер в базе архивной кампании: запись персонажей отклоняется
+ARCHIVED_TRIGGER = (
+    "CREATE TRIGGER campaign_archived_{op} BEFORE {op} ON character "
+    "BEGIN SELECT RAISE(ABORT, 'Campaign is archived.'); END"
+)
+
+
+def archive_campaign(registry, slug, busy_timeout=5.0):
+    # Кампания помечается архивной, а база переносится одним файлом в archive/. Другие
+    # процессы закрывают базу не сразу (CAMPAIGN_CHECK_INTERVAL), поэтому на время копии
+    # отдельное соединение держит BEGIN EXCLUSIVE: их запись ждёт блокировку и либо уже
+    # попала в копию, либо после неё упирается в триггеры ARCHIVED_TRIGGER, а не пишет
+    # в удалённый файл. Копию читает второе соединение: в WAL блокировка ему не мешает
+    from backup import copy_database
+    campaign = Campaign.query.filter_by(slug=slug, archived_at=None).first()
+    if campaign is None:
+        raise CampaignError(f'No active campaign {slug}.')
+    campaign.archived_at = utcnow()
+    db.session.commit()
+    registry.close(slug)
+    folder = os.path.join(registry.folder, 'archive')
+    os.makedirs(folder, exist_ok=True)
+    target = os.path.join(folder, f"{slug}-{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}.db")
+    lock = sqlite3.connect(registry.path(slug), timeout=busy_timeout, isolation_level=None)
+    try:
+        lock.execute("BEGIN EXCLUSIVE")
+        copy_database(registry.path(slug), target, -1, 0)  # Одним шагом: запись ждёт только копирование
+        for op in ('INSERT', 'UPDATE', 'DELETE'):
+            lock.execute(ARCHIVED_TRIGGER.format(op=op))
+        lock.execute("COMMIT")
+    finally:
+        lock.close()
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(registry.path(slug) + suffix):
+            os.remove(registry.path(slug) + suffix)
+    return target
+
+
+def merge_sorted(results, key, reverse=False, limit=None):
+    # [(slug, строки по key)] -> [(slug, строка)] в общем порядке, не больше limit
+    streams = [[(slug, row) for row in rows] for slug, rows in results]
+    merged = heapq.merge(*streams, key=lambda item: key(item[1]), reverse=reverse)
+    return list(itertools.islice(merged, limit))
+
+
+def character_total(reader_session):
+    # Число персонажей из сводной таблицы (stats.py), без прохода по character
+    return reader_session.execute(text("SELECT COALESCE(SUM(count), 0) FROM character_stats_group")).scalar()
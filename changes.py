@@ -0,0 +1,333 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque, namedtuple
+from sqlalchemy import column, event, insert, inspect, table, text
+from sqlalchemy.orm import object_session
+from bulk import BULK_TABLES
+from skills import format_skills, skills_sql
+
+logger = logging.getLogger(__name__)
+
+# Лента изменений персонажей для клиентов, которые держат открытыми список и
+# карточки (SSE /changes) — вместо опроса страниц.
+#
+# Каждая запись в character (ORM, пакетная вставка, пакетное изменение) в той же
+# транзакции добавляет компактное событие в change_event. seq — AUTOINCREMENT:
+# запись в SQLite идёт по одной транзакции, поэтому порядок seq совпадает с
+# порядком commit, а номера не переиспользуются после очистки старых событий.
+#
+# Брокер не нужен: сама таблица — общий журнал для всех процессов на машине.
+# В каждом процессе один поток ChangeFeed читает новые события (один запрос
+# на процесс, а не на клиента) и кладёт их в кольцевой буфер; потоки SSE ждут
+# на Condition и отдают события из буфера, в том числе при продолжении с Last-Event-ID.
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS change_event ("
+    "seq INTEGER PRIMARY KEY AUTOINCREMENT, created_at REAL NOT NULL, data TEXT NOT NULL)",
+]
+
+ABILITIES = ['strength', 'dexterity', 'constitution', 'intelligence', 'wisdom', 'charisma']
+# Поля строки списка в событиях; навыки — строкой (skills), описание — только в событии правки
+FEED_FIELDS = ['name', 'race', 'character_class', 'level', 'experience', *ABILITIES, 'max_hp', 'current_hp',
+               'image_path']
+ROW_EVENTS_MAX = 1000  # Пакетная запись большего числа строк публикует одно сводное событие
+
+PUBLISHED = 'change_feed_published'  # Флаг в session.info: после commit разбудить поток ленты
+
+change_event = table('change_event', column('seq'), column('created_at'), column('data'))
+
+# Событие в буфере: разобранные данные для фильтров и готовое сообщение SSE
+Change = namedtuple('Change', ['seq', 'data', 'message'])
+
+
+def create_tables(connection):
+    for statement in SCHEMA:
+        connection.exec_driver_sql(statement)
+
+
+def publish(connection, data):
+    connection.execute(insert(change_event).values(created_at=time.time(), data=json.dumps(data)))
+
+
+def character_event(op, target, **extra):
+    data = {'op': op, 'id': target.id, 'version': target.version, 'race': target.race,
+            'character_class': target.character_class}
+    data.update(extra)
+    return data
+
+
+def row_values(target):
+    values = {field: getattr(target, field) for field in FEED_FIELDS}
+    values['skills'] = format_skills(target.skills_mask or 0)
+    return values
+
+
+def changed_values(target):
+    # (новые значения изменившихся полей, прежние race/character_class, если они менялись)
+    state = inspect(target)
+    changes = {}
+    previous = {}
+    for field in FEED_FIELDS + ['description', 'skills_mask']:
+        history = state.attrs[field].history
+        if not history.added or history.deleted == history.added:
+            continue
+        if field == 'skills_mask':
+            changes['skills'] = format_skills(target.skills_mask or 0)
+        else:
+            changes[field] = getattr(target, field)
+        if field in ('race', 'character_class') and history.deleted:
+            previous[field] = history.deleted[0]
+    return changes, previous
+
+
+def field_sql(field):
+    return skills_sql('skills_mask') if field == 'skills' else field
+
+
+def row_event_sql(op, fields):
+    # json_object события character_event для INSERT ... SELECT по таблице character
+    changes = ', '.join(f"'{field}', {field_sql(field)}" for field in fields)
+    return (f"json_object('op', '{op}', 'id', id, 'version', version, 'race', race, "
+            f"'character_class', character_class, 'changes', json_object({changes}))")
+
+
+def publish_rows(connection, op, fields, where, parameters):
+    connection.execute(text(
+        f"INSERT INTO change_event (created_at, data) SELECT :now, {row_event_sql(op, fields)} "
+        f"FROM character WHERE {where} ORDER BY id"
+    ), dict(parameters, now=time.time()))
+
+
+def publish_inserted(connection, start_id):
+    # Пакетная вставка (BulkInserter): события по строкам или одно bulk_insert с диапазоном id
+    where = "id > :start_id"
+    first_id, last_id, count = connection.execute(
+        text(f"SELECT MIN(id), MAX(id), COUNT(*) FROM character WHERE {where}"), {'start_id': start_id}
+    ).one()
+    if not count:
+        return
+    if count <= ROW_EVENTS_MAX:
+        publish_rows(connection, 'insert', FEED_FIELDS + ['skills'], where, {'start_id': start_id})
+    else:
+        publish(connection, {'op': 'bulk_insert', 'first_id': first_id, 'last_id': last_id, 'count': count})
+
+
+def publish_selected(connection, where, fields):
+    # Пакетное изменение (updates.bulk_update) по строкам из where. При смене race или
+    # character_class подписчики с такими фильтрами должны узнать и о выбывших
+    # строках, поэтому тогда, как и для больших наборов, публикуется одно bulk_update
+    fields = sorted('skills' if field == 'skills_mask' else field for field in fields
+                    if field not in ('version', 'updated_at'))
+    count = connection.execute(text(f"SELECT COUNT(*) FROM character WHERE {where}")).scalar()
+    if not count:
+        return
+    if count <= ROW_EVENTS_MAX and not {'race', 'character_class'} & set(fields):
+        publish_rows(connection, 'update', fields, where, {})
+    else:
+        publish(connection, {'op': 'bulk_update', 'fields': fields, 'count': count})
+
+
+def register_change_feed(session, model, change_feed):
+    # События пишутся в транзакции изменения: откат убирает и их
+    table_name = model.__table__.name
+
+    def published(target):
+        object_session(target).info[PUBLISHED] = True
+
+    @event.listens_for(model, 'after_insert')
+    def publish_insert(mapper, connection, target):
+        changes = row_values(target)
+        publish(connection, character_event('insert', target, changes=changes))
+        published(target)
+
+    @event.listens_for(model, 'after_update')
+    def publish_update(mapper, connection, target):
+        changes, previous = changed_values(target)
+        if not changes:
+            return
+        data = character_event('update', target, changes=changes)
+        if previous:
+            data['previous'] = previous
+        publish(connection, data)
+        published(target)
+
+    @event.listens_for(model, 'after_delete')
+    def publish_delete(mapper, connection, target):
+        publish(connection, character_event('delete', target))
+        published(target)
+
+    @event.listens_for(session, 'do_orm_execute')
+    def collect_bulk_changes(orm_execute_state):
+        # Пакетное изменение публикует события само (publish_selected), здесь только флаг
+        if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+            statement_table = getattr(orm_execute_state.statement, 'table', None)
+            if statement_table is not None and statement_table.name == table_name:
+                orm_execute_state.session.info[PUBLISHED] = True
+
+    @event.listens_for(session, 'before_commit')
+    def publish_bulk_insert(session):
+        start_id = session.info.get(BULK_TABLES, {}).get(table_name)
+        if start_id is not None:
+            publish_inserted(session.connection(), start_id)
+            session.info[PUBLISHED] = True
+
+    @event.listens_for(session, 'after_commit')
+    def wake(session):
+        # Поток ленты этого процесса забирает событие сразу; остальные — на следующем опросе
+        if session.info.pop(PUBLISHED, False):
+            change_feed.wake()
+
+    @event.listens_for(session, 'after_rollback')
+    def discard(session):
+        session.info.pop(PUBLISHED, None)
+
+
+def matches(data, ids=None, races=None, classes=None):
+    # Подходит ли событие подписке. Сводные события (bulk_*, restore) не знают отдельных
+    # строк и приходят всем, кроме bulk_insert, id которого вне подписки по ids
+    op = data['op']
+    if op == 'bulk_insert':
+        return not ids or any(data['first_id'] <= character_id <= data['last_id'] for character_id in ids)
+    if op not in ('insert', 'update', 'delete'):
+        return True  # bulk_update, restore (backup.py)
+    if ids and data['id'] not in ids:
+        return False
+    previous = data.get('previous', {})
+    if races and data['race'] not in races and previous.get('race') not in races:
+        return False
+    if classes and data['character_class'] not in classes and previous.get('character_class') not in classes:
+        return False
+    return True
+
+
+def sse_message(seq, event_name, data):
+    return f'id: {seq}\nevent: {event_name}\ndata: {json.dumps(data)}\n\n'
+
+
+class ChangeFeed:
+    # Поток процесса, переносящий новые события из change_event в кольцевой буфер.
+    # Запускается при первой подписке (и заново после fork: потоки не наследуются).
+    def __init__(self, engine, writer_engine, buffer_size=10000, poll_interval=0.25, retention=100000,
+                 batch_size=1000):
+        self.engine = engine
+        self.writer_engine = writer_engine
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.batch_size = batch_size
+        self.events = deque(maxlen=buffer_size)
+        self.condition = threading.Condition()
+        self.poll_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.head = 0  # Последний прочитанный seq
+        self.dropped = 0  # Последний seq, которого в буфере уже нет
+        self.thread = None
+        self.pid = None
+        self.stopped = False
+
+    def start(self):
+        with self.condition:
+            if self.thread is not None and self.pid == os.getpid() and self.thread.is_alive():
+                return
+            self.pid = os.getpid()
+            self._load_tail()
+            self.thread = threading.Thread(target=self._run, name='change-feed', daemon=True)
+            self.thread.start()
+
+    def wake(self):
+        self.wakeup.set()
+
+    def stop(self):
+        # База закрыта (кампания вытеснена из LRU, campaigns.py): поток завершается,
+        # потоки SSE заканчиваются, и браузер переподключается к новой ленте
+        self.stopped = True
+        self.wake()
+        with self.condition:
+            self.condition.notify_all()
+
+    def _load_tail(self):
+        # Последние события из базы: продолжение с Last-Event-ID работает и после перезапуска
+        with self.engine.connect() as connection:
+            rows = connection.execute(
+                text("SELECT seq, data FROM change_event ORDER BY seq DESC LIMIT :limit"),
+                {'limit': self.events.maxlen}
+            ).all()
+            head = connection.execute(
+                text("SELECT seq FROM sqlite_sequence WHERE name = 'change_event'")
+            ).scalar() or 0
+        self.events.clear()
+        self.events.extend(self._entry(seq, data) for seq, data in reversed(rows))
+        self.head = rows[0][0] if rows else head
+        self.dropped = rows[-1][0] - 1 if rows else self.head
+
+    def _entry(self, seq, data):
+        data = json.loads(data)
+        data['seq'] = seq
+        return Change(seq, data, sse_message(seq, 'change', data))
+
+    def _run(self):
+        while not self.stopped:
+            self.wakeup.wait(self.poll_interval)
+            self.wakeup.clear()
+            try:
+                self.poll()
+            except Exception:
+                logger.exception('Change feed poll failed')
+
+    def poll(self):
+        with self.poll_lock:
+            while True:
+                with self.engine.connect() as connection:
+                    rows = connection.execute(
+                        text("SELECT seq, data FROM change_event WHERE seq > :head ORDER BY seq LIMIT :limit"),
+                        {'head': self.head, 'limit': self.batch_size}
+                    ).all()
+                if not rows:
+                    return
+                entries = [self._entry(seq, data) for seq, data in rows]
+                with self.condition:
+                    overflow = len(self.events) + len(entries) - self.events.maxlen
+                    if overflow > 0:
+                        self.dropped = (list(self.events) + entries)[overflow - 1].seq
+                    self.events.extend(entries)
+                    self.head = entries[-1].seq
+                    self.condition.notify_all()
+                if self.head % self.retention < len(rows):
+                    self.prune()
+                if len(rows) < self.batch_size:
+                    return
+
+    def prune(self):
+        # Раз на retention событий: в базе остаются последние retention событий
+        with self.writer_engine.begin() as connection:
+            connection.execute(text("DELETE FROM change_event WHERE seq <= :seq"),
+                               {'seq': self.head - self.retention})
+
+    def since(self, seq):
+        # События после seq; None — их уже нет в буфере (или seq из другой базы): клиенту
+        # нужно перечитать состояние целиком
+        if seq > self.head:
+            self.poll()  # Клиент пришёл из процесса, который прочитал журнал раньше этого
+        with self.condition:
+            if seq < self.dropped or seq > self.head:
+                return None
+            result = []
+            for entry in reversed(self.events):
+                if entry.seq <= seq:
+                    break
+                result.append(entry)
+            result.reverse()
+            return result
+
+    def wait(self, seq, timeout):
+        with self.condition:
+            return self.condition.wait_for(lambda: self.head > seq or self.stopped, timeout)
+
+
+def make_change_feed(config, engines, reader_key):
+    return ChangeFeed(
+        engines.get(reader_key, engines[None]), engines[None], config['CHANGE_FEED_BUFFER'],
+        config['CHANGE_FEED_POLL_INTERVAL'], config['CHANGE_FEED_RETENTION']
+    )
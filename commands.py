@@ -0,0 +1,268 @@
+import functools
+import json
+import time
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from models import db, Character, init_db
+from extensions import character_cache, image_processor
+from images import pending_images
+
+
+def campaign_option(command):
+    # --campaign SLUG: команда работает с базой кампании, а не с основной (campaigns.py)
+    @click.option('--campaign', default=None, help='Campaign id (the main database by default).')
+    @functools.wraps(command)
+    def run(campaign, **kwargs):
+        if campaign:
+            from campaigns import DEFAULT_CAMPAIGN, use_campaign
+            if campaign != DEFAULT_CAMPAIGN:
+                database = current_app.extensions['campaigns'].get(campaign)
+                if database is None:
+                    raise click.BadParameter(f'No active campaign {campaign}.', param_hint='--campaign')
+                use_campaign(database)
+        return command(**kwargs)
+    return run
+
+
+@click.command('process-images')
+@with_appcontext
+def process_images_command():
+    # Досоздать уменьшенные копии для уже загруженных картинок
+    futures = [
+        image_processor.submit(image_path)
+        for image_path in pending_images(current_app.config['UPLOAD_FOLDER'])
+    ]
+    for future in futures:
+        future.result()
+    print(f'Processed {len(futures)} images.')
+
+
+@click.command('generate')
+@click.option('--count', default=1000, show_default=True, help='Number of characters to create.')
+@click.option('--seed', type=click.IntRange(min=0), default=None, help='Seed for reproducible output.')
+@with_appcontext
+@campaign_option
+def generate_command(count, seed):
+    from generator import generate_characters, new_seed
+    if seed is None:
+        seed = new_seed()
+    generated = generate_characters(
+        db.session, Character.__table__, count, seed,
+        batch_size=current_app.config['IMPORT_BATCH_SIZE'], commit_rows=current_app.config['IMPORT_COMMIT_ROWS']
+    )
+    print(f'Generated {generated} characters (seed {seed}).')
+
+
+@click.command('recompute-stats')
+@with_appcontext
+@campaign_option
+def recompute_stats_command():
+    # Полный пересчёт сводных таблиц статистики; session.connection() — писатель основной базы
+    # или кампании из --campaign
+    from stats import recompute
+    count = recompute(db.session.connection())
+    db.session.commit()
+    print(f'Statistics recomputed for {count} characters.')
+
+
+@click.command('init-db')
+@with_appcontext
+def init_db_command():
+    init_db()
+    print('Database schema is up to date.')
+
+
+@click.command('jobs-worker')
+@click.option('--processes', type=int, default=None, help='Worker processes (JOB_WORKERS by default).')
+@with_appcontext
+def jobs_worker_command(processes):
+    # Пул процессов, выполняющих фоновые задачи из очереди; останавливается по Ctrl+C / SIGTERM
+    from jobs import run_workers
+    run_workers(processes or current_app.config['JOB_WORKERS'], current_app.config)
+
+
+@click.command('simulate')
+@click.option('--party-a', required=True, help='Comma-separated character ids of the first party.')
+@click.option('--party-b', required=True, help='Comma-separated character ids of the second party.')
+@click.option('--trials', type=click.IntRange(min=1), default=100000, show_default=True,
+              help='Number of simulated encounters.')
+@click.option('--seed', type=click.IntRange(min=0), default=None, help='Seed for reproducible output.')
+@click.option('--processes', type=int, default=0, help='Worker processes; 0 runs in this process.')
+@click.option('--full-hp', is_flag=True, help='Start every character at max HP.')
+@click.option('--json', 'as_json', is_flag=True, help='Print the full result as JSON.')
+@with_appcontext
+@campaign_option
+def simulate_command(party_a, party_b, trials, seed, processes, full_hp, as_json):
+    from generator import new_seed
+    from simulation import load_party, simulate, with_full_hp
+    try:
+        parties = [
+            load_party(db.session, Character.__table__, [int(part) for part in ids.split(',') if part.strip()])
+            for ids in (party_a, party_b)
+        ]
+    except (ValueError, LookupError) as error:
+        raise click.BadParameter(str(error))
+    if full_hp:
+        parties = [with_full_hp(party) for party in parties]
+    if seed is None:
+        seed = new_seed()
+    started = time.perf_counter()
+    result = simulate(*parties, trials, seed, batch_size=current_app.config['SIMULATION_BATCH_SIZE'],
+                      processes=processes)
+    elapsed = time.perf_counter() - started
+    if as_json:
+        print(json.dumps(result, indent=2))
+        return
+    print(f"{trials} encounters in {elapsed:.2f}s (seed {seed}), mean {result['mean_rounds']:.1f} rounds")
+    print(f"Party A wins {result['win_rate_a']:.1%}, party B wins {result['win_rate_b']:.1%}, "
+          f"draws {result['draw_rate']:.1%}")
+    for side in ('a', 'b'):
+        print(f"Party {side.upper()}: expected HP loss {result[f'expected_hp_loss_{side}']:.1f}")
+        for fighter in result[f'party_{side}']:
+            print(f"  #{fighter['id']} {fighter['name']}: HP {fighter['hp']}, "
+                  f"loses {fighter['expected_hp_loss']:.1f}, downed {fighter['downed_rate']:.1%}")
+
+
+def database_path():
+    # Путь к файлу SQLite (Flask-SQLAlchemy уже сделал относительный путь абсолютным в instance/)
+    return db.engine.url.database
+
+
+@click.command('backup')
+@click.option('--pages', type=int, default=None, help='Pages copied per step (BACKUP_PAGES by default).')
+@click.option('--sleep', type=float, default=None, help='Pause between steps in seconds (BACKUP_SLEEP by default).')
+@click.option('--no-uploads', is_flag=True, help='Back up the database only.')
+@click.option('--prune', is_flag=True, help='Keep only the newest BACKUP_KEEP backups afterwards.')
+@with_appcontext
+def backup_command(pages, sleep, no_uploads, prune):
+    # Снимок базы и загрузок без остановки приложения (backup.py)
+    from backup import create_backup, prune_backups
+    config = current_app.config
+    from campaigns import active_campaigns
+    registry = current_app.extensions['campaigns']
+    manifest = create_backup(
+        database_path(), config['UPLOAD_FOLDER'], config['BACKUP_FOLDER'],
+        pages=pages or config['BACKUP_PAGES'], sleep=config['BACKUP_SLEEP'] if sleep is None else sleep,
+        uploads=not no_uploads,
+        campaigns={campaign.slug: registry.path(campaign.slug) for campaign in active_campaigns()}
+    )
+    timings = manifest['timings']
+    size = manifest['database']['bytes'] / 2 ** 20
+    print(f"Backup {manifest['name']}: database {size:.1f} MiB in {timings['database_seconds']:.1f}s "
+          f"({size / max(timings['database_seconds'], 1e-9):.0f} MiB/s, {timings['database_steps']} steps)")
+    if manifest['campaigns']:
+        campaigns_size = sum(entry['bytes'] for entry in manifest['campaigns'].values()) / 2 ** 20
+        print(f"Campaigns: {len(manifest['campaigns'])} databases, {campaigns_size:.1f} MiB "
+              f"in {timings['campaigns_seconds']:.1f}s")
+    if not no_uploads:
+        print(f"Uploads: {len(manifest['uploads'])} files, {timings['uploads_copied']} new "
+              f"({timings['uploads_copied_bytes'] / 2 ** 20:.1f} MiB copied)")
+    if prune:
+        removed = prune_backups(config['BACKUP_FOLDER'], config['BACKUP_KEEP'])
+        print(f'Removed {len(removed)} old backups.')
+
+
+@click.command('backups')
+@with_appcontext
+def backups_command():
+    from backup import list_backups, read_manifest
+    folder = current_app.config['BACKUP_FOLDER']
+    for name in list_backups(folder):
+        manifest = read_manifest(folder, name)
+        print(f"{name}  {manifest['database']['bytes'] / 2 ** 20:9.1f} MiB  "
+              f"{manifest['database']['counts'].get('character', 0):>9} characters  {len(manifest['uploads'])} uploads")
+
+
+@click.command('verify-backup')
+@click.argument('name', required=False)
+@click.option('--quick', is_flag=True, help='PRAGMA quick_check instead of the full integrity_check.')
+@click.option('--objects', 'check_objects', is_flag=True, help='Re-hash every stored upload.')
+@with_appcontext
+def verify_backup_command(name, quick, check_objects):
+    # Без имени проверяется последний снимок
+    from backup import BackupError, latest_backup, read_manifest, verify_backup
+    folder = current_app.config['BACKUP_FOLDER']
+    try:
+        name = name or latest_backup(folder)
+        started = time.perf_counter()
+        problems = verify_backup(folder, name, quick=quick, check_objects=check_objects)
+    except BackupError as error:
+        raise click.ClickException(str(error))
+    for problem in problems:
+        print(problem)
+    if problems:
+        raise click.ClickException(f'Backup {name} is damaged.')
+    counts = read_manifest(folder, name)['database']['counts']
+    print(f"Backup {name} is OK ({time.perf_counter() - started:.1f}s): "
+          f"{counts.get('character', 0)} characters, {counts.get('user', 0)} users.")
+
+
+@click.command('restore-backup')
+@click.argument('name')
+@click.option('--no-uploads', is_flag=True, help='Restore the database only.')
+@click.confirmation_option(prompt='Replace the current database with this backup?')
+@with_appcontext
+def restore_backup_command(name, no_uploads):
+    # Снимок проверяется (quick_check, число строк, файлы загрузок) до того, как что-то меняется
+    from backup import BackupError, restore_backup
+    config = current_app.config
+    try:
+        result = restore_backup(database_path(), config['UPLOAD_FOLDER'], config['BACKUP_FOLDER'], name,
+                                uploads=not no_uploads, campaign_folder=config['CAMPAIGN_FOLDER'])
+    except BackupError as error:
+        raise click.ClickException(str(error))
+    character_cache.backend.clear()  # Общий кэш (CACHE_BACKEND=sqlite) хранит страницы старой базы
+    print(f"Restored {name}: database and {result['campaigns']} campaigns in {result['database_seconds']:.1f}s, "
+          f"{result['uploads_restored']} uploads written.")
+    print('Restart the web workers: their in-memory caches still hold pages of the old database.')
+
+
+@click.command('campaign-create')
+@click.argument('slug')
+@click.option('--name', default=None, help='Display name (the id by default).')
+@with_appcontext
+def campaign_create_command(slug, name):
+    from campaigns import CampaignError, create_campaign
+    registry = current_app.extensions['campaigns']
+    try:
+        campaign = create_campaign(registry, slug, name)
+    except CampaignError as error:
+        raise click.ClickException(str(error))
+    print(f'Campaign {campaign.slug} created: {registry.path(campaign.slug)}')
+
+
+@click.command('campaigns')
+@with_appcontext
+def campaigns_command():
+    # Кампании и число персонажей в каждой (сводки всех баз читаются параллельно)
+    from database import READER
+    from campaigns import DEFAULT_CAMPAIGN, active_campaigns, character_total
+    active = active_campaigns()
+    totals = dict(current_app.extensions['campaigns'].fan_out(
+        [DEFAULT_CAMPAIGN] + [campaign.slug for campaign in active], character_total,
+        db.engines.get(READER, db.engine)
+    ))
+    print(f'{DEFAULT_CAMPAIGN:<30} {totals[DEFAULT_CAMPAIGN]:>10} characters  (main database)')
+    for campaign in active:
+        print(f'{campaign.slug:<30} {totals[campaign.slug]:>10} characters  {campaign.name}')
+
+
+@click.command('campaign-archive')
+@click.argument('slug')
+@click.confirmation_option(prompt='Archive this campaign? Its pages stop working.')
+@with_appcontext
+def campaign_archive_command(slug):
+    # Кампания выводится из работы и переносится одним файлом в CAMPAIGN_FOLDER/archive
+    from campaigns import CampaignError, archive_campaign
+    try:
+        path = archive_campaign(current_app.extensions['campaigns'], slug,
+                                current_app.config['SQLITE_BUSY_TIMEOUT'] / 1000)
+    except CampaignError as error:
+        raise click.ClickException(str(error))
+    print(f'Campaign {slug} archived to {path}')
+
+
+COMMANDS = [process_images_command, generate_command, recompute_stats_command, init_db_command, jobs_worker_command,
+            simulate_command, backup_command, backups_command, verify_backup_command, restore_backup_command,
+            campaign_create_command, campaigns_command, campaign_archive_command]
@@ -1,4 +1,84 @@
+import os
+
+
 class Config:
     SECRET_KEY = 'your-secret-key'
-    SQLALCHEMY_DATABASE_URI = 'sqlite:///app.db'
-    SQLALCHEMY_TRACK_MODIFICATIONS = False
\ No newline at end of file
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'sqlite:///app.db')
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLITE_BUSY_TIMEOUT = 5000  # Мс ожидания чужой блокировки записи
+    SQLITE_CACHE_SIZE = -65536  # Отрицательное — в КиБ: 64 МиБ кэша страниц на соединение
+    SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+    SQLITE_READ_POOL_SIZE = int(os.environ.get('SQLITE_READ_POOL_SIZE', 8))  # Соединений для чтения
+    SQLITE_WRITE_POOL_TIMEOUT = 30  # Секунд ожидания соединения писателя
+    UPLOAD_FOLDER = None  # По умолчанию static/uploads; файлы отдаёт маршрут /uploads/, папка может быть вне static
+    CHARACTERS_PER_PAGE = 50
+    CHARACTERS_MAX_PER_PAGE = 200
+    IMPORT_BATCH_SIZE = 1000  # Строк в одном executemany
+    IMPORT_COMMIT_ROWS = 50000  # Строк в одной транзакции
+    IMPORT_MAX_ERRORS = 1000  # Ошибок в отчёте об импорте
+    EXPORT_CHUNK_SIZE = 1000  # Строк, читаемых из курсора за раз при выгрузке
+    GENERATE_MAX_COUNT = 10000  # Персонажей за один запрос /generate
+    # 'memory' или 'sqlite' (общий для процессов). С 'memory' запись сбрасывает кэш списка только в своём
+    # процессе: остальные воркеры отдают старую главную страницу до CACHE_TTL. Поэтому gunicorn.conf.py,
+    # wsgi.py и asgi.py по умолчанию выбирают 'sqlite'; 'memory' — для flask run и одного процесса
+    CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'memory')
+    CACHE_MAX_ENTRIES = 1024
+    CACHE_TTL = 300  # Секунд
+    CACHE_SQLITE_PATH = None  # По умолчанию instance/cache.db
+    IDENTITY_CACHE_SIZE = 10000  # Пользователей в кэше load_user
+    IDENTITY_CACHE_TTL = 60  # Секунд; ограничивает устаревание между процессами
+    PASSWORD_WORKERS = max(1, (os.cpu_count() or 2) // 2)  # Потоков для проверки паролей; остальные ядра — чтению
+    PASSWORD_MAX_PENDING = 8  # Ожидающих проверок, сверх которых login отвечает 429
+    PASSWORD_TIMEOUT = 10  # Секунд
+    IMAGE_WORKERS = 2  # Потоков для подготовки уменьшенных копий картинок
+    IMMUTABLE_MAX_AGE = 365 * 24 * 3600  # Кэширование файлов с хэшем в имени
+    TEMPLATES_PRECOMPILE = True  # Компилировать все шаблоны при создании приложения
+    TEMPLATES_BYTECODE_CACHE = None  # По умолчанию instance/jinja; '' — не сохранять байткод
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED') == '1'  # Гистограммы запросов и /metrics
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')  # Если задан, /metrics требует "Authorization: Bearer <токен>"
+    METRICS_QUERY_WARN_THRESHOLD = 20  # SQL-запросов за запрос, после которых пишется предупреждение (N+1)
+    PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN', '')  # Пусто — профилирование по заголовку выключено
+    PROFILE_HEADER = 'X-Profile'  # Значение заголовка должно совпадать с PROFILE_TOKEN
+    PROFILE_INTERVAL = 0.005  # Секунд между снимками стека
+    PROFILE_FOLDER = None  # По умолчанию instance/profiles
+    JOBS_DATABASE = None  # Очередь фоновых задач; по умолчанию instance/jobs.db
+    JOBS_UPLOAD_FOLDER = None  # Файлы, ожидающие фонового импорта; по умолчанию instance/job-uploads
+    JOBS_EXPORT_FOLDER = None  # Готовые фоновые выгрузки; по умолчанию instance/exports
+    JOB_WORKERS = 2  # Процессов flask jobs-worker по умолчанию
+    JOB_CONCURRENCY = {'import': 1, 'generate': 1, 'export': 2, 'images': 1}  # Одновременно выполняемых задач вида
+    JOB_MAX_ATTEMPTS = {'export': 3, 'images': 3}  # Импорт и генерация не идемпотентны — одна попытка
+    JOB_RETRY_DELAY = 5  # Секунд до первого повтора, дальше вдвое больше
+    JOB_HEARTBEAT_INTERVAL = 30  # Секунд между отметками "жив" выполняющейся задачи
+    JOB_STALE_AFTER = 300  # Секунд без отметки, после которых задача возвращается в очередь
+    JOB_POLL_INTERVAL = 1  # Секунд ожидания воркера при пустой очереди
+    JOB_EVENTS_INTERVAL = 0.5  # Секунд между проверками прогресса в потоке SSE
+    JOB_EVENTS_TIMEOUT = 300  # Секунд, после которых поток SSE закрывается (браузер переподключится)
+    JOB_GENERATE_MAX_COUNT = 1000000  # Персонажей за одну фоновую генерацию
+    SIMULATION_DEFAULT_TRIALS = 10000  # Боёв в /simulate, если trials не указан
+    SIMULATION_MAX_TRIALS = 200000  # Предел trials для /simulate (у flask simulate его нет)
+    SIMULATION_MAX_PARTY = 8  # Бойцов в одном отряде
+    SIMULATION_BATCH_SIZE = 25000  # Боёв в одной векторной пачке
+    SIMULATION_PROCESSES = 0  # Процессов для /simulate; 0 — считать в процессе веб-сервера
+    SEARCH_MAX_PAGE = 50  # Дальше страницы поиска не листаются: релевантность там уже низкая
+    CHANGE_FEED_BUFFER = 10000  # Событий в буфере процесса: на сколько назад можно продолжить по Last-Event-ID
+    CHANGE_FEED_POLL_INTERVAL = 0.25  # Секунд между проверками журнала (события других процессов)
+    CHANGE_FEED_RETENTION = 100000  # Событий, которые остаются в базе после очистки
+    CHANGE_FEED_KEEPALIVE = 15  # Секунд тишины в потоке SSE до пустого сообщения с текущим id
+    CHANGE_FEED_TIMEOUT = 300  # Секунд, после которых поток SSE закрывается (браузер переподключится)
+    CHANGE_FEED_MAX_IDS = 500  # Id персонажей в одной подписке
+    # Потоков SSE (/changes и /jobs/<id>/events) в процессе. Каждый держит поток воркера до своего таймаута,
+    # а у gunicorn (gunicorn.conf.py) потоков в воркере 4: лимит оставляет остальные обычным запросам. Всего
+    # клиентов — воркеры × лимит; сверх него поток отвечает 503 с Retry-After, и страница подключается позже
+    CHANGE_FEED_MAX_STREAMS = int(os.environ.get('CHANGE_FEED_MAX_STREAMS', 2))
+    CHANGE_FEED_RETRY_AFTER = 30  # Секунд до повторного подключения после 503
+    BACKUP_FOLDER = None  # Снимки базы и загрузок; по умолчанию instance/backups
+    BACKUP_PAGES = 4096  # Страниц за шаг online backup (16 МиБ при странице 4 КиБ)
+    BACKUP_SLEEP = 0.005  # Секунд паузы между шагами: запросы успевают к диску
+    BACKUP_KEEP = 7  # Снимков, которые оставляет flask backup --prune
+    CAMPAIGN_FOLDER = None  # Базы кампаний <slug>.db; по умолчанию instance/campaigns
+    CAMPAIGN_MAX_OPEN = 64  # Открытых баз кампаний в процессе (LRU); каждая держит до 1 + READ_POOL соединений
+    CAMPAIGN_READ_POOL_SIZE = 2  # Соединений для чтения у базы кампании
+    CAMPAIGN_CHECK_INTERVAL = 5  # Секунд, через которые открытая кампания сверяется с реестром (архивация)
+    CAMPAIGN_FANOUT_WORKERS = 8  # Потоков для запросов администратора по всем кампаниям
+    CAMPAIGN_FANOUT_LIMIT = 200  # Строк в ответе запроса по всем кампаниям
+    HISTORY_PER_PAGE = 50  # Версий на странице истории персонажа и удалённых на странице восстановления
@@ -0,0 +1,143 @@
+import sqlite3
+import sqlalchemy as sa
+from sqlalchemy import event
+from sqlalchemy.pool import NullPool
+from sqlalchemy.engine import make_url
+from sqlalchemy.sql.util import find_tables
+from flask_sqlalchemy.session import Session
+
+# Соединения с SQLite: основной движок — единственный писатель (пул из одного
+# соединения), движок READER — пул соединений только для чтения. В режиме WAL
+# читатели не ждут писателя, а писатели одного процесса выстраиваются в очередь
+# пула вместо того, чтобы ловить "database is locked" друг от друга.
+READER = 'reader'
+CAMPAIGN = 'campaign'  # session.info: база кампании текущего запроса (campaigns.py)
+SHARED_TABLES = frozenset({'user', 'campaign'})  # Всегда в основной базе, при любой кампании
+
+
+def is_sqlite_file(uri):
+    url = make_url(uri)
+    return url.get_backend_name() == 'sqlite' and url.database not in (None, '', ':memory:')
+
+
+def engine_options(config, pool_size):
+    return {
+        'pool_size': pool_size,
+        'max_overflow': 0,
+        'pool_timeout': config['SQLITE_WRITE_POOL_TIMEOUT'],
+        'connect_args': {
+            'timeout': config['SQLITE_BUSY_TIMEOUT'] / 1000,
+            'check_same_thread': False,
+        },
+    }
+
+
+def configure_engines(config):
+    # Настройки движков для Flask-SQLAlchemy; вызывается до SQLAlchemy(app)
+    uri = config['SQLALCHEMY_DATABASE_URI']
+    if not is_sqlite_file(uri):
+        return
+    config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {}).update(engine_options(config, 1))
+    config.setdefault('SQLALCHEMY_BINDS', {})[READER] = dict(
+        engine_options(config, config['SQLITE_READ_POOL_SIZE']), url=uri
+    )
+
+
+def create_engines(uri, config, read_pool_size, writer=True):
+    # Движки для файла вне конфигурации Flask-SQLAlchemy (базы кампаний): писатель и
+    # пул читателей с теми же настройками и PRAGMA, что у основной базы
+    engines = {}
+    if writer:
+        engines[None] = sa.create_engine(uri, **engine_options(config, 1))
+    if read_pool_size:
+        engines[READER] = sa.create_engine(uri, **engine_options(config, read_pool_size))
+    register_pragmas(engines, config)
+    return engines
+
+
+def create_file_reader(config, path):
+    # Один движок только для чтения на много файлов: новое соединение открывает файл
+    # path() текущего потока. Без пула (соединение живёт до конца запроса), а диалект
+    # и кэш скомпилированных запросов общие для всех файлов
+    connect_args = engine_options(config, 0)['connect_args']
+    engine = sa.create_engine('sqlite://', poolclass=NullPool, creator=lambda: sqlite3.connect(path(), **connect_args))
+    register_pragmas({READER: engine}, config)
+    return engine
+
+
+def sqlite_pragmas(config, read_only=False):
+    pragmas = [
+        f"PRAGMA busy_timeout = {int(config['SQLITE_BUSY_TIMEOUT'])}",
+        "PRAGMA synchronous = NORMAL",  # В WAL теряются только последние транзакции при сбое питания
+        f"PRAGMA cache_size = {int(config['SQLITE_CACHE_SIZE'])}",
+        f"PRAGMA mmap_size = {int(config['SQLITE_MMAP_SIZE'])}",
+        "PRAGMA temp_store = MEMORY",
+    ]
+    if read_only:
+        pragmas.append("PRAGMA query_only = ON")
+    else:
+        # Режим журнала хранится в файле базы; переключает его писатель
+        pragmas.insert(0, "PRAGMA journal_mode = WAL")
+    return pragmas
+
+
+def register_pragmas(engines, config):
+    # PRAGMA действуют на соединение, поэтому выполняются для каждого нового соединения пула
+    for key, engine in engines.items():
+        if engine.dialect.name != 'sqlite':
+            continue
+        pragmas = sqlite_pragmas(config, read_only=key == READER)
+
+        @event.listens_for(engine, 'connect')
+        def set_pragmas(dbapi_connection, connection_record, pragmas=pragmas):
+            cursor = dbapi_connection.cursor()
+            for pragma in pragmas:
+                cursor.execute(pragma)
+            cursor.close()
+
+
+def is_shared_statement(mapper, clause):
+    # Запрос только к таблицам основной базы (пользователи, реестр кампаний)
+    if mapper is not None:
+        return mapper.local_table.name in SHARED_TABLES
+    if clause is None or isinstance(clause, sa.TextClause):
+        return False  # Сырой SQL и session.connection() — таблицы персонажей
+    tables = find_tables(clause, include_crud=True)
+    return bool(tables) and all(table.name in SHARED_TABLES for table in tables)
+
+
+def is_read_statement(clause):
+    if isinstance(clause, sa.Select):
+        return True
+    if isinstance(clause, sa.TextClause):
+        return clause.text.lstrip()[:7].upper() in ('SELECT ', 'SELECT\n', 'EXPLAIN')
+    return False
+
+
+class RoutingSession(Session):
+    # Чтения идут в пул READER, пока транзакция сессии ничего не записала.
+    # Первая запись (flush, DML, DDL, сырой SQL) берёт соединение писателя, и до
+    # конца транзакции все запросы идут туда же — так сессия видит свои изменения.
+    # Если запрос выбрал кампанию (session.info[CAMPAIGN]), всё, кроме таблиц
+    # SHARED_TABLES, идёт в её движки, а не в основную базу.
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is not None:
+            return bind
+        engines = self._db.engines
+        campaign = self.info.get(CAMPAIGN)
+        if campaign is not None and not is_shared_statement(mapper, clause):
+            engines = campaign.engines
+        if READER in engines and not self.info.get('writing') and not self._flushing \
+                and is_read_statement(clause):
+            return engines[READER]
+        self.info['writing'] = True
+        if engines is not self._db.engines:
+            return engines[None]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def register_routing(session):
+    @event.listens_for(session, 'after_transaction_end')
+    def release_writer(session, transaction):
+        if transaction.parent is None:
+            session.info.pop('writing', None)
@@ -0,0 +1,127 @@
+import csv
+import io
+import json
+import time
+import zipfile
+from werkzeug.utils import secure_filename
+from skills import format_skills
+
+# Поля JSON-файла персонажа; тот же формат принимает upload_character
+EXPORT_FIELDS = [
+    "id", "name", "race", "character_class", "level", "experience",
+    "strength", "dexterity", "constitution", "intelligence",
+    "wisdom", "charisma", "max_hp", "current_hp", "skills", "description"
+]
+
+EXPORT_FORMATS = {
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'csv': ('text/csv', 'csv'),
+    'zip': ('application/zip', 'zip'),
+}
+
+
+def export_columns(model):
+    # Колонки для выборки: навыки читаем маской и форматируем строкой при выводе,
+    # если для персонажа не сохранена исходная строка (skills_text)
+    return [
+        model.skills_mask if field == 'skills' else getattr(model, field)
+        for field in EXPORT_FIELDS
+    ] + [model.skills_text]
+
+
+def character_to_dict(row):
+    data = {}
+    for field in EXPORT_FIELDS:
+        if field == 'skills':
+            legacy = getattr(row, 'skills_text', None)
+            data[field] = legacy if legacy is not None else format_skills(row.skills_mask or 0)
+        else:
+            data[field] = getattr(row, field)
+    return data
+
+
+def character_filename(data):
+    name = secure_filename(data['name'].replace(' ', '_')) or 'character'
+    return f"{name}.json"
+
+
+def character_json(data):
+    return json.dumps(data, ensure_ascii=False, indent=4).encode('utf-8')
+
+
+def iter_chunks(query, chunk_size):
+    # Курсор SQLite отдаёт строки по мере выполнения запроса: yield_per читает
+    # их пачками и не держит всю выборку в памяти
+    chunk = []
+    for row in query.yield_per(chunk_size):
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def ndjson_stream(query, chunk_size):
+    for chunk in iter_chunks(query, chunk_size):
+        yield ''.join(
+            json.dumps(character_to_dict(row), ensure_ascii=False) + '\n' for row in chunk
+        ).encode('utf-8')
+
+
+def csv_stream(query, chunk_size):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    for chunk in iter_chunks(query, chunk_size):
+        for row in chunk:
+            data = character_to_dict(row)
+            writer.writerow([data[field] for field in EXPORT_FIELDS])
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    # Заголовок пустой выгрузки
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+class _ZipSink:
+    # Поток только для записи: zipfile пишет сюда, генератор забирает накопленные байты.
+    # Без seek/tell zipfile сам переходит в потоковый режим (data descriptors).
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+
+def zip_stream(query, chunk_size):
+    sink = _ZipSink()
+    date_time = time.localtime()[:6]
+    with zipfile.ZipFile(sink, mode='w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for chunk in iter_chunks(query, chunk_size):
+            for row in chunk:
+                data = character_to_dict(row)
+                # id в имени файла: тёзки не затирают друг друга
+                info = zipfile.ZipInfo(f"{data['id']}_{character_filename(data)}", date_time)
+                info.compress_type = zipfile.ZIP_DEFLATED
+                archive.writestr(info, character_json(data))
+            yield sink.drain()
+    # Центральный каталог пишется при закрытии архива
+    yield sink.drain()
+
+
+STREAMS = {
+    'ndjson': ndjson_stream,
+    'csv': csv_stream,
+    'zip': zip_stream,
+}
@@ -0,0 +1,26 @@
+from flask import current_app, g
+from flask_login import LoginManager
+from werkzeug.local import LocalProxy
+
+# Flask-Login: одно расширение на все приложения, init_app вызывает create_app
+login_manager = LoginManager()
+login_manager.login_view = 'login'
+
+# Кэши и пулы потоков зависят от конфигурации, поэтому create_app создаёт их для
+# каждого приложения в app.extensions. События сессии регистрируются один раз
+# (models.py) и обращаются к объектам текущего приложения через эти прокси.
+# Кэш страниц и лента изменений у каждой кампании свои (campaigns.py): прокси
+# отдают объекты кампании, которую выбрал текущий запрос.
+def campaign_extension(name):
+    campaign = g.get('campaign')
+    return getattr(campaign, name) if campaign is not None else current_app.extensions[name]
+
+
+character_cache = LocalProxy(lambda: campaign_extension('character_cache'))
+identity_cache = LocalProxy(lambda: current_app.extensions['identity_cache'])
+password_verifier = LocalProxy(lambda: current_app.extensions['password_verifier'])
+image_processor = LocalProxy(lambda: current_app.extensions['image_processor'])
+job_queue = LocalProxy(lambda: current_app.extensions['job_queue'])
+change_feed = LocalProxy(lambda: campaign_extension('change_feed'))
+change_streams = LocalProxy(lambda: current_app.extensions['change_streams'])
+campaigns = LocalProxy(lambda: current_app.extensions['campaigns'])
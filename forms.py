@@ -1,6 +1,7 @@
 from flask_wtf import FlaskForm
 from wtforms import StringField, IntegerField, TextAreaField, SelectField, BooleanField, PasswordField, SubmitField
 from wtforms.validators import DataRequired, Length, NumberRange, Optional
+from wtforms.widgets import HiddenInput
 from flask_wtf.file import FileField, FileAllowed
 
 
@@ -65,6 +66,11 @@ class CharacterForm(FlaskForm):
     submit = SubmitField('Submit')
 
 
+class EditCharacterForm(CharacterForm):
+    # Версия персонажа на момент открытия формы (updates.VersionConflict)
+    version = IntegerField(widget=HiddenInput(), validators=[Optional()])
+
+
 class LoginForm(FlaskForm):
     username = StringField('Username', validators=[DataRequired(), Length(min=2, max=20)])
     password = PasswordField('Password', validators=[DataRequired()])
@@ -0,0 +1,97 @@
+from datetime import datetime, timezone
+import numpy as np
+from sqlalchemy import func, select
+from bulk import BulkInserter
+from skills import SKILLS
+
+RACES = ['Human', 'Elf', 'Dwarf', 'Halfling']
+CLASSES = [
+    'Barbarian', 'Bard', 'Cleric', 'Druid', 'Fighter', 'Monk',
+    'Paladin', 'Ranger', 'Rogue', 'Sorcerer', 'Warlock', 'Wizard'
+]
+SKILLS_PER_CHARACTER = 3
+DESCRIPTION = "Generated character with random attributes."
+
+# Персонажи генерируются блоками: у блока свой поток случайных чисел
+# default_rng([seed, номер блока]), поэтому результат зависит только от seed и count
+BLOCK_SIZE = 10000
+
+# С какого объёма выгоднее перестроить индексы, чем вставлять в них по строке
+DEFER_INDEXES_MIN_ROWS = 100000
+
+ABILITIES = ['strength', 'dexterity', 'constitution', 'intelligence', 'wisdom', 'charisma']
+COLUMNS = [
+    'name', 'race', 'character_class', 'level', 'experience', *ABILITIES,
+    'max_hp', 'current_hp', 'skills_mask', 'description'
+]
+# Колонки строки для BulkInserter: к случайным добавляются версия и время изменения
+ROW_COLUMNS = COLUMNS + ['version', 'updated_at']
+
+_RACES = np.array(RACES, dtype=object)
+_NAMES = np.array([f'Random {race}' for race in RACES], dtype=object)
+_CLASSES = np.array(CLASSES, dtype=object)
+
+
+def new_seed():
+    # Случайный seed, который можно напечатать и повторить запуск
+    return int(np.random.SeedSequence().entropy % (1 << 63))
+
+
+def generate_block(rng, size):
+    # Все атрибуты блока — одним вызовом генератора на колонку
+    race = rng.integers(0, len(RACES), size)
+    max_hp = rng.integers(10, 101, size)
+    # Несколько случайных навыков (возможны повторы, как раньше) -> битовая маска
+    skill_bits = np.left_shift(1, rng.integers(0, len(SKILLS), (size, SKILLS_PER_CHARACTER)))
+    columns = {
+        'name': _NAMES[race],  # Имя согласовано с расой
+        'race': _RACES[race],
+        'character_class': _CLASSES[rng.integers(0, len(CLASSES), size)],
+        'level': rng.integers(1, 21, size),
+        'experience': rng.integers(0, 10001, size),
+    }
+    abilities = rng.integers(8, 19, (len(ABILITIES), size))
+    for ability, values in zip(ABILITIES, abilities):
+        columns[ability] = values
+    columns['max_hp'] = max_hp
+    columns['current_hp'] = rng.integers(1, max_hp + 1)
+    columns['skills_mask'] = np.bitwise_or.reduce(skill_bits, axis=1)
+    columns['description'] = np.full(size, DESCRIPTION, dtype=object)
+    return columns
+
+
+def iter_blocks(count, seed, block_size=BLOCK_SIZE):
+    for index, start in enumerate(range(0, count, block_size)):
+        rng = np.random.default_rng([seed, index])
+        yield generate_block(rng, min(block_size, count - start))
+
+
+def iter_rows(count, seed, block_size=BLOCK_SIZE):
+    # Кортежи в порядке ROW_COLUMNS; tolist() переводит numpy-типы в обычные int/str.
+    # updated_at — в формате, в котором SQLAlchemy хранит DateTime в SQLite.
+    updated_at = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S.%f')
+    for columns in iter_blocks(count, seed, block_size):
+        values = [columns[column].tolist() for column in COLUMNS]
+        size = len(values[0])
+        values += [[1] * size, [updated_at] * size]
+        yield list(zip(*values))
+
+
+def generate_characters(session, table, count, seed, batch_size=1000, commit_rows=50000, progress=None):
+    # Крупная загрузка (не меньше уже имеющихся строк) идёт одной транзакцией
+    # с перестройкой индексов в конце
+    existing = session.execute(select(func.count()).select_from(table)).scalar()
+    defer_indexes = count >= max(existing, DEFER_INDEXES_MIN_ROWS)
+    if defer_indexes:
+        commit_rows = count
+    inserter = BulkInserter(
+        session, table, batch_size=batch_size, commit_rows=commit_rows,
+        defer_indexes=defer_indexes, columns=ROW_COLUMNS
+    )
+    done = 0
+    for rows in iter_rows(count, seed):
+        inserter.add_rows(rows)
+        done += len(rows)
+        if progress is not None:
+            progress(done, count)  # Фоновая задача показывает, сколько блоков уже вставлено
+    return inserter.finish()
@@ -0,0 +1,34 @@
+import multiprocessing
+import os
+
+# Настройки gunicorn: gunicorn -c gunicorn.conf.py wsgi:application
+# Воркеров несколько — кэш страниц общий (config.py, CACHE_BACKEND), если не задан явно
+os.environ.setdefault('CACHE_BACKEND', 'sqlite')
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+# Потоки воркера делят пул чтения (SQLITE_READ_POOL_SIZE) и одно соединение писателя
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+timeout = 30
+keepalive = 5
+max_requests = 10000
+max_requests_jitter = 1000
+
+
+def on_starting(server):
+    # Миграции выполняются один раз в мастер-процессе, а не в каждом воркере
+    from app import create_app
+    from models import db, init_db
+    with create_app().app_context():
+        init_db()
+        for engine in db.engines.values():
+            engine.dispose()
+
+
+def post_fork(server, worker):
+    # Соединения SQLite нельзя переносить через fork: воркер открывает свои
+    from wsgi import application
+    from models import db
+    with application.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
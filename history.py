@@ -0,0 +1,329 @@
+import json
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+from sqlalchemy import bindparam, event, inspect, text
+from sqlalchemy.orm import object_session
+from skills import format_skills
+
+# История правок персонажей: журнал только на добавление, из которого собирается
+# любая прошлая версия — посмотреть персонажа на момент времени, сравнить версии,
+# откатить правку или вернуть удалённого без восстановления всей базы из снимка.
+#
+#  - Строка (character_id, version) хранит только поля, изменившиеся в этой версии
+#    (JSON-объект), а каждая SNAPSHOT_INTERVAL-я версия — снимок всех полей
+#    (JSON-массив в порядке HISTORY_FIELDS). Версия собирается из ближайшего
+#    снимка и не больше SNAPSHOT_INTERVAL - 1 изменений после него.
+#  - У персонажа без правок истории нет: перед первой записью сохраняется снимок
+#    версии до изменения (op 'base', время — её updated_at). Загрузка миллионов
+#    сгенерированных персонажей не удваивает базу.
+#  - Строки пишутся в транзакции изменения: правки через ORM — одним executemany
+#    в конце flush, пакетное изменение — INSERT ... SELECT (updates.bulk_update).
+#  - Удаление — версия с op 'delete' и полным снимком, по ней персонажа можно вернуть
+#    (updates.restore_character). Id удалённых не переиспользуются (next_character_id),
+#    иначе история нового персонажа смешалась бы со старой.
+
+HISTORY_FIELDS = [
+    'name', 'race', 'character_class', 'level', 'experience', 'strength', 'dexterity', 'constitution',
+    'intelligence', 'wisdom', 'charisma', 'max_hp', 'current_hp', 'skills_mask', 'description', 'image_path'
+]  # Порядок полей снимка; новые поля — только в конец
+SNAPSHOT_INTERVAL = 32
+HISTORY_OPS = ['base', 'update', 'bulk_update', 'revert', 'delete', 'restore']
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS character_history ("
+    "character_id INTEGER NOT NULL, version INTEGER NOT NULL, created_at REAL NOT NULL, "
+    "op VARCHAR(12) NOT NULL, snapshot INTEGER NOT NULL, data TEXT NOT NULL, "
+    "PRIMARY KEY (character_id, version)) WITHOUT ROWID",
+    # Недавно удалённые для страницы восстановления
+    "CREATE INDEX IF NOT EXISTS ix_character_history_deleted ON character_history (created_at) WHERE op = 'delete'",
+]
+
+PENDING = 'character_history_pending'  # session.info: строки, которые запишутся в конце flush
+NEXT_ID = 'character_history_next_id'  # session.info: следующий свободный id на время flush
+OPS = 'character_history_ops'  # session.info: {id: op} для правок, которые не 'update' (откат)
+
+INSERT_SQL = (
+    "INSERT INTO character_history (character_id, version, created_at, op, snapshot, data) VALUES (?, ?, ?, ?, ?, ?)"
+)
+SNAPSHOT_SQL = 'json_array(' + ', '.join(HISTORY_FIELDS) + ')'
+EPOCH_SQL = "COALESCE((julianday(updated_at) - 2440587.5) * 86400.0, 0)"  # updated_at (UTC) -> секунды Unix
+
+# Снимок текущей версии строк where, если его ещё нет: выполняется до изменения
+BASELINE_SQL = (
+    "INSERT OR IGNORE INTO character_history (character_id, version, created_at, op, snapshot, data) "
+    f"SELECT id, version, {EPOCH_SQL}, 'base', 1, {SNAPSHOT_SQL} FROM character WHERE {{where}}"
+)
+
+# Версия персонажа: state — {поле: значение}, changes — {поле: (было, стало)}
+# относительно предыдущей версии (None, если предыдущей в истории нет)
+CharacterVersion = namedtuple('CharacterVersion', ['version', 'created_at', 'op', 'state', 'changes'])
+
+
+class HistoryError(ValueError):
+    pass
+
+
+def create_tables(connection):
+    for statement in SCHEMA:
+        connection.exec_driver_sql(statement)
+
+
+def encode(data):
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+
+def decode_state(data):
+    values = json.loads(data)
+    return {field: values[index] if index < len(values) else None for index, field in enumerate(HISTORY_FIELDS)}
+
+
+def target_state(target):
+    return {field: getattr(target, field) for field in HISTORY_FIELDS}
+
+
+def history_row(character_id, version, op, changes, state):
+    # Каждая SNAPSHOT_INTERVAL-я версия и удаление — снимок, остальные — изменения
+    if op == 'delete' or version % SNAPSHOT_INTERVAL == 0:
+        data, snapshot = [state[field] for field in HISTORY_FIELDS], 1
+    else:
+        data, snapshot = changes, 0
+    return character_id, version, time.time(), op, snapshot, encode(data)
+
+
+def write_baselines(connection, character_ids, chunk_size=500):
+    for start in range(0, len(character_ids), chunk_size):
+        connection.execute(
+            text(BASELINE_SQL.format(where='id IN :ids')).bindparams(bindparam('ids', expanding=True)),
+            {'ids': character_ids[start:start + chunk_size]}
+        )
+
+
+def write_rows(connection, rows):
+    if rows:
+        connection.exec_driver_sql(INSERT_SQL, rows)
+
+
+def record_baselines(connection, where):
+    # Пакетное изменение: до UPDATE — снимки строк where без истории
+    connection.execute(text(BASELINE_SQL.format(where=where)))
+
+
+def record_selected(connection, where, fields, op='bulk_update'):
+    # После UPDATE: версия строк where с новыми значениями fields
+    fields = [field for field in HISTORY_FIELDS if field in fields]
+    changes = 'json_object(' + ', '.join(f"'{field}', {field}" for field in fields) + ')'
+    connection.execute(text(
+        "INSERT INTO character_history (character_id, version, created_at, op, snapshot, data) "
+        f"SELECT id, version, :now, :op, version % {SNAPSHOT_INTERVAL} = 0, "
+        f"CASE WHEN version % {SNAPSHOT_INTERVAL} = 0 THEN {SNAPSHOT_SQL} ELSE {changes} END "
+        f"FROM character WHERE {where}"
+    ), {'now': time.time(), 'op': op})
+
+
+def next_character_id(connection):
+    # Id для нового персонажа, если SQLite выдал бы id удалённого (у которого есть история), иначе None
+    return connection.execute(text(
+        "SELECT MAX(character_id) + 1 FROM character_history "
+        "WHERE character_id >= (SELECT COALESCE(MAX(id), 0) FROM character)"
+    )).scalar()
+
+
+def register_history(session, model):
+    def pending(target):
+        return object_session(target).info.setdefault(PENDING, [])
+
+    @event.listens_for(session, 'before_flush')
+    def record_baseline(session, flush_context, instances):
+        # Снимок версии до изменения читается из базы: у объекта могут быть не загружены старые значения
+        character_ids = [
+            instance.id for instance in list(session.dirty) + list(session.deleted)
+            if isinstance(instance, model) and instance.id is not None
+            and (instance in session.deleted or session.is_modified(instance))
+        ]
+        if character_ids:
+            write_baselines(session.connection(), character_ids)
+
+    @event.listens_for(model, 'before_insert')
+    def skip_deleted_ids(mapper, connection, target):
+        if target.id is not None:
+            return
+        info = object_session(target).info
+        if NEXT_ID not in info:
+            info[NEXT_ID] = next_character_id(connection)
+        if info[NEXT_ID] is not None:
+            target.id = info[NEXT_ID]
+            info[NEXT_ID] += 1
+
+    @event.listens_for(model, 'after_update')
+    def record_update(mapper, connection, target):
+        state = inspect(target)
+        changes = {}
+        for field in HISTORY_FIELDS:
+            history = state.attrs[field].history
+            if history.added and history.deleted != history.added:
+                changes[field] = getattr(target, field)
+        if not changes:
+            return  # Поля не менялись (присвоено то же значение): UPDATE не было, версия прежняя
+        op = object_session(target).info.get(OPS, {}).pop(target.id, 'update')
+        pending(target).append(history_row(target.id, target.version, op, changes, target_state(target)))
+
+    @event.listens_for(model, 'after_delete')
+    def record_delete(mapper, connection, target):
+        pending(target).append(history_row(target.id, target.version + 1, 'delete', {}, target_state(target)))
+
+    @event.listens_for(session, 'after_flush')
+    def write_pending(session, flush_context):
+        session.info.pop(NEXT_ID, None)
+        rows = session.info.pop(PENDING, None)
+        if rows:
+            write_rows(session.connection(), rows)
+
+    @event.listens_for(session, 'after_rollback')
+    def discard(session):
+        for key in (PENDING, NEXT_ID, OPS):
+            session.info.pop(key, None)
+
+
+def history_rows(session, character_id, low, high):
+    # Строки версий low..high и всех версий от ближайшего снимка не позже low
+    return session.execute(text(
+        "SELECT version, created_at, op, snapshot, data FROM character_history "
+        "WHERE character_id = :id AND version <= :high AND version >= COALESCE(("
+        "SELECT version FROM character_history WHERE character_id = :id AND version <= :low AND snapshot = 1 "
+        "ORDER BY version DESC LIMIT 1), :low) ORDER BY version"
+    ), {'id': character_id, 'low': low, 'high': high}).all()
+
+
+def replay(rows):
+    # Строки истории по возрастанию версий -> CharacterVersion; до первого снимка собрать нечего
+    state = None
+    previous_version = None
+    for row in rows:
+        if row.snapshot:
+            values = decode_state(row.data)
+            known = state is not None and previous_version == row.version - 1
+            changes = {field: (state[field], value) for field, value in values.items()
+                       if state[field] != value} if known else None
+            state = values
+        elif state is None:
+            continue
+        else:
+            values = json.loads(row.data)
+            changes = {field: (state.get(field), value) for field, value in values.items()}
+            state = dict(state, **values)
+        previous_version = row.version
+        yield CharacterVersion(row.version, row.created_at, row.op, state, changes)
+
+
+def current_row(session, character_id):
+    return session.execute(text(
+        f"SELECT {', '.join(HISTORY_FIELDS)}, version, {EPOCH_SQL} AS updated FROM character WHERE id = :id"
+    ), {'id': character_id}).first()
+
+
+def latest_version(session, character_id):
+    # (version, op) последней строки истории; None — истории нет
+    return session.execute(text(
+        "SELECT version, op FROM character_history WHERE character_id = :id ORDER BY version DESC LIMIT 1"
+    ), {'id': character_id}).first()
+
+
+def character_version(session, character_id, version):
+    # Персонаж в версии version; None — такой версии нет ни в базе, ни в истории
+    current = current_row(session, character_id)
+    if current is not None and current.version == version:
+        state = {field: getattr(current, field) for field in HISTORY_FIELDS}
+        return CharacterVersion(version, current.updated, None, state, None)
+    for entry in replay(history_rows(session, character_id, version, version)):
+        if entry.version == version:
+            return entry
+    return None
+
+
+def version_at(session, character_id, timestamp):
+    # Версия, действовавшая в момент timestamp (секунды Unix); None — персонажа тогда
+    # ещё не было (или он старше своей истории)
+    version = session.execute(text(
+        "SELECT version FROM character_history WHERE character_id = :id AND created_at <= :at "
+        "ORDER BY version DESC LIMIT 1"
+    ), {'id': character_id, 'at': timestamp}).scalar()
+    if version is not None or latest_version(session, character_id) is not None:
+        return version
+    current = current_row(session, character_id)
+    return current.version if current is not None and current.updated <= timestamp else None
+
+
+def character_versions(session, character_id, limit, before=None):
+    # Страница версий от новых к старым: до limit версий меньше before (по умолчанию — с последней)
+    latest = latest_version(session, character_id)
+    if latest is None:
+        current = current_row(session, character_id)
+        if current is None or (before is not None and current.version >= before):
+            return []
+        state = {field: getattr(current, field) for field in HISTORY_FIELDS}
+        return [CharacterVersion(current.version, current.updated, None, state, None)]
+    high = latest.version if before is None else min(before - 1, latest.version)
+    low = max(1, high - limit + 1)
+    # С версии low - 1: у первой версии страницы видны изменения
+    entries = [entry for entry in replay(history_rows(session, character_id, max(1, low - 1), high))
+               if entry.version >= low]
+    return entries[::-1]
+
+
+def diff_states(old, new):
+    return {field: (old[field], new[field]) for field in HISTORY_FIELDS if old[field] != new[field]}
+
+
+def deleted_characters(session, limit):
+    # Удалённые и не восстановленные, сначала недавние: (character_id, version, created_at, name)
+    return session.execute(text(
+        "SELECT deleted.character_id, deleted.version, deleted.created_at, json_extract(deleted.data, '$[0]') AS name "
+        "FROM character_history AS deleted WHERE deleted.op = 'delete' AND NOT EXISTS ("
+        "SELECT 1 FROM character_history AS later "
+        "WHERE later.character_id = deleted.character_id AND later.version > deleted.version) "
+        "ORDER BY deleted.created_at DESC LIMIT :limit"
+    ), {'limit': limit}).all()
+
+
+def public_state(state):
+    # Поля состояния для JSON и шаблонов: навыки строкой, как у персонажа
+    values = {field: value for field, value in state.items() if field != 'skills_mask'}
+    values['skills'] = format_skills(state['skills_mask'] or 0)
+    return values
+
+
+def public_changes(changes):
+    values = {}
+    for field, (old, new) in changes.items():
+        if field == 'skills_mask':
+            field, old, new = 'skills', format_skills(old or 0), format_skills(new or 0)
+        values[field] = [old, new]
+    return values
+
+
+def parse_time(value):
+    # '2026-10-01T18:30', '2026-10-01T18:30:00+03:00' (без зоны — UTC) или секунды Unix -> секунды Unix
+    value = (value or '').strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        moment = datetime.fromisoformat(value)
+    except ValueError:
+        raise HistoryError('Time must be ISO 8601 (2026-10-01T18:30, UTC unless an offset is given).')
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.timestamp()
+
+
+def format_time(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat(timespec='seconds')
+
+
+def history_size(connection):
+    # (строк, байт данных) истории — для бенчмарка
+    return connection.execute(text(
+        "SELECT COUNT(*), COALESCE(SUM(LENGTH(CAST(data AS BLOB))), 0) FROM character_history"
+    )).one()
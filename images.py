@@ -0,0 +1,162 @@
+import glob
+import hashlib
+import importlib.util
+import logging
+import os
+import re
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Уменьшенные копии: миниатюра для списка и картинка для карточки персонажа
+VARIANT_WIDTHS = {'thumb': 64, 'detail': 300}
+VARIANT_FORMATS = {'webp': ('WEBP', 'webp'), 'jpeg': ('JPEG', 'jpg')}
+
+# Имя файла — sha256 содержимого, поэтому его содержимое никогда не меняется
+CONTENT_ADDRESSED = re.compile(r'^uploads/[0-9a-f]{64}(-\d+)?\.[a-z0-9]+$')
+
+READ_CHUNK_SIZE = 64 * 1024
+
+# Загрузки, для которых готовятся уменьшенные копии
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+
+# Pillow — необязательная зависимость: без него копий не будет, и srcset не выводится
+VARIANTS_ENABLED = importlib.util.find_spec('PIL') is not None
+
+
+def store_upload(file, upload_folder):
+    # Пишем во временный файл, попутно считая хэш, затем переименовываем в <sha256>.<ext>.
+    # Одинаковые загрузки попадают в один файл, разные с одним именем не затирают друг друга.
+    extension = file.filename.rsplit('.', 1)[1].lower()
+    os.makedirs(upload_folder, exist_ok=True)
+    digest = hashlib.sha256()
+    handle, temp_path = tempfile.mkstemp(dir=upload_folder, suffix='.part')
+    try:
+        with os.fdopen(handle, 'wb') as output:
+            while True:
+                chunk = file.stream.read(READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                output.write(chunk)
+        filename = f'{digest.hexdigest()}.{extension}'
+        final_path = os.path.join(upload_folder, filename)
+        if os.path.exists(final_path):
+            os.remove(temp_path)
+        else:
+            os.replace(temp_path, final_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return f'uploads/{filename}', final_path
+
+
+def variant_name(image_path, width, image_format):
+    base = image_path.rsplit('.', 1)[0]
+    return f'{base}-{width}.{VARIANT_FORMATS[image_format][1]}'
+
+
+def upload_name(image_path):
+    # Character.image_path хранится как "uploads/<файл>"; сам файл лежит в UPLOAD_FOLDER
+    return image_path[len('uploads/'):] if image_path.startswith('uploads/') else image_path
+
+
+def upload_file(upload_folder, image_path):
+    return os.path.join(upload_folder, upload_name(image_path))
+
+
+def variants_ready(upload_folder, image_path):
+    if not image_path:
+        return False
+    return all(
+        os.path.exists(upload_file(upload_folder, variant_name(image_path, width, image_format)))
+        for width in VARIANT_WIDTHS.values() for image_format in VARIANT_FORMATS
+    )
+
+
+def variant_original(upload_folder, filename):
+    # Имя оригинала для копии "<имя>-<ширина>.<формат>", которой ещё нет; None — это не копия
+    match = re.fullmatch(r'(.+)-(\d+)\.([a-z0-9]+)', filename)
+    if match is None or int(match.group(2)) not in VARIANT_WIDTHS.values():
+        return None
+    for path in sorted(glob.glob(os.path.join(upload_folder, glob.escape(match.group(1)) + '.*'))):
+        name = os.path.basename(path)
+        if name.rsplit('.', 1)[-1].lower() in IMAGE_EXTENSIONS:
+            return name
+    return None
+
+
+def pending_images(upload_folder):
+    # Загруженные картинки без уменьшенных копий (у самих копий в имени есть "-")
+    pending = []
+    if not os.path.isdir(upload_folder):
+        return pending
+    for filename in sorted(os.listdir(upload_folder)):
+        image_path = f'uploads/{filename}'
+        if filename.rsplit('.', 1)[-1].lower() in IMAGE_EXTENSIONS and '-' not in filename \
+                and not variants_ready(upload_folder, image_path):
+            pending.append(image_path)
+    return pending
+
+
+def image_srcsets(image_path, url_for):
+    # srcset строится по одному имени, без обращения к диску: имена копий выводятся из
+    # имени загрузки, а копию, которую ещё готовит ImageProcessor, маршрут uploaded_image
+    # подменяет переадресацией на оригинал
+    srcsets = {}
+    if not image_path or not VARIANTS_ENABLED or image_path.rsplit('.', 1)[-1].lower() not in IMAGE_EXTENSIONS:
+        return srcsets
+    for image_format in VARIANT_FORMATS:
+        srcsets[image_format] = ', '.join(
+            f"{url_for('uploaded_image', filename=upload_name(variant_name(image_path, width, image_format)))} {width}w"
+            for width in sorted(VARIANT_WIDTHS.values())
+        )
+    return srcsets
+
+
+def make_variants(upload_folder, image_path):
+    try:
+        from PIL import Image
+    except ImportError:
+        # Pillow — необязательная зависимость: без него отдаём только оригинал
+        logger.warning('Pillow is not installed, skipping image variants for %s', image_path)
+        return False
+
+    source_path = upload_file(upload_folder, image_path)
+    with Image.open(source_path) as source:
+        source.load()
+        for width in VARIANT_WIDTHS.values():
+            resized = source.copy()
+            # Ограничиваем только ширину, пропорции сохраняются
+            resized.thumbnail((width, resized.height))
+            for image_format, (pil_format, _) in VARIANT_FORMATS.items():
+                target_path = upload_file(upload_folder, variant_name(image_path, width, image_format))
+                if os.path.exists(target_path):
+                    continue
+                image = resized
+                if pil_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+                    image = image.convert('RGB')
+                handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(target_path), suffix='.part')
+                with os.fdopen(handle, 'wb') as output:
+                    image.save(output, pil_format, quality=82, optimize=True)
+                os.replace(temp_path, target_path)
+    return True
+
+
+class ImageProcessor:
+    # Фоновый пул: запрос на загрузку возвращается сразу, копии готовятся после
+    def __init__(self, upload_folder, max_workers=2):
+        self.upload_folder = upload_folder
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='images')
+
+    def submit(self, image_path):
+        future = self.executor.submit(make_variants, self.upload_folder, image_path)
+        future.add_done_callback(lambda done: self._log_failure(done, image_path))
+        return future
+
+    def _log_failure(self, future, image_path):
+        error = future.exception()
+        if error is not None:
+            logger.error('Image processing failed for %s: %s', image_path, error)
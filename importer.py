@@ -0,0 +1,203 @@
+import codecs
+import json
+from bulk import BulkInserter
+from skills import LEGACY_SKILLS, legacy_skills, skills_to_mask
+
+# Обязательные поля JSON-файла персонажа (формат download_character)
+REQUIRED_KEYS = {
+    "id", "name", "race", "character_class", "level", "experience",
+    "strength", "dexterity", "constitution", "intelligence",
+    "wisdom", "charisma", "max_hp", "current_hp", "skills", "description"
+}
+STRING_FIELDS = ('name', 'race', 'character_class')
+INTEGER_FIELDS = (
+    'level', 'experience', 'strength', 'dexterity', 'constitution',
+    'intelligence', 'wisdom', 'charisma', 'max_hp', 'current_hp'
+)
+
+READ_CHUNK_SIZE = 64 * 1024
+_WHITESPACE = ' \t\r\n'
+
+
+class ImportReport:
+    def __init__(self, max_errors):
+        self.imported = 0
+        self.failed = 0
+        self.errors = []
+        self.max_errors = max_errors
+
+    def add_error(self, record, message):
+        self.failed += 1
+        # Храним только первые max_errors ошибок, чтобы отчёт не рос вместе с файлом
+        if len(self.errors) < self.max_errors:
+            self.errors.append({'record': record, 'error': message})
+
+    def to_dict(self):
+        return {
+            'imported': self.imported,
+            'failed': self.failed,
+            'errors': self.errors,
+            'errors_truncated': self.failed > len(self.errors),
+        }
+
+
+class _Reader:
+    # Буфер текста поверх бинарного потока: читаем кусками, декодируем инкрементально
+    def __init__(self, stream, chunk_size):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder('utf-8-sig')()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        if self.eof:
+            return False
+        chunk = self.stream.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            self.buffer = self.buffer[self.pos:] + self.decoder.decode(b'', final=True)
+        else:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            # Отбрасываем уже разобранную часть, в памяти остаётся только хвост
+            self.buffer = self.buffer[self.pos:] + self.decoder.decode(chunk)
+        self.pos = 0
+        return True
+
+    def peek(self):
+        # Первый непробельный символ или '' в конце потока
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ''
+
+    def decode_value(self, decoder):
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError as error:
+                # Если после места ошибки нет перевода строки, запись могла быть
+                # просто обрезана границей куска — дочитываем. Иначе ошибка настоящая.
+                if '\n' not in self.buffer[error.pos:] and self.fill():
+                    continue
+                raise
+            # Число в конце буфера могло быть обрезано — дочитываем и пробуем снова
+            if end == len(self.buffer) and not isinstance(value, (dict, list)) and self.fill():
+                continue
+            self.pos = end
+            return value
+
+    def skip_line(self):
+        # После битой строки NDJSON продолжаем со следующей
+        while True:
+            newline = self.buffer.find('\n', self.pos)
+            if newline != -1:
+                self.pos = newline + 1
+                return
+            self.pos = len(self.buffer)
+            if not self.fill():
+                return
+
+
+def iter_json_records(stream, chunk_size=READ_CHUNK_SIZE):
+    # Потоковый разбор JSON-массива, NDJSON или одиночного объекта.
+    # Выдаёт (номер записи, значение или JSONDecodeError).
+    reader = _Reader(stream, chunk_size)
+    decoder = json.JSONDecoder()
+
+    if reader.peek() == '[':
+        reader.pos += 1
+        number = 0
+        if reader.peek() == ']':
+            return
+        while True:
+            number += 1
+            reader.peek()
+            try:
+                yield number, reader.decode_value(decoder)
+            except json.JSONDecodeError as error:
+                # Внутри массива синхронизироваться после ошибки нельзя
+                yield number, error
+                return
+            separator = reader.peek()
+            if separator == ',':
+                reader.pos += 1
+            elif separator == ']':
+                return
+            else:
+                yield number + 1, json.JSONDecodeError("Expected ',' or ']'", reader.buffer, reader.pos)
+                return
+
+    number = 0
+    while reader.peek():
+        number += 1
+        try:
+            yield number, reader.decode_value(decoder)
+        except json.JSONDecodeError as error:
+            yield number, error
+            reader.skip_line()
+
+
+def validate_record(data):
+    # Та же проверка, что и для одиночной загрузки, плюс типы полей.
+    # Возвращает словарь значений колонок Character или бросает ValueError.
+    if not isinstance(data, dict):
+        raise ValueError('Record must be a JSON object.')
+    missing = REQUIRED_KEYS - data.keys()
+    if missing:
+        raise ValueError('Missing keys: ' + ', '.join(sorted(missing)))
+
+    mapping = {}
+    for key in STRING_FIELDS:
+        value = data[key]
+        if not isinstance(value, str) or not value.strip():
+            raise ValueError(f"'{key}' must be a non-empty string.")
+        mapping[key] = value
+    for key in INTEGER_FIELDS:
+        value = data[key]
+        # Быстрый путь для обычных чисел; bool — подкласс int, его отсекаем
+        if type(value) is not int:
+            if isinstance(value, bool):
+                raise ValueError(f"'{key}' must be an integer.")
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                raise ValueError(f"'{key}' must be an integer.")
+        mapping[key] = value
+    description = data['description']
+    if description is not None and not isinstance(description, str):
+        raise ValueError("'description' must be a string.")
+    mapping['description'] = description
+    skills = data['skills']
+    if isinstance(skills, list):
+        # Список названий записывается так же, как строка: "Stealth, Perception"
+        skills = ', '.join(label.strip() for label in skills if isinstance(label, str) and label.strip())
+    elif not isinstance(skills, str):
+        raise ValueError("'skills' must be a string.")
+    mapping['skills_mask'] = skills_to_mask(skills)
+    # Строку, которую маска не восстанавливает, выгрузка отдаст как есть (skills.py)
+    if legacy_skills(skills) is not None:
+        mapping[LEGACY_SKILLS] = skills
+    return mapping
+
+
+def import_characters(stream, session, table, batch_size=1000, commit_rows=50000, max_errors=1000):
+    report = ImportReport(max_errors)
+    inserter = BulkInserter(session, table, batch_size=batch_size, commit_rows=commit_rows)
+
+    for number, value in iter_json_records(stream):
+        if isinstance(value, json.JSONDecodeError):
+            report.add_error(number, f'Invalid JSON: {value.msg}')
+            continue
+        try:
+            inserter.add(validate_record(value))
+        except ValueError as error:
+            report.add_error(number, str(error))
+
+    report.imported = inserter.finish()
+    return report
@@ -0,0 +1,370 @@
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import sqlite3
+import threading
+import time
+from werkzeug.datastructures import MultiDict
+
+logger = logging.getLogger(__name__)
+
+# Очередь фоновых задач в отдельном файле SQLite: без внешнего брокера, и частые
+# обновления прогресса не занимают блокировку записи основной базы.
+# Веб-процесс ставит задачу (enqueue) и сразу отвечает её id; процессы
+# `flask jobs-worker` забирают задачи (claim), выполняют обработчик из HANDLERS
+# в контексте приложения и пишут прогресс, результат или ошибку.
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+FINISHED = (DONE, FAILED)
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS job (
+        id INTEGER PRIMARY KEY,
+        kind TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'queued',
+        progress INTEGER NOT NULL DEFAULT 0,
+        total INTEGER,
+        message TEXT,
+        result TEXT,
+        error TEXT,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        max_attempts INTEGER NOT NULL DEFAULT 1,
+        run_after REAL NOT NULL,
+        created_at REAL NOT NULL,
+        started_at REAL,
+        finished_at REAL,
+        heartbeat_at REAL,
+        worker TEXT,
+        user_id INTEGER
+    )""",
+    "CREATE INDEX IF NOT EXISTS ix_job_status_run_after ON job (status, run_after, id)",
+    "CREATE INDEX IF NOT EXISTS ix_job_created_at ON job (created_at)",
+]
+
+# Обработчики задач по виду: handler(job) -> результат (JSON-совместимый)
+HANDLERS = {}
+
+
+def job_handler(kind):
+    def register(function):
+        HANDLERS[kind] = function
+        return function
+    return register
+
+
+def job_to_dict(row):
+    data = dict(row)
+    data['payload'] = json.loads(data['payload'])
+    data['result'] = json.loads(data['result']) if data['result'] else None
+    return data
+
+
+class JobQueue:
+    def __init__(self, path, concurrency=None, max_attempts=None, retry_delay=5, stale_after=300):
+        self.path = path
+        self.concurrency = concurrency or {}  # Вид -> сколько задач может выполняться одновременно
+        self.max_attempts = max_attempts or {}  # Вид -> число попыток (повторять можно только идемпотентные)
+        self.retry_delay = retry_delay
+        self.stale_after = stale_after
+        self.local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = self._connection()
+        for statement in SCHEMA:
+            connection.execute(statement)
+
+    def _connection(self):
+        # Соединение на поток, как у SQLiteCache; транзакции открываем явно
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    def enqueue(self, kind, payload, user_id=None):
+        if kind not in HANDLERS:
+            raise ValueError(f'Unknown job kind: {kind}')
+        now = time.time()
+        cursor = self._connection().execute(
+            "INSERT INTO job (kind, payload, max_attempts, run_after, created_at, user_id) VALUES (?, ?, ?, ?, ?, ?)",
+            (kind, json.dumps(payload), self.max_attempts.get(kind, 1), now, now, user_id)
+        )
+        return cursor.lastrowid
+
+    def get(self, job_id):
+        row = self._connection().execute("SELECT * FROM job WHERE id = ?", (job_id,)).fetchone()
+        return None if row is None else job_to_dict(row)
+
+    def recent(self, limit=50):
+        rows = self._connection().execute("SELECT * FROM job ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+        return [job_to_dict(row) for row in rows]
+
+    def claim(self, worker):
+        # BEGIN IMMEDIATE: подсчёт выполняющихся задач и захват следующей — одна
+        # транзакция записи, поэтому лимиты по видам не превышаются при нескольких воркерах
+        connection = self._connection()
+        now = time.time()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            # Задачи воркера, который перестал обновлять heartbeat (упал или убит), возвращаются в очередь
+            connection.execute(
+                "UPDATE job SET status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'queued' END, "
+                "error = 'Worker stopped responding.', worker = NULL, "
+                "finished_at = CASE WHEN attempts >= max_attempts THEN ? END "
+                "WHERE status = 'running' AND heartbeat_at < ?",
+                (now, now - self.stale_after)
+            )
+            running = dict(connection.execute(
+                "SELECT kind, COUNT(*) FROM job WHERE status = 'running' GROUP BY kind"
+            ).fetchall())
+            busy = [kind for kind, limit in self.concurrency.items() if running.get(kind, 0) >= limit]
+            row = connection.execute(
+                "UPDATE job SET status = 'running', worker = ?, attempts = attempts + 1, "
+                "started_at = ?, heartbeat_at = ? "
+                "WHERE id = (SELECT id FROM job WHERE status = 'queued' AND run_after <= ? "
+                f"AND kind NOT IN ({', '.join('?' * len(busy))}) ORDER BY run_after, id LIMIT 1) "
+                "RETURNING *",
+                (worker, now, now, now, *busy)
+            ).fetchone()
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return None if row is None else job_to_dict(row)
+
+    def progress(self, job_id, done, total=None, message=None):
+        self._connection().execute(
+            "UPDATE job SET progress = ?, total = COALESCE(?, total), message = COALESCE(?, message), "
+            "heartbeat_at = ? WHERE id = ?",
+            (done, total, message, time.time(), job_id)
+        )
+
+    def heartbeat(self, job_id):
+        self._connection().execute("UPDATE job SET heartbeat_at = ? WHERE id = ?", (time.time(), job_id))
+
+    def complete(self, job_id, result):
+        self._connection().execute(
+            "UPDATE job SET status = 'done', result = ?, error = NULL, finished_at = ? WHERE id = ?",
+            (json.dumps(result), time.time(), job_id)
+        )
+
+    def fail(self, job, error):
+        # Повтор с экспоненциальной задержкой, пока не исчерпаны попытки
+        now = time.time()
+        if job['attempts'] < job['max_attempts']:
+            delay = self.retry_delay * 2 ** (job['attempts'] - 1)
+            self._connection().execute(
+                "UPDATE job SET status = 'queued', error = ?, worker = NULL, run_after = ? WHERE id = ?",
+                (error, now + delay, job['id'])
+            )
+        else:
+            self._connection().execute(
+                "UPDATE job SET status = 'failed', error = ?, finished_at = ? WHERE id = ?",
+                (error, now, job['id'])
+            )
+
+
+def make_job_queue(config):
+    return JobQueue(
+        config['JOBS_DATABASE'], config['JOB_CONCURRENCY'], config['JOB_MAX_ATTEMPTS'],
+        config['JOB_RETRY_DELAY'], config['JOB_STALE_AFTER']
+    )
+
+
+class Job:
+    # То, что видит обработчик: параметры задачи и отчёт о прогрессе (не чаще interval)
+    def __init__(self, queue, row, interval=0.5):
+        self.queue = queue
+        self.id = row['id']
+        self.payload = row['payload']
+        self.interval = interval
+        self.reported = 0.0
+
+    def progress(self, done, total=None, message=None, force=False):
+        now = time.monotonic()
+        if force or now - self.reported >= self.interval:
+            self.reported = now
+            self.queue.progress(self.id, done, total, message)
+
+
+class Heartbeat(threading.Thread):
+    # Отметка "жив" для задач, которые долго не сообщают прогресс (перестройка индексов и т.п.)
+    def __init__(self, queue, job_id, interval):
+        super().__init__(name=f'job-{job_id}-heartbeat', daemon=True)
+        self.queue = queue
+        self.job_id = job_id
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.queue.heartbeat(self.job_id)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def run_job(app, queue, row):
+    heartbeat = Heartbeat(queue, row['id'], app.config['JOB_HEARTBEAT_INTERVAL'])
+    heartbeat.start()
+    try:
+        with app.app_context():
+            job = Job(queue, row)
+            if job.payload.get('campaign'):
+                # Задача, поставленная из кампании, работает с её базой (campaigns.py)
+                from campaigns import use_campaign
+                database = app.extensions['campaigns'].get(job.payload['campaign'])
+                if database is None:
+                    raise LookupError(f"Campaign {job.payload['campaign']} is archived or missing.")
+                use_campaign(database)
+            result = HANDLERS[row['kind']](job)
+        queue.complete(row['id'], result)
+    except Exception as error:
+        logger.exception('Job %s (%s) failed', row['id'], row['kind'])
+        queue.fail(row, f'{type(error).__name__}: {error}')
+    finally:
+        heartbeat.stop()
+
+
+def worker_loop(app, queue, stop, name):
+    while not stop.is_set():
+        row = queue.claim(name)
+        if row is None:
+            stop.wait(app.config['JOB_POLL_INTERVAL'])
+            continue
+        logger.info('%s: running job %s (%s)', name, row['id'], row['kind'])
+        run_job(app, queue, row)
+
+
+def worker_process(number, stop, settings):
+    # Процесс пула: своё приложение и свои соединения с базами. spawn не копирует приложение
+    # родителя, поэтому его настройки (settings — app.config) передаются явно: create_app()
+    # без них взял бы Config по умолчанию — другую базу, очередь задач и папки
+    from app import create_app
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Останавливает родитель через stop
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(processName)s %(levelname)s %(message)s')
+    app = create_app(type('WorkerConfig', (), settings))
+    worker_loop(app, app.extensions['job_queue'], stop, f'{socket.gethostname()}:{os.getpid()}:{number}')
+
+
+def run_workers(processes, config):
+    # config — app.config приложения, запустившего пул. Текущая задача дописывается
+    # до конца: по SIGTERM/SIGINT процессы больше не берут новых
+    context = multiprocessing.get_context('spawn')
+    stop = context.Event()
+    settings = dict(config)
+    workers = [
+        context.Process(target=worker_process, args=(number, stop, settings), name=f'job-worker-{number}')
+        for number in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+
+    def shutdown(signum, frame):
+        stop.set()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    for worker in workers:
+        worker.join()
+
+
+class ProgressReader:
+    # Обёртка файла, сообщающая число прочитанных байт (для импорта)
+    def __init__(self, stream, callback):
+        self.stream = stream
+        self.callback = callback
+        self.done = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.done += len(data)
+        self.callback(self.done)
+        return data
+
+
+@job_handler('import')
+def import_job(job):
+    from flask import current_app
+    from models import db, Character
+    from importer import import_characters
+    path = job.payload['path']
+    size = os.path.getsize(path)
+    config = current_app.config
+    try:
+        with open(path, 'rb') as source:
+            report = import_characters(
+                ProgressReader(source, lambda done: job.progress(done, size, 'bytes read')),
+                db.session, Character.__table__,
+                batch_size=config['IMPORT_BATCH_SIZE'], commit_rows=config['IMPORT_COMMIT_ROWS'],
+                max_errors=config['IMPORT_MAX_ERRORS']
+            )
+    finally:
+        os.remove(path)
+    job.progress(size, size, f'{report.imported} imported, {report.failed} failed', force=True)
+    return report.to_dict()
+
+
+@job_handler('generate')
+def generate_job(job):
+    from flask import current_app
+    from models import db, Character
+    from generator import generate_characters
+    count = job.payload['count']
+    generated = generate_characters(
+        db.session, Character.__table__, count, job.payload['seed'],
+        batch_size=current_app.config['IMPORT_BATCH_SIZE'], commit_rows=current_app.config['IMPORT_COMMIT_ROWS'],
+        progress=lambda done, total: job.progress(done, total, 'characters generated')
+    )
+    job.progress(generated, count, 'characters generated', force=True)
+    return {'generated': generated, 'seed': job.payload['seed']}
+
+
+@job_handler('export')
+def export_job(job):
+    from flask import current_app
+    from exporters import EXPORT_FORMATS, STREAMS
+    from queries import export_query
+    export_format = job.payload['format']
+    _, extension = EXPORT_FORMATS[export_format]
+    query = export_query(MultiDict(job.payload['args']))
+    total = query.order_by(None).count()
+    chunk_size = current_app.config['EXPORT_CHUNK_SIZE']
+
+    folder = current_app.config['JOBS_EXPORT_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+    filename = f'characters-{job.id}.{extension}'
+    path = os.path.join(folder, filename)
+    with open(path + '.part', 'wb') as output:
+        for chunks, data in enumerate(STREAMS[export_format](query, chunk_size), 1):
+            output.write(data)
+            job.progress(min(total, chunks * chunk_size), total, 'rows exported')
+    os.replace(path + '.part', path)
+    job.progress(total, total, 'rows exported', force=True)
+    return {'file': filename, 'rows': total}
+
+
+@job_handler('images')
+def images_job(job):
+    from flask import current_app
+    from images import make_variants, pending_images
+    pending = pending_images(current_app.config['UPLOAD_FOLDER'])
+    processed = 0
+    for done, image_path in enumerate(pending, 1):
+        if make_variants(current_app.config['UPLOAD_FOLDER'], image_path):
+            processed += 1
+        job.progress(done, len(pending), 'images processed')
+    job.progress(len(pending), len(pending), 'images processed', force=True)
+    return {'processed': processed, 'pending': len(pending)}
@@ -0,0 +1,206 @@
+import bisect
+import hmac
+import logging
+import threading
+import time
+from collections import Counter
+from flask import Response, abort, before_render_template, g, has_app_context, request, template_rendered
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм (секунды и число запросов к базе)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values, extra=''):
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            series = sorted(self.series.items())
+            lines += self.render_series(series)
+        return lines
+
+
+class CounterMetric(Metric):
+    kind = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.series[label_values] = self.series.get(label_values, 0) + amount
+
+    def render_series(self, series):
+        return [f'{self.name}{format_labels(self.labels, values)} {total}' for values, total in series]
+
+
+class Histogram(Metric):
+    # Счётчики по корзинам хранятся без накопления; кумулятивные значения "le"
+    # считаются только при выдаче /metrics
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets, labels=()):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.series.get(label_values)
+            if state is None:
+                state = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def render_series(self, series):
+        lines = []
+        for values, (counts, total) in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                labels = format_labels(self.labels, values, f'le="{bound}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = format_labels(self.labels, values)
+            lines.append(f'{self.name}_sum{labels} {total}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class Metrics:
+    # Метрики одного процесса. У каждого воркера gunicorn свой набор: Prometheus
+    # должен опрашивать воркеры по отдельности или суммировать ряды по instance.
+    def __init__(self):
+        self.request_duration = Histogram(
+            'http_request_duration_seconds', 'Request latency by endpoint.', LATENCY_BUCKETS,
+            ('endpoint', 'method', 'status')
+        )
+        self.request_queries = Histogram(
+            'http_request_db_queries', 'SQL statements executed per request.', QUERY_COUNT_BUCKETS,
+            ('endpoint',)
+        )
+        self.request_db_time = Histogram(
+            'http_request_db_seconds', 'Time spent in SQL statements per request.', LATENCY_BUCKETS,
+            ('endpoint',)
+        )
+        self.template_duration = Histogram(
+            'template_render_seconds', 'Jinja template render time.', LATENCY_BUCKETS, ('template',)
+        )
+        self.query_warnings = CounterMetric(
+            'http_request_query_warnings_total', 'Requests over the per-request query threshold.', ('endpoint',)
+        )
+
+    def render(self):
+        lines = []
+        for metric in (self.request_duration, self.request_queries, self.request_db_time,
+                       self.template_duration, self.query_warnings):
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+
+class RequestStats:
+    # Замеры текущего запроса; хранятся в g
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.statements = Counter()
+        self.templates = []
+
+
+def current_stats():
+    if not has_app_context():
+        return None
+    return g.get('request_stats')
+
+
+def register_query_hooks(engine):
+    # Время каждого SQL-запроса: начало хранится на соединении, потому что
+    # context есть не у всех вызовов cursor.execute
+    @event.listens_for(engine, 'before_cursor_execute')
+    def query_started(connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault('query_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def query_finished(connection, cursor, statement, parameters, context, executemany):
+        started = connection.info['query_started'].pop()
+        stats = current_stats()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_time += time.perf_counter() - started
+            stats.statements[statement] += 1
+
+
+def init_metrics(app, engines):
+    # Подключается в create_app при METRICS_ENABLED; без него приложение не платит ни за что
+    metrics = app.extensions['metrics'] = Metrics()
+    threshold = app.config['METRICS_QUERY_WARN_THRESHOLD']
+    for engine in engines:
+        register_query_hooks(engine)
+
+    @app.before_request
+    def start_request():
+        g.request_stats = RequestStats()
+
+    @app.after_request
+    def finish_request(response):
+        stats = g.pop('request_stats', None)
+        if stats is None:
+            return response
+        # Имя endpoint, а не путь: число рядов не растёт от id в URL
+        endpoint = request.endpoint or 'unmatched'
+        metrics.request_duration.observe(
+            time.perf_counter() - stats.started, endpoint, request.method, response.status_code
+        )
+        metrics.request_queries.observe(stats.queries, endpoint)
+        metrics.request_db_time.observe(stats.db_time, endpoint)
+        if stats.queries > threshold:
+            # Типичный N+1: один и тот же запрос в цикле по строкам
+            statement, repeats = stats.statements.most_common(1)[0]
+            metrics.query_warnings.inc(endpoint)
+            logger.warning(
+                '%s %s executed %d SQL statements (threshold %d); most repeated (%d times): %s',
+                request.method, request.path, stats.queries, threshold, repeats, ' '.join(statement.split())[:300]
+            )
+        return response
+
+    def template_started(sender, template, context, **extra):
+        stats = current_stats()
+        if stats is not None:
+            stats.templates.append(time.perf_counter())
+
+    def template_finished(sender, template, context, **extra):
+        stats = current_stats()
+        if stats is not None and stats.templates:
+            metrics.template_duration.observe(time.perf_counter() - stats.templates.pop(), template.name)
+
+    before_render_template.connect(template_started, app, weak=False)
+    template_rendered.connect(template_finished, app, weak=False)
+
+    def metrics_view():
+        token = app.config['METRICS_TOKEN']
+        if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+            abort(401)
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
+    return metrics
@@ -0,0 +1,211 @@
+from skills import LEGACY_SKILLS_SCHEMA, legacy_skills, save_legacy_skills, skills_to_mask, skills_sql
+import changes
+import history
+import stats
+
+
+# Шаги миграции схемы SQLite. Номер последнего применённого шага хранится
+# в PRAGMA user_version, поэтому каждый шаг выполняется ровно один раз.
+# Шаги пишутся идемпотентно: на новой базе db.create_all() уже создал часть объектов.
+MIGRATIONS = []
+
+
+def migration(func):
+    MIGRATIONS.append(func)
+    return func
+
+
+def table_exists(connection, table):
+    return connection.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+    ).first() is not None
+
+
+def column_exists(connection, table, column):
+    rows = connection.exec_driver_sql(f"PRAGMA table_info({table})").fetchall()
+    return any(row[1] == column for row in rows)
+
+
+@migration
+def add_character_indexes(connection):
+    # Фильтры index(): race/character_class/level на равенство
+    connection.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_character_race_class_level "
+        "ON character (race, character_class, level)"
+    )
+    connection.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_character_class_level ON character (character_class, level)"
+    )
+    # Ключи сортировки; id разрешает равенство ключей для курсорной пагинации
+    connection.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_character_name_id ON character (name, id)")
+    connection.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_character_level_id ON character (level, id)")
+    connection.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_character_experience_id ON character (experience, id)"
+    )
+
+
+@migration
+def add_character_name_fts(connection):
+    # Поиск подстроки в имени через FTS5 с триграммным токенизатором
+    # (external content: сам текст хранится только в таблице character)
+    connection.exec_driver_sql(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS character_name_fts USING fts5("
+        "name, content='character', content_rowid='id', tokenize='trigram')"
+    )
+    # Триггеры держат индекс в синхронизации при insert/update/delete
+    connection.exec_driver_sql(
+        "CREATE TRIGGER IF NOT EXISTS character_name_fts_ai AFTER INSERT ON character BEGIN "
+        "INSERT INTO character_name_fts (rowid, name) VALUES (new.id, new.name); "
+        "END"
+    )
+    connection.exec_driver_sql(
+        "CREATE TRIGGER IF NOT EXISTS character_name_fts_ad AFTER DELETE ON character BEGIN "
+        "INSERT INTO character_name_fts (character_name_fts, rowid, name) VALUES ('delete', old.id, old.name); "
+        "END"
+    )
+    connection.exec_driver_sql(
+        "CREATE TRIGGER IF NOT EXISTS character_name_fts_au AFTER UPDATE OF id, name ON character BEGIN "
+        "INSERT INTO character_name_fts (character_name_fts, rowid, name) VALUES ('delete', old.id, old.name); "
+        "INSERT INTO character_name_fts (rowid, name) VALUES (new.id, new.name); "
+        "END"
+    )
+    # Индексируем уже существующие строки
+    connection.exec_driver_sql("INSERT INTO character_name_fts (character_name_fts) VALUES ('rebuild')")
+
+
+@migration
+def convert_skills_to_mask(connection):
+    # Строка навыков "Stealth, Perception" заменяется 18-битной маской skills_mask.
+    # Строки, которые не восстанавливаются из маски один в один (неизвестные навыки,
+    # повторы, другой порядок или регистр), сохраняются в character_skills_legacy:
+    # выгрузка отдаёт их как есть, пока навыки персонажа не изменят (skills.py)
+    connection.exec_driver_sql(LEGACY_SKILLS_SCHEMA)
+    if not column_exists(connection, 'character', 'skills_mask'):
+        connection.exec_driver_sql("ALTER TABLE character ADD COLUMN skills_mask INTEGER NOT NULL DEFAULT 0")
+    if not column_exists(connection, 'character', 'skills'):
+        return
+
+    rows = connection.exec_driver_sql("SELECT id, skills FROM character").fetchall()
+    masks = [(skills_to_mask(text or ''), character_id) for character_id, text in rows]
+    if masks:
+        connection.exec_driver_sql("UPDATE character SET skills_mask = ? WHERE id = ?", masks)
+    save_legacy_skills(connection, [
+        (character_id, text or '') for character_id, text in rows if legacy_skills(text or '') is not None
+    ])
+    connection.exec_driver_sql("ALTER TABLE character DROP COLUMN skills")
+
+
+@migration
+def add_fts_sync_pause(connection):
+    # Пакетная загрузка вставляет строку в fts_sync_pause в своей транзакции и
+    # потом дописывает FTS-индекс одним INSERT ... SELECT (см. bulk.py).
+    # Другие соединения эту строку не видят, а писать параллельно SQLite не даёт.
+    connection.exec_driver_sql("CREATE TABLE IF NOT EXISTS fts_sync_pause (id INTEGER PRIMARY KEY)")
+    connection.exec_driver_sql("DROP TRIGGER IF EXISTS character_name_fts_ai")
+    connection.exec_driver_sql(
+        "CREATE TRIGGER character_name_fts_ai AFTER INSERT ON character "
+        "WHEN NOT EXISTS (SELECT 1 FROM fts_sync_pause) BEGIN "
+        "INSERT INTO character_name_fts (rowid, name) VALUES (new.id, new.name); "
+        "END"
+    )
+
+
+@migration
+def add_character_version(connection):
+    # Версия строки (optimistic locking, ETag, ключи кэша) и время последнего изменения
+    if not column_exists(connection, 'character', 'version'):
+        connection.exec_driver_sql("ALTER TABLE character ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+    if not column_exists(connection, 'character', 'updated_at'):
+        # ADD COLUMN не допускает DEFAULT CURRENT_TIMESTAMP, заполняем отдельно
+        connection.exec_driver_sql("ALTER TABLE character ADD COLUMN updated_at DATETIME")
+    connection.exec_driver_sql("UPDATE character SET updated_at = CURRENT_TIMESTAMP WHERE updated_at IS NULL")
+
+
+@migration
+def add_user_session_version(connection):
+    # Версия сессии пользователя: входит в id сессии Flask-Login и меняется
+    # при смене пароля или прав, что сбрасывает кэш личности и старые сессии.
+    # В базах кампаний (campaigns.py) таблицы user нет
+    if table_exists(connection, 'user') and not column_exists(connection, 'user', 'session_version'):
+        connection.exec_driver_sql("ALTER TABLE user ADD COLUMN session_version INTEGER NOT NULL DEFAULT 1")
+
+
+@migration
+def add_character_stats(connection):
+    # Сводные таблицы статистики (см. stats.py), заполняются по имеющимся персонажам
+    stats.create_tables(connection)
+    if connection.exec_driver_sql("SELECT COUNT(*) FROM character_stats_group").scalar() == 0:
+        stats.apply_inserted(connection, 0)
+
+
+@migration
+def add_character_search_fts(connection):
+    # Полнотекстовый поиск по имени, описанию и навыкам (search.py). External content:
+    # текст берётся из представления, где навыки выводятся из skills_mask словами.
+    # porter — словоформы ("exiled" находит "exile"), prefix — готовые списки документов
+    # для префиксов из 2–4 символов: "drag*" не собирается из всех слов на drag
+    connection.exec_driver_sql(
+        "CREATE VIEW IF NOT EXISTS character_search_source AS "
+        f"SELECT id, name, description, {skills_sql('skills_mask')} AS skills FROM character"
+    )
+    connection.exec_driver_sql(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS character_search_fts USING fts5("
+        "name, description, skills, content='character_search_source', content_rowid='id', "
+        "tokenize='porter unicode61 remove_diacritics 2', prefix='2 3 4')"
+    )
+    new_row = f"new.id, new.name, new.description, {skills_sql('new.skills_mask')}"
+    old_row = f"'delete', old.id, old.name, old.description, {skills_sql('old.skills_mask')}"
+    columns = "(rowid, name, description, skills)"
+    delete_columns = "(character_search_fts, rowid, name, description, skills)"
+    # Вставку пакетная загрузка дописывает сама (fts_sync_pause, bulk.py)
+    connection.exec_driver_sql(
+        "CREATE TRIGGER IF NOT EXISTS character_search_fts_ai AFTER INSERT ON character "
+        "WHEN NOT EXISTS (SELECT 1 FROM fts_sync_pause) BEGIN "
+        f"INSERT INTO character_search_fts {columns} VALUES ({new_row}); "
+        "END"
+    )
+    connection.exec_driver_sql(
+        "CREATE TRIGGER IF NOT EXISTS character_search_fts_ad AFTER DELETE ON character BEGIN "
+        f"INSERT INTO character_search_fts {delete_columns} VALUES ({old_row}); "
+        "END"
+    )
+    connection.exec_driver_sql(
+        "CREATE TRIGGER IF NOT EXISTS character_search_fts_au "
+        "AFTER UPDATE OF id, name, description, skills_mask ON character BEGIN "
+        f"INSERT INTO character_search_fts {delete_columns} VALUES ({old_row}); "
+        f"INSERT INTO character_search_fts {columns} VALUES ({new_row}); "
+        "END"
+    )
+    connection.exec_driver_sql("INSERT INTO character_search_fts (character_search_fts) VALUES ('rebuild')")
+
+
+@migration
+def add_change_event(connection):
+    # Журнал изменений персонажей для ленты /changes (changes.py)
+    changes.create_tables(connection)
+
+
+@migration
+def add_character_history(connection):
+    # История правок персонажей (history.py): пустая, строки появляются с первой правкой
+    history.create_tables(connection)
+
+
+@migration
+def restore_character_skills_legacy(connection):
+    # На этом номере была миграция, удалявшая character_skills_legacy; номер остаётся за
+    # ней, а таблица создаётся снова (пустой) в базах, где её успели удалить
+    connection.exec_driver_sql(LEGACY_SKILLS_SCHEMA)
+
+
+def upgrade(engine):
+    with engine.begin() as connection:
+        current = connection.exec_driver_sql("PRAGMA user_version").scalar()
+        for number, step in enumerate(MIGRATIONS, start=1):
+            if number <= current:
+                continue
+            step(connection)
+            # PRAGMA не принимает параметры, номер подставляем в строку
+            connection.exec_driver_sql(f"PRAGMA user_version = {number}")
+    return len(MIGRATIONS)
+
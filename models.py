@@ -1,12 +1,50 @@
+from datetime import datetime, timezone
 from flask_sqlalchemy import SQLAlchemy
+from flask_login import UserMixin
+from sqlalchemy import column, select, table
+from sqlalchemy.orm import column_property
+from migrations import upgrade
+from database import RoutingSession, register_routing
+from cache import register_invalidation
+from auth import register_identity_invalidation
+from stats import register_rollups
+from changes import register_change_feed
+from history import register_history
+from extensions import change_feed, character_cache, identity_cache
+from skills import format_skills, parse_skills, register_legacy_skills
 
-db = SQLAlchemy()
+# Одно расширение на все приложения: create_app вызывает db.init_app(app)
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
-class User(db.Model):
+
+# Время изменения храним в UTC без часового пояса
+def utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(100), unique=True, nullable=False)
     password = db.Column(db.String(200), nullable=False)
     is_admin = db.Column(db.Boolean, default=False)
+    session_version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+
+    def get_id(self):
+        return f'{self.id}:{self.session_version or 1}'
+
+
+class Campaign(db.Model):
+    # Реестр кампаний (в основной базе); персонажи кампании — в её файле (campaigns.py)
+    id = db.Column(db.Integer, primary_key=True)
+    slug = db.Column(db.String(50), unique=True, nullable=False)  # Имя файла базы и префикс URL /c/<slug>/
+    name = db.Column(db.String(100), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=utcnow)
+    archived_at = db.Column(db.DateTime, nullable=True)
+
+
+# Исходные строки навыков, которые маска не восстанавливает; таблицу создаёт migrations.py
+character_skills_legacy = table('character_skills_legacy', column('character_id'), column('skills'))
+
 
 class Character(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -23,6 +61,62 @@ class Character(db.Model):
     charisma = db.Column(db.Integer, nullable=False)
     max_hp = db.Column(db.Integer, nullable=False)
     current_hp = db.Column(db.Integer, nullable=False)
-    skills = db.Column(db.Text, nullable=False)
+    skills_mask = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # Навыки битовой маской (skills.py)
     description = db.Column(db.Text, nullable=True)
-    image_path = db.Column(db.String(200), nullable=True)  # Поле для хранения пути к изображению
\ No newline at end of file
+    image_path = db.Column(db.String(200), nullable=True)  # Для пути к изображению
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')  # Растёт при каждом изменении
+    updated_at = db.Column(db.DateTime, nullable=True, default=utcnow, onupdate=utcnow)
+
+    # Исходная строка навыков из character_skills_legacy (или None) для выгрузки;
+    # отложенная колонка: читается только там, где её запрашивают
+    skills_text = column_property(
+        select(character_skills_legacy.c.skills)
+        .where(character_skills_legacy.c.character_id == id)
+        .scalar_subquery(),
+        deferred=True
+    )
+
+    __mapper_args__ = {'version_id_col': version}
+
+    # Индексы под фильтры и сортировки index(); для существующих баз их создаёт migrations.py
+    __table_args__ = (
+        db.Index('ix_character_race_class_level', 'race', 'character_class', 'level'),
+        db.Index('ix_character_class_level', 'character_class', 'level'),
+        db.Index('ix_character_name_id', 'name', 'id'),
+        db.Index('ix_character_level_id', 'level', 'id'),
+        db.Index('ix_character_experience_id', 'experience', 'id'),
+    )
+
+    # Строковое представление навыков ("Stealth, Perception") для шаблонов и JSON
+    @property
+    def skills(self):
+        return format_skills(self.skills_mask or 0)
+
+    @skills.setter
+    def skills(self, value):
+        self.skills_mask = parse_skills(value)[0]
+
+
+# FTS5-индекс имён (триграммы); таблицу и триггеры создаёт migrations.py
+character_name_fts = table('character_name_fts', column('rowid'), column('name'))
+
+# FTS5-индекс имени, описания и навыков для ранжированного поиска (search.py)
+character_search_fts = table(
+    'character_search_fts', column('rowid'), column('name'), column('description'), column('skills')
+)
+
+# События сессии и маппера регистрируются один раз на процесс, а не на каждое приложение:
+# чтение из пула READER до первой записи, сброс кэшей после commit, сводные
+# таблицы статистики, журнал ленты изменений и история правок в той же транзакции, что и персонажи
+register_routing(db.session)
+register_invalidation(db.session, Character, character_cache)
+register_identity_invalidation(db.session, User, identity_cache)
+register_rollups(db.session, Character)
+register_change_feed(db.session, Character, change_feed)
+register_history(db.session, Character)
+register_legacy_skills(Character)
+
+
+def init_db():
+    db.create_all()
+    upgrade(db.engine)
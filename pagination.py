@@ -0,0 +1,62 @@
+import base64
+import json
+from sqlalchemy import tuple_
+
+
+class CursorError(ValueError):
+    pass
+
+
+# Курсор — это значения (ключ сортировки, id) последней строки страницы,
+# упакованные в JSON и base64, чтобы его можно было передать в URL
+def encode_cursor(values):
+    raw = json.dumps(list(values), separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    # Битый курсор — CursorError: HTML-список начинает с первой страницы, API отвечает 400
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except ValueError:
+        raise CursorError('Invalid cursor.') from None
+    if not isinstance(values, list) or len(values) != 2:
+        raise CursorError('Invalid cursor.')
+    # В курсоре только скаляры: ключ сортировки (строка или число) и целый id.
+    # Иначе вложенный список или объект уйдёт параметром в SQL и уронит запрос
+    sort_key, last_id = values
+    if isinstance(sort_key, bool) or not isinstance(sort_key, (str, int, float)):
+        raise CursorError('Invalid cursor.')
+    if isinstance(last_id, bool) or not isinstance(last_id, int):
+        raise CursorError('Invalid cursor.')
+    return values
+
+
+def keyset_query(query, sort_column, id_column, descending, cursor, limit):
+    # Вместо OFFSET продолжаем с места, где закончилась предыдущая страница:
+    # (sort_key, id) > (последний sort_key, последний id). При индексе по
+    # (sort_key, id) стоимость страницы не зависит от её номера.
+    key = tuple_(sort_column, id_column)
+    if cursor is not None:
+        last = tuple_(*cursor)
+        query = query.filter(key < last if descending else key > last)
+
+    if descending:
+        query = query.order_by(sort_column.desc(), id_column.desc())
+    else:
+        query = query.order_by(sort_column.asc(), id_column.asc())
+    return query.limit(limit)
+
+
+def keyset_page(query, sort_column, id_column, descending, cursor, per_page):
+    # Берём на одну строку больше, чтобы узнать, есть ли следующая страница
+    rows = keyset_query(query, sort_column, id_column, descending, cursor, per_page + 1).all()
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        last_row = rows[-1]
+        next_cursor = encode_cursor([getattr(last_row, sort_column.key), getattr(last_row, id_column.key)])
+    return rows, next_cursor
@@ -0,0 +1,87 @@
+import hmac
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from flask import g, request
+
+# Сэмплирующий профайлер одного запроса: фоновый поток раз в interval секунд
+# снимает стек потока, обрабатывающего запрос. Результат — "folded stacks"
+# (строка "корень;...;лист число"), которые понимают flamegraph.pl и speedscope.
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+def fold_stack(frame):
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+
+class SamplingProfiler(threading.Thread):
+    def __init__(self, thread_id, interval):
+        super().__init__(name='profiler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[fold_stack(frame)] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        return self.stacks
+
+
+def write_folded(stacks, path):
+    with open(path, 'w', encoding='utf-8') as output:
+        for stack, count in stacks.most_common():
+            output.write(f'{stack} {count}\n')
+
+
+def init_profiler(app):
+    # Профилирование включается заголовком PROFILE_HEADER со значением PROFILE_TOKEN;
+    # без токена в конфигурации заголовок игнорируется
+    token = app.config['PROFILE_TOKEN']
+    header = app.config['PROFILE_HEADER']
+    folder = app.config['PROFILE_FOLDER'] or os.path.join(app.instance_path, 'profiles')
+
+    @app.before_request
+    def start_profiler():
+        value = request.headers.get(header)
+        if value and hmac.compare_digest(value, token):
+            g.profiler = SamplingProfiler(threading.get_ident(), app.config['PROFILE_INTERVAL'])
+            g.profiler.start()
+
+    @app.after_request
+    def stop_profiler(response):
+        profiler = g.pop('profiler', None)
+        if profiler is None:
+            return response
+        # Потоковые ответы (export) профилируются только до начала отдачи тела
+        stacks = profiler.stop()
+        os.makedirs(folder, exist_ok=True)
+        filename = f"{time.strftime('%Y%m%d-%H%M%S')}-{request.endpoint or 'unmatched'}-{os.getpid()}-" \
+                   f"{threading.get_ident()}.folded"
+        write_folded(stacks, os.path.join(folder, filename))
+        response.headers['X-Profile-File'] = filename
+        response.headers['X-Profile-Samples'] = str(sum(stacks.values()))
+        return response
+
+    @app.teardown_request
+    def discard_profiler(error):
+        # Запрос завершился исключением до after_request: просто останавливаем поток
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.stop()
@@ -0,0 +1,103 @@
+from flask import current_app
+from models import db, Character, character_name_fts
+from exporters import export_columns
+from skills import SKILL_BITS, skill_key
+
+# Триграммный токенизатор не находит подстроки короче трёх символов
+NAME_FTS_MIN_LENGTH = 3
+
+# Колонки, которые нужны списку персонажей (index.html)
+LIST_COLUMNS = (
+    Character.id, Character.name, Character.race, Character.character_class, Character.level,
+    Character.image_path
+)
+
+# Допустимые ключи сортировки; при равенстве порядок определяет id
+SORT_COLUMNS = {
+    'name': Character.name,
+    'level': Character.level,
+    'experience': Character.experience,
+}
+
+
+def filter_characters(query, args):
+    # Применяем фильтры из параметров запроса
+    name = args.get('name')
+    race = args.get('race')
+    character_class = args.get('character_class')
+    level = args.get('level', type=int)
+
+    if name and len(name) >= NAME_FTS_MIN_LENGTH:
+        # Фраза в кавычках — поиск подстроки по триграммному индексу
+        phrase = '"' + name.replace('"', '""') + '"'
+        matches = db.select(character_name_fts.c.rowid).where(character_name_fts.c.name.match(phrase))
+        query = query.filter(Character.id.in_(matches))
+    elif name:
+        query = query.filter(Character.name.ilike(f"%{name}%"))
+    if race:
+        query = query.filter(Character.race == race)
+    if character_class:
+        query = query.filter(Character.character_class == character_class)
+    if level:
+        query = query.filter(Character.level == level)
+
+    skills_mask, match_any = get_skills_filter(args)
+    if skills_mask:
+        matched = Character.skills_mask.op('&')(skills_mask)
+        if match_any:
+            query = query.filter(matched != 0)
+        else:
+            query = query.filter(matched == skills_mask)
+    return query
+
+
+def get_skills_filter(args):
+    # Навыки: ?skills=Stealth,Perception&skills_match=all|any
+    skills_mask = 0
+    for value in args.getlist('skills'):
+        for label in value.split(','):
+            skills_mask |= SKILL_BITS.get(skill_key(label), 0)
+    return skills_mask, args.get('skills_match', 'all') == 'any'
+
+
+def get_sort(args):
+    sort_by = args.get('sort_by', 'name')  # По умолчанию сортировка по имени
+    if sort_by not in SORT_COLUMNS:
+        sort_by = 'name'
+    descending = args.get('order', 'asc') == 'desc'  # По умолчанию по возрастанию
+    return SORT_COLUMNS[sort_by], descending
+
+
+def character_list_query(args, columns=LIST_COLUMNS, session=None):
+    # Запрос для списка: фильтры, только нужные колонки и ключ сортировки для курсора.
+    # session — сессия другой базы (запросы по всем кампаниям, campaigns.py)
+    sort_column, descending = get_sort(args)
+    columns = list(columns)
+    if not any(selected is sort_column for selected in columns):
+        columns.append(sort_column)
+    return filter_characters((session or db.session).query(*columns), args), sort_column, descending
+
+
+def get_per_page(args):
+    per_page = args.get('per_page', current_app.config['CHARACTERS_PER_PAGE'], type=int)
+    return max(1, min(per_page, current_app.config['CHARACTERS_MAX_PER_PAGE']))
+
+
+def list_cache_params(args):
+    # Нормализованные параметры списка: одинаковые запросы дают один ключ кэша
+    sort_column, descending = get_sort(args)
+    skills_mask, match_any = get_skills_filter(args)
+    return repr((
+        args.get('name') or '', args.get('race') or '', args.get('character_class') or '',
+        args.get('level', type=int) or 0, skills_mask, match_any and bool(skills_mask),
+        sort_column.key, descending, get_per_page(args), args.get('cursor') or ''
+    ))
+
+
+def export_query(args):
+    # Вся выборка списка с теми же фильтрами и порядком, что и index(), без страниц
+    sort_column, descending = get_sort(args)
+    query = filter_characters(db.session.query(*export_columns(Character)), args)
+    if descending:
+        return query.order_by(sort_column.desc(), Character.id.desc())
+    return query.order_by(sort_column.asc(), Character.id.asc())
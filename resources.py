@@ -1,35 +1,171 @@
-from flask_restful import Resource, reqparse
-from models import Item, db
-
-parser = reqparse.RequestParser()
-parser.add_argument('name', required=True, help='Name cannot be blank')
-
-class ItemResource(Resource):
-    def get(self, item_id):
-        item = Item.query.get_or_404(item_id)
-        return {'id': item.id, 'name': item.name}
-
-    def delete(self, item_id):
-        item = Item.query.get_or_404(item_id)
-        db.session.delete(item)
-        db.session.commit()
-        return '', 204
-
-    def put(self, item_id):
-        args = parser.parse_args()
-        item = Item.query.get_or_404(item_id)
-        item.name = args['name']
-        db.session.commit()
-        return {'id': item.id, 'name': item.name}
-
-class ItemListResource(Resource):
+import hashlib
+from functools import wraps
+from flask import current_app, g, jsonify, request, url_for
+from flask_login import current_user
+from flask_restful import Resource, abort
+from werkzeug.datastructures import MultiDict
+from exporters import EXPORT_FIELDS
+from pagination import CursorError, decode_cursor, keyset_page
+from skills import format_skills
+
+# Поля, которые можно запросить через ?fields=; id возвращается всегда
+API_FIELDS = EXPORT_FIELDS + ['image_path', 'version', 'updated_at']
+
+
+def api_login_required(method):
+    # Клиенту API нужен код 401, а не редирект на страницу входа
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        if not current_user.is_authenticated:
+            abort(401, message='Authentication required.')
+        return method(*args, **kwargs)
+    return wrapper
+
+
+def parse_fields(args):
+    # ?fields=name,level -> поля в порядке API_FIELDS; без параметра — все
+    value = args.get('fields')
+    if not value:
+        return list(API_FIELDS)
+    requested = {field.strip() for field in value.split(',') if field.strip()}
+    unknown = requested.difference(API_FIELDS)
+    if unknown:
+        abort(400, message=f"Unknown fields: {', '.join(sorted(unknown))}.")
+    return [field for field in API_FIELDS if field == 'id' or field in requested]
+
+
+def field_columns(model, fields):
+    # Выбираем из базы только запрошенные колонки (+ id и version для ETag)
+    columns = [model.id, model.version]
+    for field in fields:
+        if field in ('id', 'version'):
+            continue
+        columns.append(model.skills_mask if field == 'skills' else getattr(model, field))
+    return columns
+
+
+def row_to_dict(row, fields):
+    data = {}
+    for field in fields:
+        if field == 'skills':
+            data[field] = format_skills(row.skills_mask or 0)
+        elif field == 'updated_at':
+            data[field] = row.updated_at.isoformat() if row.updated_at else None
+        else:
+            data[field] = getattr(row, field)
+    return data
+
+
+def rows_etag(fields, rows, extra=''):
+    # Версия меняется при каждом изменении персонажа, поэтому пар (id, version)
+    # достаточно, чтобы понять, изменился ли ответ, не сериализуя его. Id повторяются
+    # в разных кампаниях, а кампания из сессии не видна в URL — она тоже входит в ETag
+    campaign = g.get('campaign')
+    digest = hashlib.sha1(repr((fields, extra, campaign.slug if campaign else '')).encode('utf-8'))
+    for row in rows:
+        digest.update(b'%d:%d;' % (row.id, row.version))
+    return digest.hexdigest()
+
+
+def conditional_response(body, etag):
+    response = jsonify(body)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Cookie')
+    return response.make_conditional(request)
+
+
+class CharacterResource(Resource):
+    method_decorators = [api_login_required]
+
+    def __init__(self, session, model):
+        self.session = session
+        self.model = model
+
+    def get(self, id):
+        fields = parse_fields(request.args)
+        row = self.session.query(*field_columns(self.model, fields)).filter(self.model.id == id).first()
+        if row is None:
+            abort(404, message=f'Character {id} not found.')
+        return conditional_response(row_to_dict(row, fields), rows_etag(fields, [row]))
+
+
+class CharacterListResource(Resource):
+    # GET /api/characters — те же фильтры и сортировка, что у index(), с курсором;
+    # GET /api/characters?ids=1,2,3 — пакетная выборка одним запросом;
+    # PATCH /api/characters {"filters": {...}, "changes": {...}} — пакетное изменение (updates.bulk_update)
+    method_decorators = [api_login_required]
+
+    def __init__(self, session, model, list_query, get_per_page, bulk_update):
+        self.session = session
+        self.model = model
+        self.list_query = list_query
+        self.get_per_page = get_per_page
+        self.bulk_update = bulk_update
+
     def get(self):
-        items = Item.query.all()
-        return [{'id': item.id, 'name': item.name} for item in items]
-
-    def post(self):
-        args = parser.parse_args()
-        new_item = Item(name=args['name'])
-        db.session.add(new_item)
-        db.session.commit()
-        return {'id': new_item.id, 'name': new_item.name}, 201
\ No newline at end of file
+        fields = parse_fields(request.args)
+        if 'ids' in request.args:
+            return self.get_batch(fields)
+
+        try:
+            cursor = decode_cursor(request.args.get('cursor'))
+        except CursorError as error:
+            abort(400, message=str(error))
+        query, sort_column, descending = self.list_query(request.args, field_columns(self.model, fields))
+        rows, next_cursor = keyset_page(
+            query, sort_column, self.model.id, descending, cursor, self.get_per_page(request.args)
+        )
+        next_url = None
+        if next_cursor:
+            next_args = request.args.to_dict()
+            next_args['cursor'] = next_cursor
+            next_url = url_for(request.endpoint, **next_args)
+        body = {
+            'items': [row_to_dict(row, fields) for row in rows],
+            'next_cursor': next_cursor,
+            'next': next_url,
+        }
+        return conditional_response(body, rows_etag(fields, rows, next_cursor or ''))
+
+    def get_batch(self, fields):
+        try:
+            ids = [int(value) for value in request.args['ids'].split(',') if value.strip()]
+        except ValueError:
+            abort(400, message='ids must be a comma-separated list of integers.')
+        ids = list(dict.fromkeys(ids))
+        limit = current_app.config['CHARACTERS_MAX_PER_PAGE']
+        if len(ids) > limit:
+            abort(400, message=f'At most {limit} ids per request.')
+
+        rows = self.session.query(*field_columns(self.model, fields)).filter(self.model.id.in_(ids)).all()
+        found = {row.id: row for row in rows}
+        # Порядок ответа совпадает с порядком ids в запросе
+        rows = [found[character_id] for character_id in ids if character_id in found]
+        body = {
+            'items': [row_to_dict(row, fields) for row in rows],
+            'missing': [character_id for character_id in ids if character_id not in found],
+        }
+        return conditional_response(body, rows_etag(fields, rows, ids))
+
+    def patch(self):
+        if not current_user.is_admin:
+            abort(403, message='Only admins can update characters.')
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            abort(400, message='Expected a JSON object with "filters" and "changes".')
+        filters = body.get('filters') or {}
+        if not isinstance(filters, dict):
+            abort(400, message='filters must be an object.')
+        # Те же параметры, что у GET; список значений — как повторённый параметр
+        filters = MultiDict([
+            (key, str(value)) for key, values in filters.items()
+            for value in (values if isinstance(values, list) else [values])
+        ])
+        try:
+            updated = self.bulk_update(self.session, filters, body.get('changes'))
+        except ValueError as error:
+            self.session.rollback()
+            abort(400, message=str(error))
+        self.session.commit()
+        return {'updated': updated}
@@ -0,0 +1,132 @@
+import re
+from collections import namedtuple
+from markupsafe import Markup, escape
+from sqlalchemy import func, literal, literal_column, select
+from models import Character, character_search_fts
+from queries import filter_characters
+
+# Ранжированный полнотекстовый поиск по имени, описанию и навыкам (FTS5,
+# таблицу и триггеры создаёт migrations.py). Строка пользователя переводится
+# в безопасное выражение MATCH: слова через AND, "фраза в кавычках" ищется
+# целиком, слово* — по префиксу. Операторы и синтаксис FTS5 из ввода не проходят.
+
+# Вес совпадений в bm25 по колонкам (name, description, skills)
+SEARCH_WEIGHTS = (10.0, 1.0, 2.0)
+SNIPPET_TOKENS = 16
+SEARCH_CANDIDATES = 5000  # Больше совпадений — ранжируются только самые новые
+SAMPLE_ROWS = 2000  # Окно новых строк, по которому оценивается частота запроса
+PREFIX_MIN_LENGTH = 2  # Короче — слишком много совпадений, префиксный индекс начинается с 2 символов
+
+# Маркеры подсветки: не встречаются в тексте и переживают экранирование HTML
+MARK_START = '\x02'
+MARK_END = '\x03'
+
+STOP_WORDS = frozenset(
+    'a an and are as at be but by for from has he her his in is it its of on or she that the their they '
+    'this to was were who with'.split()
+)
+
+TOKEN = re.compile(r'"([^"]*)"?|(\S+)')
+WORD = re.compile(r'\w+')
+
+fts = literal_column('character_search_fts')
+
+SearchRow = namedtuple('SearchRow', [
+    'id', 'name', 'race', 'character_class', 'level', 'image_path', 'name_highlight', 'description_snippet',
+    'skills_highlight', 'rank',
+])
+
+
+def match_expression(text):
+    # 'exiled "northern keep" necro*' -> '"exiled" AND "northern keep" AND "necro"*'; '' — нечего искать.
+    # Служебные слова вне кавычек пропускаются: они есть почти в каждом описании
+    terms = []
+    skipped = []
+    for phrase, word in TOKEN.findall(text or ''):
+        words = WORD.findall(phrase or word)
+        if not words:
+            continue
+        term = '"' + ' '.join(words) + '"'
+        if word.endswith('*') and len(words[-1]) >= PREFIX_MIN_LENGTH:
+            term += '*'
+        elif word and len(words) == 1 and words[0].lower() in STOP_WORDS:
+            skipped.append(term)
+            continue
+        terms.append(term)
+    return ' AND '.join(terms or skipped)
+
+
+def marked(text):
+    # Экранированный текст с <mark> вместо маркеров FTS5
+    if not text:
+        return Markup('')
+    return Markup(str(escape(text)).replace(MARK_START, '<mark>').replace(MARK_END, '</mark>'))
+
+
+def is_common(session, expression):
+    # Запрос есть хотя бы в половине описаний (оценка по SAMPLE_ROWS новейшим строкам).
+    # У таких слов FTS5 обнуляет idf и bm25 всех строк почти равен, а считать его
+    # дорого: idf вычисляется проходом по всем совпадениям, а не только по кандидатам
+    newest = session.scalar(select(func.max(Character.id)))
+    if not newest or newest <= SEARCH_CANDIDATES:
+        return False
+    rowid = character_search_fts.c.rowid
+    sampled = session.scalar(
+        select(func.count()).select_from(character_search_fts)
+        .where(fts.match(expression), rowid > newest - SAMPLE_ROWS)
+    )
+    return sampled * 2 >= SAMPLE_ROWS
+
+
+def search_characters(session, text, filters, limit, offset=0):
+    # Строки по убыванию релевантности, при равной — сначала новые (+1 лишняя, чтобы
+    # понять, есть ли следующая страница); filters — race/character_class/level/skills, как у списка
+    expression = match_expression(text)
+    if not expression:
+        return []
+    rowid = character_search_fts.c.rowid
+    common = is_common(session, expression)
+    rank = literal(0.0) if common else func.bm25(fts, *SEARCH_WEIGHTS)
+    # Ранжируются не больше SEARCH_CANDIDATES самых новых совпадений: у запросов с тысячами
+    # совпадений вес слов мал, а bm25 считается для каждого кандидата
+    candidates = filter_characters(
+        session.query(rowid.label('id'), rank.label('rank'))
+        .select_from(character_search_fts).join(Character, Character.id == rowid)
+        .filter(fts.match(expression)),
+        filters,
+    ).order_by(rowid.desc()).limit(limit + 1 + offset if common else SEARCH_CANDIDATES).subquery()
+    ranks = dict(
+        session.query(candidates.c.id, candidates.c.rank)
+        .order_by(candidates.c.rank, candidates.c.id.desc()).limit(limit + 1).offset(offset).all()
+    )
+    if not ranks:
+        return []
+    # Подсветка и фрагменты — только для строк страницы. Страница выбирается одним проходом
+    # по диапазону rowid: на rowid IN FTS5 ищет каждую строку отдельно и для префиксного
+    # запроса каждый раз заново собирает список документов; "+ 0" не даёт отдать ему IN
+    rows = session.query(
+        Character.id, Character.name, Character.race, Character.character_class, Character.level,
+        Character.image_path,
+        func.highlight(fts, 0, MARK_START, MARK_END).label('name_highlight'),
+        func.snippet(fts, 1, MARK_START, MARK_END, '…', SNIPPET_TOKENS).label('description_snippet'),
+        func.highlight(fts, 2, MARK_START, MARK_END).label('skills_highlight'),
+    ).select_from(character_search_fts).join(Character, Character.id == rowid).filter(
+        fts.match(expression), rowid.between(min(ranks), max(ranks)), (rowid + 0).in_(list(ranks))
+    ).all()
+    rows = [SearchRow(*row, rank=ranks[row.id]) for row in rows]
+    return sorted(rows, key=lambda row: (row.rank, -row.id))
+
+
+def search_result(row):
+    return {
+        'id': row.id,
+        'name': row.name,
+        'race': row.race,
+        'character_class': row.character_class,
+        'level': row.level,
+        'image_path': row.image_path,
+        'rank': row.rank,
+        'name_highlight': marked(row.name_highlight),
+        'description_snippet': marked(row.description_snippet),
+        'skills_highlight': marked(row.skills_highlight),
+    }
@@ -0,0 +1,210 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from sqlalchemy import select
+
+# Монте-Карло симуляция боя отряд на отряд по сохранённым персонажам.
+# Персонажи загружаются в колонки NumPy (по элементу на бойца), затем
+# тысячи боёв идут одновременно: состояние пачки — массивы (бои, бойцы),
+# а раунд — несколько векторных операций над всей пачкой.
+#
+# Модель упрощённая, в духе D&D 5e: атака — d20 + модификатор + мастерство
+# против класса доспеха, натуральная 20 — крит (кости урона дважды), 1 — промах.
+# Раунд одновременный: все живые бойцы атакуют случайного живого противника
+# по состоянию на начало раунда, поэтому порядок инициативы не нужен
+# и обе стороны могут пасть в одном раунде (ничья).
+
+ABILITIES = ['strength', 'dexterity', 'constitution', 'intelligence', 'wisdom', 'charisma']
+
+# Класс -> (характеристика атаки, кость урона, бонус доспеха, боец ближнего боя)
+CLASS_PROFILES = {
+    'Barbarian': ('strength', 12, 3, True),
+    'Bard': ('charisma', 8, 2, False),
+    'Cleric': ('wisdom', 8, 6, False),
+    'Druid': ('wisdom', 8, 3, False),
+    'Fighter': ('strength', 10, 8, True),
+    'Monk': ('dexterity', 8, 3, True),
+    'Paladin': ('strength', 10, 8, True),
+    'Ranger': ('dexterity', 8, 4, True),
+    'Rogue': ('dexterity', 6, 2, True),
+    'Sorcerer': ('charisma', 10, 0, False),
+    'Warlock': ('charisma', 10, 2, False),
+    'Wizard': ('intelligence', 10, 0, False),
+}
+DEFAULT_PROFILE = ('strength', 6, 0, True)  # Классы из импорта, которых нет в таблице
+
+COLUMNS = ['id', 'name', 'character_class', 'level', *ABILITIES, 'max_hp', 'current_hp']
+
+BATCH_SIZE = 25000
+MAX_ROUNDS = 100
+
+
+def modifier(score):
+    return np.floor_divide(score - 10, 2)
+
+
+def load_party(session, table, ids):
+    # Колонки отряда в порядке ids; неизвестный id -> LookupError
+    rows = {row.id: row for row in session.execute(
+        select(*[table.c[column] for column in COLUMNS]).where(table.c.id.in_(ids))
+    )}
+    missing = [character_id for character_id in ids if character_id not in rows]
+    if missing:
+        raise LookupError(f"Unknown characters: {', '.join(map(str, missing))}")
+    rows = [rows[character_id] for character_id in ids]
+    columns = {column: np.array([getattr(row, column) for row in rows]) for column in COLUMNS}
+    return party_arrays(columns)
+
+
+def party_arrays(columns):
+    # Боевые параметры из колонок персонажа; все массивы длины "число бойцов"
+    level = columns['level'].astype(np.int64)
+    classes = columns['character_class']
+    profiles = [CLASS_PROFILES.get(name, DEFAULT_PROFILE) for name in classes]
+    ability = np.array([columns[profile[0]][index] for index, profile in enumerate(profiles)], dtype=np.int64)
+    martial = np.array([profile[3] for profile in profiles])
+    proficiency = 2 + (level - 1) // 4
+    # Бойцы ближнего боя бьют дважды с 5 уровня (воин трижды с 11-го),
+    # заклинатели — одна атака, кости которой растут на 5/11/17 уровнях
+    attacks = np.where(martial, 1 + (level >= 5), 1)
+    attacks += (classes == 'Fighter') & (level >= 11)
+    dice = np.where(martial, 1, 1 + (level >= 5) + (level >= 11) + (level >= 17))
+    # Скрытая атака плута: +1d6 за каждые два уровня к единственной атаке
+    rogue = classes == 'Rogue'
+    attacks = np.where(rogue, 1, attacks)
+    dice = np.where(rogue, 1 + (level + 1) // 2, dice)
+    return {
+        'id': columns['id'].astype(np.int64),
+        'name': columns['name'],
+        'hp': columns['current_hp'].astype(np.int64),
+        'max_hp': columns['max_hp'].astype(np.int64),
+        'armor_class': 10 + modifier(columns['dexterity'].astype(np.int64))
+                       + np.array([profile[2] for profile in profiles]),
+        'attack_bonus': modifier(ability) + proficiency,
+        'damage_bonus': np.maximum(modifier(ability), 0),
+        'die': np.array([profile[1] for profile in profiles], dtype=np.int64),
+        'dice': dice.astype(np.int64),
+        'attacks': attacks.astype(np.int64),
+    }
+
+
+def attack_round(rng, attacker, attacker_alive, defender, defender_alive):
+    # Урон, полученный каждым защитником за раунд: массив (бои, защитники)
+    trials, defenders = defender_alive.shape
+    damage = np.zeros(trials * defenders, dtype=np.int64)
+    offsets = (np.arange(trials) * defenders)[:, None]
+    # Случайный живой противник: k-й живой, k равномерно из [0, число живых)
+    alive_before = defender_alive.cumsum(axis=1)[:, None, :]
+    alive_count = alive_before[:, :, -1]
+    # Кости урона с учётом крита: столбцы сверх dice * (1 + crit) обнуляются
+    max_dice = 2 * int(attacker['dice'].max())
+    dice_columns = np.arange(max_dice)
+    for swing in range(int(attacker['attacks'].max())):
+        active = attacker_alive & (attacker['attacks'] > swing)
+        choice = (rng.random(active.shape) * alive_count).astype(np.int64)
+        target = (alive_before <= choice[..., None]).sum(axis=2)
+        roll = rng.integers(1, 21, active.shape, dtype=np.int8)
+        critical = roll == 20
+        armor_class = defender['armor_class'][target]
+        hit = active & (critical | ((roll != 1) & (roll + attacker['attack_bonus'] >= armor_class)))
+        # Кости бросаем только для попаданий: их обычно меньше половины атак
+        trial, fighter = np.nonzero(hit)
+        count = attacker['dice'][fighter] * (1 + critical[trial, fighter])
+        faces = rng.random((len(fighter), max_dice)) * attacker['die'][fighter, None]
+        rolled = np.where(dice_columns < count[:, None], faces.astype(np.int64) + 1, 0).sum(axis=1)
+        dealt = rolled + attacker['damage_bonus'][fighter]
+        damage += np.bincount(offsets[trial, 0] + target[trial, fighter], weights=dealt,
+                              minlength=trials * defenders).astype(np.int64)
+    return damage.reshape(trials, defenders)
+
+
+def simulate_batch(party_a, party_b, trials, seed, index, max_rounds=MAX_ROUNDS):
+    # Одна пачка боёв; поток случайных чисел default_rng([seed, index]), как в generator,
+    # поэтому итог зависит только от seed и числа боёв, а не от числа процессов
+    rng = np.random.default_rng([seed, index])
+    hp_a = np.broadcast_to(party_a['hp'], (trials, len(party_a['hp']))).copy()
+    hp_b = np.broadcast_to(party_b['hp'], (trials, len(party_b['hp']))).copy()
+    # Если одна из сторон уже лежит (у всех HP <= 0), боя нет: 0 раундов, победа другой стороны
+    # или ничья. Иначе в attack_round не из кого выбирать цель
+    standing = bool((party_a['hp'] > 0).any() and (party_b['hp'] > 0).any())
+    rounds = np.full(trials, max_rounds if standing else 0, dtype=np.int64)
+    active = np.arange(trials if standing else 0)  # Бои, где обе стороны ещё на ногах
+    for round_number in range(1, max_rounds + 1):
+        if not len(active):
+            break
+        alive_a = hp_a[active] > 0
+        alive_b = hp_b[active] > 0
+        damage_b = attack_round(rng, party_a, alive_a, party_b, alive_b)
+        damage_a = attack_round(rng, party_b, alive_b, party_a, alive_a)
+        hp_a[active] -= damage_a
+        hp_b[active] -= damage_b
+        over = ~(hp_a[active] > 0).any(axis=1) | ~(hp_b[active] > 0).any(axis=1)
+        rounds[active[over]] = round_number
+        # Закончившиеся бои больше не считаем: пачка сжимается с каждым раундом
+        active = active[~over]
+    standing_a = (hp_a > 0).any(axis=1)
+    standing_b = (hp_b > 0).any(axis=1)
+    return {
+        'trials': trials,
+        'wins_a': int((standing_a & ~standing_b).sum()),
+        'wins_b': int((standing_b & ~standing_a).sum()),
+        'rounds': int(rounds.sum()),
+        'hp_lost_a': (np.maximum(party_a['hp'], 0) - np.maximum(hp_a, 0)).sum(axis=0),
+        'hp_lost_b': (np.maximum(party_b['hp'], 0) - np.maximum(hp_b, 0)).sum(axis=0),
+        'downed_a': (hp_a <= 0).sum(axis=0),
+        'downed_b': (hp_b <= 0).sum(axis=0),
+    }
+
+
+def batches(trials, batch_size):
+    return [(index, min(batch_size, trials - start)) for index, start in enumerate(range(0, trials, batch_size))]
+
+
+def simulate(party_a, party_b, trials, seed, batch_size=BATCH_SIZE, processes=0, max_rounds=MAX_ROUNDS):
+    # processes > 1 — пачки считаются в пуле процессов (spawn: без копии приложения и соединений)
+    jobs = batches(trials, batch_size)
+    if processes > 1 and len(jobs) > 1:
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(min(processes, len(jobs)), mp_context=context) as pool:
+            results = list(pool.map(
+                simulate_batch, *zip(*[(party_a, party_b, size, seed, index, max_rounds) for index, size in jobs])
+            ))
+    else:
+        results = [simulate_batch(party_a, party_b, size, seed, index, max_rounds) for index, size in jobs]
+    total = {key: sum(result[key] for result in results) for key in results[0]}
+    return summarize(party_a, party_b, total, seed)
+
+
+def side_summary(party, hp_lost, downed, trials):
+    return [
+        {
+            'id': int(party['id'][index]),
+            'name': str(party['name'][index]),
+            'hp': int(party['hp'][index]),
+            'expected_hp_loss': float(hp_lost[index] / trials),
+            'downed_rate': float(downed[index] / trials),
+        }
+        for index in range(len(party['id']))
+    ]
+
+
+def summarize(party_a, party_b, total, seed):
+    trials = total['trials']
+    draws = trials - total['wins_a'] - total['wins_b']
+    return {
+        'trials': trials,
+        'seed': seed,
+        'win_rate_a': total['wins_a'] / trials,
+        'win_rate_b': total['wins_b'] / trials,
+        'draw_rate': draws / trials,
+        'mean_rounds': total['rounds'] / trials,
+        'expected_hp_loss_a': float(total['hp_lost_a'].sum() / trials),
+        'expected_hp_loss_b': float(total['hp_lost_b'].sum() / trials),
+        'party_a': side_summary(party_a, total['hp_lost_a'], total['downed_a'], trials),
+        'party_b': side_summary(party_b, total['hp_lost_b'], total['downed_b'], trials),
+    }
+
+
+def with_full_hp(party):
+    # Отряд после долгого отдыха: текущие HP = максимальным
+    return dict(party, hp=party['max_hp'].copy())
@@ -0,0 +1,106 @@
+from functools import lru_cache
+from sqlalchemy import event, inspect, text
+
+# Навыки хранятся в Character.skills_mask: бит i соответствует SKILLS[i].
+# Имена совпадают с полями BooleanField в CharacterForm.
+SKILLS = [
+    'acrobatics', 'animal_handling', 'arcana', 'athletics', 'deception',
+    'history', 'insight', 'intimidation', 'investigation', 'medicine',
+    'nature', 'perception', 'performance', 'persuasion', 'religion',
+    'sleight_of_hand', 'stealth', 'survival'
+]
+SKILL_BITS = {skill: 1 << index for index, skill in enumerate(SKILLS)}
+
+
+def skill_label(skill):
+    # 'sleight_of_hand' -> 'Sleight Of Hand' (так навыки записывались строкой раньше)
+    return skill.replace('_', ' ').title()
+
+
+def skill_key(label):
+    return label.strip().lower().replace(' ', '_')
+
+
+def parse_skills(text):
+    # Строка вида "Stealth, Perception" (или список названий) -> (маска, нераспознанные названия)
+    labels = text.split(',') if isinstance(text, str) else (text or [])
+    mask = 0
+    unknown = []
+    for label in labels:
+        if not isinstance(label, str) or not label.strip():
+            continue
+        bit = SKILL_BITS.get(skill_key(label))
+        if bit is None:
+            unknown.append(label.strip())
+        else:
+            mask |= bit
+    return mask, unknown
+
+
+@lru_cache(maxsize=4096)
+def skills_to_mask(text):
+    # Одни и те же строки навыков повторяются постоянно (импорт, генерация) — кэшируем
+    return parse_skills(text)[0]
+
+
+def format_skills(mask):
+    # Обратное преобразование в строку для JSON-экспорта и шаблонов
+    return ', '.join(skill_label(skill) for skill in SKILLS if mask & SKILL_BITS[skill])
+
+
+# Исходные строки навыков, которые маска не восстанавливает один в один (неизвестные
+# навыки, другой порядок, повторы, регистр): их пишут миграция и импорт, а выгрузка
+# отдаёт вместо format_skills, пока навыки персонажа не изменят
+LEGACY_SKILLS_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS character_skills_legacy (character_id INTEGER PRIMARY KEY, skills TEXT NOT NULL)"
+)
+LEGACY_SKILLS = 'skills_text'  # Ключ исходной строки в записи импорта (bulk.py пишет её в таблицу)
+
+
+@lru_cache(maxsize=4096)
+def legacy_skills(text):
+    # Строка, если маска её не восстанавливает; иначе None
+    return text if format_skills(skills_to_mask(text)) != text else None
+
+
+def save_legacy_skills(connection, rows):
+    # rows — [(character_id, строка)]
+    if rows:
+        connection.exec_driver_sql(
+            "INSERT OR REPLACE INTO character_skills_legacy (character_id, skills) VALUES (?, ?)", rows
+        )
+
+
+def clear_legacy_skills(connection, where):
+    # Навыки изменили — исходная строка больше не про этого персонажа
+    connection.exec_driver_sql(
+        f"DELETE FROM character_skills_legacy WHERE character_id IN (SELECT id FROM character WHERE {where})"
+    )
+
+
+def register_legacy_skills(model):
+    @event.listens_for(model, 'after_update')
+    def clear_changed(mapper, connection, target):
+        if inspect(target).attrs.skills_mask.history.has_changes():
+            connection.execute(text("DELETE FROM character_skills_legacy WHERE character_id = :id"),
+                               {'id': target.id})
+
+
+def form_skills_mask(form):
+    mask = 0
+    for skill in SKILLS:
+        if getattr(form, skill).data:  # Проверяем, был ли выбран флажок
+            mask |= SKILL_BITS[skill]
+    return mask
+
+
+def set_form_skills(form, mask):
+    for skill in SKILLS:
+        getattr(form, skill).data = bool(mask & SKILL_BITS[skill])
+
+
+def skills_sql(mask):
+    # Навыки текстом в SQL (для полнотекстового индекса): выражение над колонкой маски mask
+    return "trim(" + " || ".join(
+        f"(CASE WHEN {mask} & {SKILL_BITS[skill]} THEN '{skill_label(skill)} ' ELSE '' END)" for skill in SKILLS
+    ) + ")"
@@ -0,0 +1,341 @@
+from sqlalchemy import event, inspect, text
+from bulk import BULK_TABLES
+
+# Сводные таблицы для статистики по персонажам. Обновляются приращениями
+# при каждой вставке/изменении/удалении, поэтому дашборд читает несколько
+# тысяч строк сводок вместо всей таблицы character.
+#
+#   character_stats_group     — (race, character_class, level): число персонажей и суммы
+#   character_stats_histogram — (race, character_class, metric, value): гистограммы
+#                               характеристик и доли HP (по десятым) для перцентилей
+ABILITIES = ['strength', 'dexterity', 'constitution', 'intelligence', 'wisdom', 'charisma']
+HP_RATIO = 'hp_ratio'
+METRICS = ABILITIES + [HP_RATIO]
+PERCENTILES = [25, 50, 75, 90]
+
+SUM_COLUMNS = [f'sum_{ability}' for ability in ABILITIES] + ['sum_max_hp', 'sum_current_hp', 'sum_hp_ratio']
+TRACKED_FIELDS = ['race', 'character_class', 'level', 'max_hp', 'current_hp'] + ABILITIES
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS character_stats_group ("
+    "race VARCHAR(50) NOT NULL, character_class VARCHAR(50) NOT NULL, level INTEGER NOT NULL, "
+    "count INTEGER NOT NULL DEFAULT 0, "
+    + ''.join(f"{column} REAL NOT NULL DEFAULT 0, " for column in SUM_COLUMNS) +
+    "PRIMARY KEY (race, character_class, level))",
+    "CREATE TABLE IF NOT EXISTS character_stats_histogram ("
+    "race VARCHAR(50) NOT NULL, character_class VARCHAR(50) NOT NULL, metric VARCHAR(20) NOT NULL, "
+    "value INTEGER NOT NULL, count INTEGER NOT NULL DEFAULT 0, "
+    "PRIMARY KEY (race, character_class, metric, value))",
+]
+
+# Доля HP в SQL: 0 при max_hp <= 0; номер десятой доли — целая часть ratio * 10
+HP_RATIO_SQL = "(CASE WHEN max_hp > 0 THEN CAST(current_hp AS REAL) / max_hp ELSE 0 END)"
+
+GROUP_UPSERT = (
+    "INSERT INTO character_stats_group (race, character_class, level, count, " + ', '.join(SUM_COLUMNS) + ") "
+    "VALUES (:race, :character_class, :level, :count, " + ', '.join(f':{column}' for column in SUM_COLUMNS) + ") "
+    "ON CONFLICT (race, character_class, level) DO UPDATE SET count = count + excluded.count, "
+    + ', '.join(f'{column} = {column} + excluded.{column}' for column in SUM_COLUMNS)
+)
+HISTOGRAM_UPSERT = (
+    "INSERT INTO character_stats_histogram (race, character_class, metric, value, count) "
+    "VALUES (:race, :character_class, :metric, :value, :count) "
+    "ON CONFLICT (race, character_class, metric, value) DO UPDATE SET count = count + excluded.count"
+)
+
+# Те же сводки для набора строк (условие where) одним запросом на таблицу;
+# sign=-1 вычитает набор — так пакетное изменение снимает строки до UPDATE
+# и добавляет после
+def bulk_group_upsert(where, sign=1):
+    return (
+        "INSERT INTO character_stats_group (race, character_class, level, count, " + ', '.join(SUM_COLUMNS) + ") "
+        f"SELECT race, character_class, level, {sign} * COUNT(*), "
+        + ''.join(f"{sign} * SUM({ability}), " for ability in ABILITIES) +
+        f"{sign} * SUM(max_hp), {sign} * SUM(current_hp), {sign} * SUM({HP_RATIO_SQL}) "
+        f"FROM character WHERE {where} GROUP BY race, character_class, level "
+        "ON CONFLICT (race, character_class, level) DO UPDATE SET count = count + excluded.count, "
+        + ', '.join(f'{column} = {column} + excluded.{column}' for column in SUM_COLUMNS)
+    )
+
+
+def bulk_histogram_upsert(where, sign=1):
+    return (
+        "INSERT INTO character_stats_histogram (race, character_class, metric, value, count) "
+        f"SELECT race, character_class, metric, value, {sign} * COUNT(*) FROM ("
+        + " UNION ALL ".join(
+            f"SELECT race, character_class, '{ability}' AS metric, {ability} AS value "
+            f"FROM character WHERE {where}" for ability in ABILITIES
+        ) +
+        f" UNION ALL SELECT race, character_class, '{HP_RATIO}', CAST({HP_RATIO_SQL} * 10 AS INTEGER) "
+        f"FROM character WHERE {where}"
+        ") WHERE true GROUP BY race, character_class, metric, value "
+        "ON CONFLICT (race, character_class, metric, value) DO UPDATE SET count = count + excluded.count"
+    )
+
+
+BULK_GROUP_UPSERT = bulk_group_upsert('id > :start_id')
+BULK_HISTOGRAM_UPSERT = bulk_histogram_upsert('id > :start_id')
+
+
+def create_tables(connection):
+    for statement in SCHEMA:
+        connection.exec_driver_sql(statement)
+
+
+def hp_ratio(current_hp, max_hp):
+    return current_hp / max_hp if max_hp and max_hp > 0 else 0.0
+
+
+def apply_delta(connection, values, sign):
+    # Добавить (sign=1) или вычесть (sign=-1) одного персонажа из сводок
+    ratio = hp_ratio(values['current_hp'], values['max_hp'])
+    group = {
+        'race': values['race'], 'character_class': values['character_class'], 'level': values['level'],
+        'count': sign, 'sum_max_hp': sign * values['max_hp'], 'sum_current_hp': sign * values['current_hp'],
+        'sum_hp_ratio': sign * ratio,
+    }
+    for ability in ABILITIES:
+        group[f'sum_{ability}'] = sign * values[ability]
+    connection.execute(text(GROUP_UPSERT), group)
+
+    histogram = [
+        {'race': values['race'], 'character_class': values['character_class'],
+         'metric': ability, 'value': values[ability], 'count': sign}
+        for ability in ABILITIES
+    ]
+    histogram.append({
+        'race': values['race'], 'character_class': values['character_class'],
+        'metric': HP_RATIO, 'value': int(ratio * 10), 'count': sign,
+    })
+    connection.execute(text(HISTOGRAM_UPSERT), histogram)
+
+    if sign < 0:
+        # Опустевшие группы и столбцы гистограммы не храним
+        connection.execute(
+            text("DELETE FROM character_stats_group WHERE race = :race AND character_class = :character_class "
+                 "AND level = :level AND count <= 0"), group
+        )
+        connection.execute(
+            text("DELETE FROM character_stats_histogram WHERE race = :race AND character_class = :character_class "
+                 "AND count <= 0"), group
+        )
+
+
+def apply_inserted(connection, start_id):
+    # Пакетная вставка: сводки по всем строкам с id > start_id
+    connection.execute(text(BULK_GROUP_UPSERT), {'start_id': start_id})
+    connection.execute(text(BULK_HISTOGRAM_UPSERT), {'start_id': start_id})
+
+
+def apply_selected(connection, where, sign):
+    # Пакетное изменение: добавить или вычесть все строки, отобранные условием where
+    connection.execute(text(bulk_group_upsert(where, sign)))
+    connection.execute(text(bulk_histogram_upsert(where, sign)))
+    if sign < 0:
+        connection.execute(text("DELETE FROM character_stats_group WHERE count <= 0"))
+        connection.execute(text("DELETE FROM character_stats_histogram WHERE count <= 0"))
+
+
+def register_rollups(session, model):
+    # Приращения в той же транзакции, что и изменение персонажа
+    table_name = model.__table__.name
+
+    def current_values(target):
+        return {field: getattr(target, field) for field in TRACKED_FIELDS}
+
+    def previous_values(target):
+        state = inspect(target)
+        values = {}
+        changed = False
+        for field in TRACKED_FIELDS:
+            history = state.attrs[field].history
+            if history.deleted:
+                values[field] = history.deleted[0]
+                changed = True
+            else:
+                values[field] = getattr(target, field)
+        return values if changed else None
+
+    @event.listens_for(model, 'after_insert')
+    def rollup_insert(mapper, connection, target):
+        apply_delta(connection, current_values(target), 1)
+
+    @event.listens_for(model, 'after_update')
+    def rollup_update(mapper, connection, target):
+        previous = previous_values(target)
+        if previous is not None:
+            apply_delta(connection, previous, -1)
+            apply_delta(connection, current_values(target), 1)
+
+    @event.listens_for(model, 'after_delete')
+    def rollup_delete(mapper, connection, target):
+        apply_delta(connection, current_values(target), -1)
+
+    @event.listens_for(session, 'before_commit')
+    def rollup_bulk_insert(session):
+        # BulkInserter пишет мимо событий маппера и сообщает начальный id пачки
+        start_id = session.info.get(BULK_TABLES, {}).get(table_name)
+        if start_id is not None:
+            apply_inserted(session.connection(), start_id)
+
+
+def _factorize(values, codes):
+    import numpy as np
+    # Строки -> номера через словарь: быстрее сортировки строк в np.unique
+    return np.fromiter((codes.setdefault(value, len(codes)) for value in values), dtype=np.int64, count=len(values))
+
+
+def _group_by(race_index, class_index, n_classes, values):
+    import numpy as np
+    # Ключ (race, class, value) одним int64: np.unique по одному столбцу,
+    # а не по строкам матрицы
+    low = int(values.min())
+    span = int(values.max()) - low + 1
+    keys = (race_index * n_classes + class_index) * span + (values - low)
+    unique, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    race_class, value = np.divmod(unique, span)
+    race, character_class = np.divmod(race_class, n_classes)
+    return race, character_class, value + low, inverse.reshape(-1), counts
+
+
+def recompute(connection, chunk_size=100000):
+    # Полный пересчёт сводок из таблицы character средствами NumPy — для починки
+    # после ручных правок базы. Выполняется в транзакции вызывающего.
+    # NumPy нужен только здесь, поэтому импортируется при вызове, а не при старте.
+    import numpy as np
+    columns = ['race', 'character_class', 'level', 'max_hp', 'current_hp'] + ABILITIES
+    result = connection.exec_driver_sql(f"SELECT {', '.join(columns)} FROM character")
+    race_codes = {}
+    class_codes = {}
+    chunks = {column: [] for column in columns}
+    while True:
+        rows = result.fetchmany(chunk_size)
+        if not rows:
+            break
+        for column, values in zip(columns, zip(*rows)):
+            if column == 'race':
+                chunks[column].append(_factorize(values, race_codes))
+            elif column == 'character_class':
+                chunks[column].append(_factorize(values, class_codes))
+            else:
+                chunks[column].append(np.array(values, dtype=np.int64))
+
+    connection.exec_driver_sql("DELETE FROM character_stats_group")
+    connection.exec_driver_sql("DELETE FROM character_stats_histogram")
+    if not chunks['race']:
+        return 0
+    data = {column: np.concatenate(parts) for column, parts in chunks.items()}
+    races = list(race_codes)
+    classes = list(class_codes)
+    race_index = data['race']
+    class_index = data['character_class']
+    max_hp = data['max_hp']
+    ratio = np.divide(
+        data['current_hp'], max_hp, out=np.zeros(len(max_hp), dtype=np.float64), where=max_hp > 0
+    )
+
+    # Группы (race, class, level): номер группы для каждой строки и суммы через bincount
+    group_race, group_class, group_level, group_index, counts = _group_by(
+        race_index, class_index, len(classes), data['level']
+    )
+    sums = {f'sum_{ability}': data[ability] for ability in ABILITIES}
+    sums.update({'sum_max_hp': max_hp, 'sum_current_hp': data['current_hp'], 'sum_hp_ratio': ratio})
+    totals = {column: np.bincount(group_index, weights=sums[column]) for column in SUM_COLUMNS}
+    group_rows = []
+    for position in range(len(counts)):
+        row = {
+            'race': races[group_race[position]], 'character_class': classes[group_class[position]],
+            'level': int(group_level[position]), 'count': int(counts[position]),
+        }
+        row.update({column: float(totals[column][position]) for column in SUM_COLUMNS})
+        group_rows.append(row)
+    connection.execute(text(GROUP_UPSERT), group_rows)
+
+    histogram_rows = []
+    metric_values = {ability: data[ability] for ability in ABILITIES}
+    metric_values[HP_RATIO] = (ratio * 10).astype(np.int64)
+    for metric, values in metric_values.items():
+        value_race, value_class, value, _, counts = _group_by(race_index, class_index, len(classes), values)
+        for position in range(len(counts)):
+            histogram_rows.append({
+                'race': races[value_race[position]], 'character_class': classes[value_class[position]],
+                'metric': metric, 'value': int(value[position]), 'count': int(counts[position]),
+            })
+    connection.execute(text(HISTOGRAM_UPSERT), histogram_rows)
+    return len(max_hp)
+
+
+def percentile_values(histogram, percentiles=PERCENTILES):
+    # Перцентили по методу ближайшего ранга из гистограммы [(значение, число)]
+    total = sum(count for _, count in histogram)
+    result = {}
+    if not total:
+        return {f'p{percentile}': None for percentile in percentiles}
+    for percentile in percentiles:
+        rank = max(1, -(-percentile * total // 100))
+        seen = 0
+        for value, count in histogram:
+            seen += count
+            if seen >= rank:
+                result[f'p{percentile}'] = value
+                break
+    return result
+
+
+def roster_stats(session, race=None, character_class=None):
+    # Всё читается из сводок: несколько GROUP BY по тысячам строк
+    where = []
+    params = {}
+    if race:
+        where.append("race = :race")
+        params['race'] = race
+    if character_class:
+        where.append("character_class = :character_class")
+        params['character_class'] = character_class
+    condition = f" WHERE {' AND '.join(where)}" if where else ""
+
+    by_race_class = [
+        {'race': row.race, 'character_class': row.character_class, 'count': row.count}
+        for row in session.execute(text(
+            "SELECT race, character_class, SUM(count) AS count FROM character_stats_group"
+            f"{condition} GROUP BY race, character_class ORDER BY race, character_class"
+        ), params)
+    ]
+    levels = {
+        row.level: row.count for row in session.execute(text(
+            f"SELECT level, SUM(count) AS count FROM character_stats_group{condition} GROUP BY level ORDER BY level"
+        ), params)
+    }
+    totals = session.execute(text(
+        "SELECT COALESCE(SUM(count), 0) AS count, "
+        + ', '.join(f"COALESCE(SUM({column}), 0) AS {column}" for column in SUM_COLUMNS) +
+        f" FROM character_stats_group{condition}"
+    ), params).one()._mapping
+    total = totals['count']
+
+    histograms = {metric: [] for metric in METRICS}
+    for row in session.execute(text(
+        "SELECT metric, value, SUM(count) AS count FROM character_stats_histogram"
+        f"{condition} GROUP BY metric, value ORDER BY metric, value"
+    ), params):
+        if row.count > 0:
+            histograms[row.metric].append((row.value, row.count))
+
+    abilities = {}
+    for ability in ABILITIES:
+        abilities[ability] = {'mean': totals[f'sum_{ability}'] / total if total else None}
+        abilities[ability].update(percentile_values(histograms[ability]))
+    hp = {
+        'mean_ratio': totals['sum_hp_ratio'] / total if total else None,
+        'total_ratio': totals['sum_current_hp'] / totals['sum_max_hp'] if totals['sum_max_hp'] else None,
+        # Ключ — десятая доля HP: 0 означает меньше 10%, 10 — полное здоровье
+        'ratio_histogram': {value: count for value, count in histograms[HP_RATIO]},
+    }
+    hp.update(percentile_values([(value / 10, count) for value, count in histograms[HP_RATIO]]))
+    return {
+        'total': total,
+        'by_race_class': by_race_class,
+        'level_histogram': levels,
+        'abilities': abilities,
+        'hp': hp,
+    }
@@ -0,0 +1,135 @@
+import argparse
+import itertools
+import os
+import sqlite3
+import sys
+import tempfile
+
+# Проверка планов запросов: для каждой комбинации фильтров и сортировки,
+# которую может построить index(), выполняем EXPLAIN QUERY PLAN и падаем,
+# если SQLite просматривает таблицу или индекс целиком.
+#
+# Просмотр индекса (SCAN character USING INDEX) допустим только тогда, когда
+# индекс сам даёт порядок ORDER BY: запрос index() всегда с LIMIT, и обход
+# останавливается на первой странице. Если SQLite при этом ещё и сортирует
+# (USE TEMP B-TREE FOR ORDER BY), индекс читается до конца — это ошибка.
+#
+# Планы зависят от статистики, поэтому по умолчанию база заполняется
+# генератором и проверяется дважды: без статистики (свежая база) и после
+# ANALYZE. Файл из --database проверяется с той статистикой, что в нём есть.
+#
+#   python -m tools.check_query_plans                 # временная база, --characters персонажей
+#   python -m tools.check_query_plans --database app.db
+
+NAMES = [None, 'Elf', 'El']  # триграммный поиск и короткая строка (ilike)
+RACES = [None, 'Elf']
+CLASSES = [None, 'Wizard']
+LEVELS = [None, '5']
+SKILLS = [None, 'Stealth,Perception']
+SORTS = ['name', 'level', 'experience']
+ORDERS = ['asc', 'desc']
+CURSOR_VALUES = {'name': 'Random Elf', 'level': 5, 'experience': 1000}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Fail if any index() query falls back to a table or index scan.')
+    parser.add_argument('--database', help='SQLite file to check (default: a seeded temporary database)')
+    parser.add_argument('--characters', type=int, default=20000, help='Characters in the seeded database.')
+    parser.add_argument('--verbose', action='store_true', help='print every plan')
+    return parser.parse_args()
+
+
+def combinations():
+    for name, race, character_class, level, skills, sort_by, order, paged in itertools.product(
+            NAMES, RACES, CLASSES, LEVELS, SKILLS, SORTS, ORDERS, [False, True]):
+        args = {'sort_by': sort_by, 'order': order}
+        filters = (('name', name), ('race', race), ('character_class', character_class), ('level', level),
+                   ('skills', skills))
+        for key, value in filters:
+            if value is not None:
+                args[key] = value
+        yield args, paged
+
+
+def full_scans(plan, tables):
+    # "SCAN character" — полный просмотр таблицы; "SCAN character USING [COVERING] INDEX ..." —
+    # полный просмотр индекса, если порядок всё равно досортировывается во временном дереве
+    ordered = not any('TEMP B-TREE FOR' in detail and 'ORDER BY' in detail for detail in plan)
+    scans = []
+    for detail in plan:
+        words = detail.strip().split()
+        if len(words) < 2 or words[0] != 'SCAN' or words[1] not in tables:
+            continue
+        if len(words) == 2 or not ordered:
+            scans.append(detail.strip())
+    return scans
+
+
+def check_plans(app, options, stage):
+    from flask import request
+    from models import db, Character
+    from queries import character_list_query, get_per_page
+    from pagination import keyset_query
+
+    failures = 0
+    checked = 0
+    tables = {Character.__tablename__}
+    for args, paged in combinations():
+        with app.test_request_context(query_string=args):
+            query, sort_column, descending = character_list_query(request.args)
+            cursor = [CURSOR_VALUES[args['sort_by']], 100] if paged else None
+            query = keyset_query(query, sort_column, Character.id, descending, cursor,
+                                 get_per_page(request.args) + 1)
+            sql = str(query.statement.compile(db.engine, compile_kwargs={'literal_binds': True}))
+            plan = [row[-1] for row in db.session.execute(db.text('EXPLAIN QUERY PLAN ' + sql))]
+
+        checked += 1
+        label = ' '.join(f'{key}={value}' for key, value in args.items()) + (' cursor' if paged else '')
+        scans = full_scans(plan, tables)
+        if scans:
+            failures += 1
+            print(f'FAIL [{stage}] {label}: ' + '; '.join(plan))
+        elif options.verbose:
+            print(f'ok   [{stage}] {label}: ' + '; '.join(plan))
+    db.session.rollback()
+    print(f'{stage}: {checked} queries checked, {failures} full scans')
+    return failures
+
+
+def analyze(path):
+    connection = sqlite3.connect(path)
+    connection.execute("ANALYZE")
+    connection.close()
+
+
+def main():
+    options = parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.abspath(options.database) if options.database else os.path.join(directory, 'plans.db')
+        from benchmarks.common import make_app, seed_database
+        from models import db, init_db
+
+        if not options.database:
+            seed_database(path, options.characters)  # Генератор детерминирован: одни и те же данные
+
+        app = make_app(path, TEMPLATES_PRECOMPILE=False)
+        failures = 0
+        with app.app_context():
+            init_db()
+            for engine in db.engines.values():
+                engine.dispose()  # Читатели, открытые до миграций, не видят новых индексов
+            if options.database:
+                failures += check_plans(app, options, os.path.basename(path))
+            else:
+                failures += check_plans(app, options, 'no statistics')
+                for engine in db.engines.values():
+                    engine.dispose()  # Новые соединения прочитают sqlite_stat1
+                analyze(path)
+                failures += check_plans(app, options, 'after ANALYZE')
+            for engine in db.engines.values():
+                engine.dispose()
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
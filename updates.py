@@ -0,0 +1,232 @@
+from sqlalchemy import column, func, insert, select, table, update
+from werkzeug.datastructures import MultiDict
+from models import Character, utcnow
+from queries import filter_characters
+from skills import SKILL_BITS, clear_legacy_skills, form_skills_mask, skill_key
+from stats import TRACKED_FIELDS, apply_selected
+from changes import FEED_FIELDS, publish_rows, publish_selected
+from history import (HISTORY_FIELDS, OPS, HistoryError, character_version, diff_states, history_row,
+                     latest_version, record_baselines, record_selected, write_rows)
+
+# Изменение персонажей.
+#  - Правка одного персонажа пишет только изменившиеся поля: без изменений нет
+#    ни UPDATE, ни новой версии, ни сброса кэша списков.
+#  - Форма правки несёт версию, с которой её открыли; если персонажа за это
+#    время изменил кто-то другой, сохранение отклоняется (VersionConflict),
+#    а не затирает чужую правку.
+#  - Пакетное изменение применяет выражения к отфильтрованному набору одним
+#    UPDATE в SQL, не загружая строки в Python.
+#  - Откат к прошлой версии и восстановление удалённого берут состояние из
+#    истории правок (history.py) и сами становятся новыми версиями.
+
+EDIT_FIELDS = [
+    'name', 'race', 'character_class', 'level', 'experience', 'strength', 'dexterity', 'constitution',
+    'intelligence', 'wisdom', 'charisma', 'max_hp', 'current_hp', 'description'
+]
+
+# Поля пакетного изменения: (минимум, максимум) для чисел, None для строк
+BULK_NUMERIC_FIELDS = {
+    'level': (1, 20),
+    'experience': (0, None),
+    'strength': (1, 30),
+    'dexterity': (1, 30),
+    'constitution': (1, 30),
+    'intelligence': (1, 30),
+    'wisdom': (1, 30),
+    'charisma': (1, 30),
+    'max_hp': (1, None),
+    'current_hp': (0, None),
+}
+BULK_TEXT_FIELDS = {'race': 50, 'character_class': 50, 'description': None}  # Поле -> максимальная длина
+BULK_OPERATIONS = ['set', 'add', 'copy']
+
+# Id выбранных строк: набор фиксируется до UPDATE, потому что после изменения
+# строки могут перестать подходить под фильтр (level=3 -> level + 1)
+bulk_ids = table('bulk_update_ids', column('id'), schema='temp')
+
+
+class VersionConflict(Exception):
+    def __init__(self, current_version):
+        super().__init__(f'Character was changed by someone else (now version {current_version}).')
+        self.current_version = current_version
+
+
+class BulkUpdateError(ValueError):
+    pass
+
+
+def form_changes(character, form):
+    # {поле: новое значение} только для отличающихся полей
+    changes = {}
+    for field in EDIT_FIELDS:
+        value = getattr(form, field).data
+        current = getattr(character, field)
+        if value != current and not (field == 'description' and not value and not current):
+            changes[field] = value
+    skills_mask = form_skills_mask(form)
+    if skills_mask != character.skills_mask:
+        changes['skills_mask'] = skills_mask
+    return changes
+
+
+def apply_changes(character, changes, expected_version=None):
+    # Версию при flush дополнительно проверяет SQLAlchemy (version_id_col);
+    # здесь — что форма открыта на текущей версии
+    if expected_version is not None and expected_version != character.version:
+        raise VersionConflict(character.version)
+    for field, value in changes.items():
+        setattr(character, field, value)
+    return changes
+
+
+def numeric_value(field, value):
+    if isinstance(value, bool) or not isinstance(value, int):
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            raise BulkUpdateError(f'{field} needs an integer value.')
+    return value
+
+
+def clamp(field, expression):
+    low, high = BULK_NUMERIC_FIELDS[field]
+    if high is not None:
+        expression = func.min(expression, high)
+    return func.max(expression, low)
+
+
+def change_expression(field, change):
+    # {"set": 5} | {"add": 1} | {"copy": "max_hp"} -> выражение SQL для SET;
+    # голое значение — то же, что {"set": значение}
+    if not isinstance(change, dict):
+        change = {'set': change}
+    if len(change) != 1 or next(iter(change)) not in BULK_OPERATIONS:
+        raise BulkUpdateError(f"{field}: use exactly one of {', '.join(BULK_OPERATIONS)}.")
+    operation, value = next(iter(change.items()))
+
+    if field in BULK_TEXT_FIELDS:
+        if operation != 'set' or not isinstance(value, str):
+            raise BulkUpdateError(f'{field} can only be set to a string.')
+        limit = BULK_TEXT_FIELDS[field]
+        value = value.strip()
+        if (field != 'description' and not value) or (limit and len(value) > limit):
+            raise BulkUpdateError(f'{field} must be 1 to {limit} characters.')
+        return value
+    if field not in BULK_NUMERIC_FIELDS:
+        raise BulkUpdateError(f'{field} cannot be changed in bulk.')
+
+    if operation == 'copy':
+        if value not in BULK_NUMERIC_FIELDS:
+            raise BulkUpdateError(f'{field} can only copy a numeric field.')
+        return clamp(field, getattr(Character, value))
+    value = numeric_value(field, value)
+    if operation == 'add':
+        return clamp(field, getattr(Character, field) + value)
+    low, high = BULK_NUMERIC_FIELDS[field]
+    if value < low or high is not None and value > high:
+        raise BulkUpdateError(f'{field} must be between {low} and {high if high is not None else "any"}.')
+    return value
+
+
+def skills_expression(change):
+    # {"add": ["Stealth"], "remove": ["Arcana"]} -> skills_mask | добавленные & ~удалённые
+    if not isinstance(change, dict) or not change or set(change) - {'add', 'remove'}:
+        raise BulkUpdateError('skills: use {"add": [...], "remove": [...]}.')
+    masks = {}
+    for operation, labels in change.items():
+        if isinstance(labels, str):
+            labels = labels.split(',')
+        mask = 0
+        for label in labels:
+            bit = SKILL_BITS.get(skill_key(label))
+            if bit is None:
+                raise BulkUpdateError(f'Unknown skill: {label}.')
+            mask |= bit
+        masks[operation] = mask
+    expression = Character.skills_mask.op('|')(masks.get('add', 0))
+    return expression.op('&')(~masks.get('remove', 0))
+
+
+def bulk_values(changes):
+    if not isinstance(changes, dict) or not changes:
+        raise BulkUpdateError('Nothing to change.')
+    values = {}
+    for field, change in changes.items():
+        if field == 'skills':
+            values['skills_mask'] = skills_expression(change)
+        else:
+            values[field] = change_expression(field, change)
+    # Версия и время изменения — как у правки через ORM: ETag и кэш карточек зависят от версии
+    values['version'] = Character.version + 1
+    values['updated_at'] = utcnow()
+    return values
+
+
+def bulk_update(session, filters, changes):
+    # Фильтры — те же параметры, что у списка (race, character_class, level, name, skills);
+    # возвращает число изменённых персонажей. Commit — за вызывающим.
+    values = bulk_values(changes)
+    if not isinstance(filters, MultiDict):
+        filters = MultiDict(filters or {})
+    selected = filter_characters(session.query(Character.id), filters)
+
+    connection = session.connection()  # Соединение писателя: дальше в транзакции только запись
+    connection.exec_driver_sql("CREATE TEMP TABLE IF NOT EXISTS bulk_update_ids (id INTEGER PRIMARY KEY)")
+    connection.exec_driver_sql("DELETE FROM temp.bulk_update_ids")
+    try:
+        connection.execute(insert(bulk_ids).from_select(['id'], selected.statement))
+        where = "id IN (SELECT id FROM temp.bulk_update_ids)"
+        # Сводная статистика: набор вычитается по старым значениям и добавляется по новым
+        rollups = any(field in TRACKED_FIELDS for field in values)
+        if rollups:
+            apply_selected(connection, where, -1)
+        record_baselines(connection, where)
+        result = session.execute(
+            update(Character).where(Character.id.in_(select(bulk_ids.c.id))).values(values)
+            .execution_options(synchronize_session=False)
+        )
+        if rollups:
+            apply_selected(connection, where, 1)
+        if 'skills_mask' in values:
+            clear_legacy_skills(connection, where)
+        record_selected(connection, where, values)
+        publish_selected(connection, where, values)
+    finally:
+        connection.exec_driver_sql("DELETE FROM temp.bulk_update_ids")
+    return result.rowcount
+
+
+def revert_character(session, character, version, expected_version=None):
+    # Правка, возвращающая поля версии version (откат последней правки — version = текущая - 1).
+    # Возвращает изменённые поля; commit — за вызывающим
+    target = character_version(session, character.id, version) if version and version < character.version else None
+    if target is None:
+        raise HistoryError(f'Character {character.id} has no earlier version {version}.')
+    changes = diff_states({field: getattr(character, field) for field in HISTORY_FIELDS}, target.state)
+    apply_changes(character, {field: new for field, (_, new) in changes.items()}, expected_version)
+    if changes:
+        session.info.setdefault(OPS, {})[character.id] = 'revert'
+    return changes
+
+
+def restore_character(session, character_id, version=None):
+    # Удалённый персонаж возвращается с тем же id — как при удалении или в версии version.
+    # Вставка идёт мимо ORM (версия продолжает историю, а не начинается с 1), поэтому
+    # сводки, ленту и историю обновляет сама, как bulk_update. Commit — за вызывающим
+    connection = session.connection()  # Соединение писателя: проверка и вставка под одной блокировкой
+    latest = latest_version(session, character_id)
+    if latest is None or latest.op != 'delete':
+        raise HistoryError(f'Character {character_id} is not deleted.')
+    target = character_version(session, character_id, version or latest.version)
+    if target is None:
+        raise HistoryError(f'Character {character_id} has no version {version}.')
+    deleted = character_version(session, character_id, latest.version)
+    session.execute(insert(Character).values(
+        id=character_id, version=latest.version + 1, updated_at=utcnow(), **target.state
+    ))
+    where = f'id = {int(character_id)}'
+    apply_selected(connection, where, 1)
+    publish_rows(connection, 'insert', FEED_FIELDS + ['skills'], where, {})
+    changes = {field: new for field, (_, new) in diff_states(deleted.state, target.state).items()}
+    write_rows(connection, [history_row(character_id, latest.version + 1, 'restore', changes, target.state)])
+    return latest.version + 1
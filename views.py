@@ -0,0 +1,1079 @@
+import io
+import json
+import os
+import time
+import uuid
+from flask import (Response, current_app, render_template, redirect, url_for, flash, request, jsonify, send_file,
+                   send_from_directory, stream_with_context, abort, make_response, session, g)
+from flask_restful import Api
+from flask_login import login_user, logout_user, current_user, login_required
+from werkzeug.datastructures import MultiDict
+from werkzeug.http import is_resource_modified
+from werkzeug.security import generate_password_hash
+from sqlalchemy.orm.exc import StaleDataError
+from forms import CharacterForm, EditCharacterForm, LoginForm, RegistrationForm
+from pagination import CursorError, decode_cursor, keyset_page, keyset_query
+from models import db, User, Character
+from queries import character_list_query, export_query, get_per_page, get_sort, list_cache_params
+from exporters import EXPORT_FORMATS, STREAMS, character_filename, character_json, character_to_dict
+from extensions import (login_manager, character_cache, identity_cache, password_verifier, image_processor, job_queue,
+                        change_feed, change_streams, campaigns)
+from jobs import FINISHED, HANDLERS
+from auth import PoolSaturated
+from stats import roster_stats
+from resources import CharacterListResource, CharacterResource
+from images import CONTENT_ADDRESSED, image_srcsets, store_upload, upload_file, upload_name, variant_original
+from skills import form_skills_mask, set_form_skills
+from updates import (BulkUpdateError, VersionConflict, apply_changes, bulk_update, form_changes, restore_character,
+                     revert_character)
+from history import (HistoryError, character_version, character_versions, deleted_characters, diff_states,
+                     format_time, parse_time, public_changes, public_state, version_at)
+from search import search_characters, search_result
+from changes import matches, sse_message
+from database import READER
+from campaigns import (DEFAULT_CAMPAIGN, URL_PREFIX, CampaignError, active_campaigns, add_campaign_to_url,
+                       campaign_slug, character_total, create_campaign, merge_sorted, select_campaign)
+
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'json'}
+IMPORT_EXTENSIONS = {'json', 'ndjson', 'jsonl'}
+
+
+# User Loader for Flask-Login
+@login_manager.user_loader
+def load_user(user_id):
+    return identity_cache.load(user_id)
+
+
+# Helper function to check allowed file extensions
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+
+# Сохраняем загруженную картинку под именем-хэшем и ставим в очередь уменьшенные копии
+def save_image(file):
+    image_path, _ = store_upload(file, current_app.config['UPLOAD_FOLDER'])
+    image_processor.submit(image_path)
+    return image_path
+
+
+def image_variants(image_path):
+    # {'webp': srcset, 'jpeg': srcset} уменьшенных копий картинки
+    return image_srcsets(image_path, url_for)
+
+
+def image_url(image_path):
+    return url_for('uploaded_image', filename=upload_name(image_path))
+
+
+def uploaded_image(filename):
+    # Загрузки отдаются из UPLOAD_FOLDER, который может лежать и вне static. Копию, которую
+    # ImageProcessor ещё не подготовил, временно заменяет оригинал (без кэширования)
+    folder = current_app.config['UPLOAD_FOLDER']
+    if not os.path.isfile(upload_file(folder, filename)) and '/' not in filename:
+        original = variant_original(folder, filename)
+        if original is not None:
+            response = redirect(url_for('uploaded_image', filename=original))
+            response.cache_control.no_store = True
+            return response
+    return send_from_directory(folder, filename)
+
+
+def cache_static_files(response):
+    # Файлы с хэшем содержимого в имени не меняются никогда
+    filename = (request.view_args or {}).get('filename', '')
+    if request.endpoint == 'uploaded_image':
+        filename = f'uploads/{filename}'
+    if request.endpoint in ('static', 'uploaded_image') and response.status_code in (200, 304) \
+            and CONTENT_ADDRESSED.match(filename):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config['IMMUTABLE_MAX_AGE']
+        response.cache_control.immutable = True
+    return response
+
+
+# Routes
+def index():
+    cache_key = character_cache.list_key(list_cache_params(request.args))
+    cached = character_cache.get_list(cache_key)
+    if cached is None:
+        query, sort_column, descending = character_list_query(request.args)
+        try:
+            cursor = decode_cursor(request.args.get('cursor'))
+        except CursorError:
+            cursor = None  # Битый курсор — просто начинаем с первой страницы
+        rows, next_cursor = keyset_page(
+            query, sort_column, Character.id, descending, cursor, get_per_page(request.args)
+        )
+        # В кэш кладём простые словари: их можно сериализовать для общего бэкенда
+        cached = ([dict(row._mapping) for row in rows], next_cursor)
+        character_cache.set_list(cache_key, cached)
+    characters, next_cursor = cached
+
+    next_url = None
+    if next_cursor:
+        next_args = request.args.to_dict()
+        next_args['cursor'] = next_cursor
+        next_url = url_for('index', **next_args)
+    first_url = None
+    if request.args.get('cursor'):
+        first_args = request.args.to_dict()
+        first_args.pop('cursor')
+        first_url = url_for('index', **first_args)
+    export_args = request.args.to_dict()
+    export_args.pop('cursor', None)
+    export_args.pop('per_page', None)
+    return render_template('index.html', characters=characters, next_url=next_url, first_url=first_url,
+                           export_args=export_args)
+
+
+SEARCH_FILTERS = ['race', 'character_class', 'level', 'skills', 'skills_match']
+
+
+def search():
+    # Полнотекстовый поиск: ?q=...&race=&character_class=&level=&skills=&page=N, по релевантности
+    text = request.args.get('q', '').strip()
+    per_page = get_per_page(request.args)
+    page = min(max(request.args.get('page', 1, type=int), 1), current_app.config['SEARCH_MAX_PAGE'])
+    filters = MultiDict([(key, value) for key, value in request.args.items(multi=True) if key in SEARCH_FILTERS])
+    rows = search_characters(db.session, text, filters, per_page, (page - 1) * per_page) if text else []
+    results = [search_result(row) for row in rows[:per_page]]
+    page_args = request.args.to_dict()
+    next_url = None
+    if len(rows) > per_page and page < current_app.config['SEARCH_MAX_PAGE']:
+        next_url = url_for('search', **dict(page_args, page=page + 1))
+    previous_url = url_for('search', **dict(page_args, page=page - 1)) if page > 1 else None
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({'items': results, 'page': page, 'next': next_url})
+    from generator import CLASSES, RACES
+    return render_template('search.html', results=results, query=text, page=page, next_url=next_url,
+                           previous_url=previous_url, races=RACES, classes=CLASSES)
+
+
+def register():
+    if current_user.is_authenticated:
+        return redirect(url_for('index'))
+    form = RegistrationForm()
+    if form.validate_on_submit():
+        hashed_password = generate_password_hash(form.password.data, method='pbkdf2:sha256')
+        user = User(username=form.username.data, password=hashed_password, is_admin=form.is_admin.data)
+        db.session.add(user)
+        db.session.commit()
+        flash('Account created successfully! You can now log in.', 'success')
+        return redirect(url_for('login'))
+    return render_template('register.html', form=form)
+
+
+def login():
+    if current_user.is_authenticated:
+        return redirect(url_for('index'))
+    form = LoginForm()
+    if form.validate_on_submit():
+        user = User.query.filter_by(username=form.username.data).first()
+        try:
+            valid = user is not None and password_verifier.verify(user.password, form.password.data)
+        except PoolSaturated:
+            # Пул проверки паролей перегружен: отказываем сразу, не занимая воркер
+            flash('Too many login attempts right now. Please try again in a moment.', 'danger')
+            response = make_response(render_template('login.html', form=form), 429)
+            response.headers['Retry-After'] = '1'
+            return response
+        if valid:
+            login_user(user)
+            return redirect(url_for('index'))
+        flash('Invalid username or password.', 'danger')
+    return render_template('login.html', form=form)
+
+
+@login_required
+def logout():
+    logout_user()
+    flash('You have been logged out.', 'info')
+    return redirect(url_for('login'))
+
+
+@login_required
+def add_character():
+    if not current_user.is_admin:
+        flash('Only admins can create characters.', 'danger')
+        return redirect(url_for('index'))
+    form = CharacterForm()
+    if form.validate_on_submit():
+        # Сбор навыков в битовую маску
+        skills_mask = form_skills_mask(form)
+
+        # Обработка изображения
+        image_path = None
+        if form.image.data:
+            file = form.image.data
+            if file and allowed_file(file.filename):
+                image_path = save_image(file)
+
+        # Создание персонажа
+        character = Character(
+            name=form.name.data,
+            race=form.race.data,
+            character_class=form.character_class.data,
+            level=form.level.data,
+            experience=form.experience.data,
+            strength=form.strength.data,
+            dexterity=form.dexterity.data,
+            constitution=form.constitution.data,
+            intelligence=form.intelligence.data,
+            wisdom=form.wisdom.data,
+            charisma=form.charisma.data,
+            max_hp=form.max_hp.data,
+            current_hp=form.current_hp.data,
+            skills_mask=skills_mask,
+            description=form.description.data,
+            image_path=image_path
+        )
+        db.session.add(character)
+        db.session.commit()
+        flash('Character added successfully!', 'success')
+        return redirect(url_for('index'))
+    return render_template('add_character.html', form=form)
+
+
+@login_required
+def generate_character():
+    if not current_user.is_admin:
+        flash('Only admins can generate characters.', 'danger')
+        return redirect(url_for('index'))
+
+    # Генератор тянет NumPy — импортируем при первом использовании
+    from generator import generate_characters, new_seed
+
+    # ?count=N&seed=S: пакетная генерация, одинаковый seed даёт одинаковых персонажей
+    config = current_app.config
+    count = max(request.args.get('count', 1, type=int), 1)
+    seed = request.args.get('seed', type=int)
+    if seed is None:
+        seed = new_seed()
+    elif seed < 0:
+        abort(400, 'Seed must be a non-negative integer.')  # NumPy не принимает отрицательный seed
+    if count > config['GENERATE_MAX_COUNT']:
+        # Большие объёмы генерирует фоновый воркер, запрос сразу возвращает задачу
+        count = min(count, config['JOB_GENERATE_MAX_COUNT'])
+        return job_created(job_queue.enqueue('generate', campaign_payload({'count': count, 'seed': seed}),
+                                             current_user.id))
+    generated = generate_characters(
+        db.session, Character.__table__, count, seed,
+        batch_size=config['IMPORT_BATCH_SIZE'], commit_rows=config['IMPORT_COMMIT_ROWS']
+    )
+    if generated == 1:
+        flash('Random character generated!', 'success')
+    else:
+        flash(f'{generated} random characters generated (seed {seed}).', 'success')
+    return redirect(url_for('index'))
+
+
+@login_required
+def character_details(id):
+    # Сначала читаем только версию: её хватает для ответа 304 и проверки кэша
+    state = db.session.query(Character.version, Character.updated_at).filter(Character.id == id).first()
+    if state is None:
+        abort(404)
+
+    # Страница содержит имя пользователя и флеш-сообщения, поэтому ETag зависит и от пользователя,
+    # а id повторяются в разных кампаниях
+    etag = f'character-{campaign_slug()}-{id}-{state.version}-{current_user.id}'
+    if '_flashes' not in session and not is_resource_modified(
+            request.environ, etag=etag, last_modified=state.updated_at):
+        response = Response(status=304)
+    else:
+        fragment = character_cache.get_detail(id, state.version)
+        if fragment is None:
+            character = Character.query.get_or_404(id)
+            fragment = render_template('character_card.html', character=character)
+            character_cache.set_detail(id, character.version, fragment)
+        response = make_response(render_template('character_details.html', fragment=fragment, character_id=id))
+
+    response.set_etag(etag)
+    response.last_modified = state.updated_at
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    return response
+
+
+@login_required
+def character_stats():
+    # Статистика по персонажам из сводных таблиц; ?race=&character_class= сужают выборку
+    return jsonify(roster_stats(
+        db.session, request.args.get('race'), request.args.get('character_class')
+    ))
+
+
+@login_required
+def admin():
+    if not current_user.is_admin:
+        abort(403)
+    from generator import CLASSES, RACES
+    race = request.args.get('race')
+    character_class = request.args.get('character_class')
+    return render_template(
+        'admin.html', stats=roster_stats(db.session, race, character_class),
+        races=RACES, classes=CLASSES, race=race, character_class=character_class
+    )
+
+
+@login_required
+def cache_stats():
+    if not current_user.is_admin:
+        abort(403)
+    return jsonify(character_cache.stats())
+
+
+@login_required
+def download_character(id):
+    character = Character.query.get_or_404(id)
+
+    # Формируем JSON-данные персонажа в памяти, без записи на диск
+    character_data = character_to_dict(character)
+    return send_file(
+        io.BytesIO(character_json(character_data)),
+        mimetype='application/json',
+        as_attachment=True,
+        download_name=character_filename(character_data)
+    )
+
+
+@login_required
+def export_characters():
+    # Потоковая выгрузка всего списка с теми же фильтрами, что и index()
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in EXPORT_FORMATS:
+        flash('Unknown export format.', 'danger')
+        return redirect(url_for('index'))
+
+    mimetype, extension = EXPORT_FORMATS[export_format]
+    body = STREAMS[export_format](export_query(request.args), current_app.config['EXPORT_CHUNK_SIZE'])
+    return Response(
+        stream_with_context(body),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename=characters.{extension}'}
+    )
+
+
+@login_required
+def upload_character():
+    if not current_user.is_admin:
+        flash('Only admins can upload characters.', 'danger')
+        return redirect(url_for('index'))
+
+    if request.method == 'POST':
+        if 'file' not in request.files:
+            flash('No file part in the request.', 'danger')
+            return redirect(request.url)
+
+        file = request.files['file']
+        if file.filename == '':
+            flash('No file selected.', 'danger')
+            return redirect(request.url)
+
+        if file and file.filename.rsplit('.', 1)[-1].lower() in IMPORT_EXTENSIONS:
+            if request.form.get('background'):
+                return job_created(job_queue.enqueue('import', campaign_payload({'path': save_job_upload(file)}),
+                                                     current_user.id))
+
+            from importer import import_characters
+
+            # Потоковый импорт: один объект, JSON-массив или NDJSON; битые записи попадают в отчёт
+            config = current_app.config
+            report = import_characters(
+                file.stream, db.session, Character.__table__,
+                batch_size=config['IMPORT_BATCH_SIZE'],
+                commit_rows=config['IMPORT_COMMIT_ROWS'],
+                max_errors=config['IMPORT_MAX_ERRORS']
+            )
+            if request.accept_mimetypes.best == 'application/json':
+                return jsonify(report.to_dict())
+            if report.imported == 1 and not report.failed:
+                flash('Character uploaded successfully!', 'success')
+                return redirect(url_for('index'))
+            if report.imported == 0 and report.failed == 1:
+                flash(f"Invalid character file: {report.errors[0]['error']}", 'danger')
+                return redirect(request.url)
+            flash(f'Imported {report.imported} characters, {report.failed} failed.',
+                  'info' if report.failed else 'success')
+            return render_template('upload_character.html', report=report)
+        else:
+            flash('Please upload a valid .json or .ndjson file.', 'danger')
+            return redirect(request.url)
+
+    return render_template('upload_character.html')
+
+
+@login_required
+def delete_character(id):
+    if not current_user.is_admin:
+        flash('Only admins can delete characters.', 'danger')
+        return redirect(url_for('index'))
+    character = Character.query.get_or_404(id)
+    db.session.delete(character)
+    db.session.commit()
+    flash('Character deleted.', 'info')
+    return redirect(url_for('index'))
+
+
+@login_required
+def edit_character(character_id):
+    if not current_user.is_admin:
+        flash('Only admins can edit characters.', 'danger')
+        return redirect(url_for('index'))
+
+    character = Character.query.get_or_404(character_id)
+    form = EditCharacterForm(obj=character)
+
+    if form.validate_on_submit():
+        # Записываются только изменённые поля; версия из формы защищает от
+        # перезаписи правки, сохранённой другим администратором
+        changes = form_changes(character, form)
+        if form.image.data:
+            file = form.image.data
+            if file and allowed_file(file.filename):
+                changes['image_path'] = save_image(file)
+        try:
+            apply_changes(character, changes, form.version.data)
+            db.session.commit()
+        except (VersionConflict, StaleDataError):
+            db.session.rollback()
+            flash('This character was changed by someone else. Review the current values and save again.', 'danger')
+            character = Character.query.get_or_404(character_id)
+            form = EditCharacterForm(formdata=None, obj=character)
+            set_form_skills(form, character.skills_mask)
+            return render_template('edit_character.html', form=form, character=character), 409
+        if changes:
+            flash('Character updated successfully!', 'success')
+        else:
+            flash('No changes to save.', 'info')
+        return redirect(url_for('index'))
+
+    # Установить значения флажков для навыков
+    if request.method == 'GET':
+        set_form_skills(form, character.skills_mask)
+
+    return render_template('edit_character.html', form=form, character=character)
+
+
+BULK_FILTERS = ['name', 'race', 'character_class', 'level', 'skills', 'skills_match']
+
+
+def bulk_form_changes(form):
+    # Строки формы (поле, операция, значение) -> словарь изменений для bulk_update
+    changes = {}
+    for field, operation, value in zip(form.getlist('change_field'), form.getlist('change_op'),
+                                       form.getlist('change_value')):
+        if not field:
+            continue
+        if field in changes and field != 'skills':
+            raise BulkUpdateError(f'{field} is changed twice.')
+        changes.setdefault(field, {})[operation] = value
+    return changes
+
+
+@login_required
+def bulk_update_characters():
+    # Изменение всех персонажей, подходящих под фильтр, одним UPDATE
+    if not current_user.is_admin:
+        abort(403)
+    from generator import CLASSES, RACES
+    if request.method == 'POST':
+        filters = {key: request.form[key] for key in BULK_FILTERS if request.form.get(key)}
+        try:
+            updated = bulk_update(db.session, filters, bulk_form_changes(request.form))
+        except BulkUpdateError as error:
+            db.session.rollback()
+            flash(str(error), 'danger')
+        else:
+            db.session.commit()
+            flash(f'{updated} characters updated.', 'success')
+            return redirect(url_for('index', **{key: value for key, value in filters.items() if key != 'skills_match'}))
+    return render_template('bulk_update.html', races=RACES, classes=CLASSES)
+
+
+def parse_party(value, limit):
+    # "1,2,3" -> [1, 2, 3]; ValueError для пустого, нечислового или слишком большого отряда
+    ids = [int(part) for part in value.replace(' ', '').split(',') if part]
+    if not ids or len(ids) > limit:
+        raise ValueError(f'A party needs 1 to {limit} character ids.')
+    return ids
+
+
+@login_required
+def simulate_encounter():
+    # Монте-Карло симуляция боя: ?party_a=1,2,3,4&party_b=5,6,7,8&trials=N&seed=S&full_hp=1
+    config = current_app.config
+    wants_json = request.accept_mimetypes.best == 'application/json'
+    if 'party_a' not in request.args:
+        return render_template('simulate.html', result=None)
+
+    # NumPy нужен только здесь — импортируем при первом использовании
+    from generator import new_seed
+    from simulation import load_party, simulate, with_full_hp
+    try:
+        ids_a = parse_party(request.args.get('party_a', ''), config['SIMULATION_MAX_PARTY'])
+        ids_b = parse_party(request.args.get('party_b', ''), config['SIMULATION_MAX_PARTY'])
+        party_a = load_party(db.session, Character.__table__, ids_a)
+        party_b = load_party(db.session, Character.__table__, ids_b)
+        seed = request.args.get('seed', type=int)
+        if seed is not None and seed < 0:
+            raise ValueError('Seed must be a non-negative integer.')
+    except (ValueError, LookupError) as error:
+        if wants_json:
+            abort(400, str(error))
+        flash(str(error), 'danger')
+        return render_template('simulate.html', result=None)
+    if request.args.get('full_hp'):
+        party_a, party_b = with_full_hp(party_a), with_full_hp(party_b)
+    trials = request.args.get('trials', config['SIMULATION_DEFAULT_TRIALS'], type=int)
+    trials = min(max(trials, 1), config['SIMULATION_MAX_TRIALS'])
+    if seed is None:
+        seed = new_seed()
+    result = simulate(
+        party_a, party_b, trials, seed,
+        batch_size=config['SIMULATION_BATCH_SIZE'], processes=config['SIMULATION_PROCESSES']
+    )
+    if wants_json:
+        return jsonify(result)
+    return render_template('simulate.html', result=result)
+
+
+def save_job_upload(file):
+    # Файл для фонового импорта сохраняется целиком до постановки задачи
+    folder = current_app.config['JOBS_UPLOAD_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f"{uuid.uuid4().hex}.{file.filename.rsplit('.', 1)[-1].lower()}")
+    file.save(path)
+    return path
+
+
+def campaign_payload(payload):
+    # Задача выполняется в кампании, из которой её поставили (jobs.run_job)
+    campaign = g.get('campaign')
+    if campaign is not None:
+        payload['campaign'] = campaign.slug
+    return payload
+
+
+def job_json(job):
+    data = dict(job)
+    data.pop('payload')
+    data['url'] = url_for('job_status', job_id=job['id'])
+    data['events'] = url_for('job_events', job_id=job['id'])
+    if job['kind'] == 'export' and job['status'] == 'done':
+        data['download'] = url_for('job_download', job_id=job['id'])
+    return data
+
+
+def job_created(job_id):
+    # 202 с id задачи для клиентов API, для браузера — страница прогресса
+    url = url_for('job_status', job_id=job_id)
+    if request.accept_mimetypes.best == 'application/json':
+        response = jsonify(job_json(job_queue.get(job_id)))
+        response.status_code = 202
+        response.headers['Location'] = url
+        return response
+    flash(f'Job {job_id} queued.', 'info')
+    return redirect(url)
+
+
+@login_required
+def jobs():
+    if not current_user.is_admin:
+        abort(403)
+    return render_template('jobs.html', jobs=job_queue.recent(), export_formats=EXPORT_FORMATS)
+
+
+@login_required
+def enqueue_job(kind):
+    if not current_user.is_admin:
+        abort(403)
+    if kind not in HANDLERS:
+        abort(404)
+    config = current_app.config
+    if kind == 'import':
+        file = request.files.get('file')
+        if not file or file.filename.rsplit('.', 1)[-1].lower() not in IMPORT_EXTENSIONS:
+            abort(400, 'Please upload a valid .json or .ndjson file.')
+        payload = {'path': save_job_upload(file)}
+    elif kind == 'generate':
+        from generator import new_seed
+        seed = request.values.get('seed', type=int)
+        if seed is not None and seed < 0:
+            abort(400, 'Seed must be a non-negative integer.')  # Иначе задача падала бы на каждой попытке
+        payload = {
+            'count': min(max(request.values.get('count', 1, type=int), 1), config['JOB_GENERATE_MAX_COUNT']),
+            'seed': new_seed() if seed is None else seed,
+        }
+    elif kind == 'export':
+        # Фильтры и сортировка — те же параметры, что у /export
+        export_format = request.values.get('format', 'ndjson')
+        if export_format not in EXPORT_FORMATS:
+            abort(400, 'Unknown export format.')
+        args = [(key, value) for key, value in request.values.items(multi=True) if key != 'format' and value]
+        payload = {'format': export_format, 'args': args}
+    else:
+        payload = {}
+    return job_created(job_queue.enqueue(kind, campaign_payload(payload), current_user.id))
+
+
+@login_required
+def job_status(job_id):
+    if not current_user.is_admin:
+        abort(403)
+    job = job_queue.get(job_id)
+    if job is None:
+        abort(404)
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify(job_json(job))
+    return render_template('job.html', job=job_json(job))
+
+
+@login_required
+def job_events(job_id):
+    # Server-Sent Events: событие progress при каждом изменении задачи и done в конце.
+    # Поток живёт не дольше JOB_EVENTS_TIMEOUT; EventSource переподключится сам.
+    if not current_user.is_admin:
+        abort(403)
+    if job_queue.get(job_id) is None:
+        abort(404)
+    config = current_app.config
+    if not change_streams.acquire(blocking=False):
+        # Общий лимит с /changes (CHANGE_FEED_MAX_STREAMS): оба потока держат поток сервера
+        response = make_response('Too many open event streams, retry later.', 503)
+        response.headers['Retry-After'] = str(config['CHANGE_FEED_RETRY_AFTER'])
+        return response
+    interval = config['JOB_EVENTS_INTERVAL']
+    deadline = time.monotonic() + config['JOB_EVENTS_TIMEOUT']
+
+    def stream():
+        yield f'retry: {int(interval * 1000)}\n\n'
+        last_state = None
+        last_sent = time.monotonic()
+        while time.monotonic() < deadline:
+            job = job_json(job_queue.get(job_id))
+            state = (job['status'], job['progress'], job['total'], job['message'], job['error'])
+            if state != last_state:
+                last_state = state
+                last_sent = time.monotonic()
+                event = 'done' if job['status'] in FINISHED else 'progress'
+                yield f'event: {event}\ndata: {json.dumps(job)}\n\n'
+                if event == 'done':
+                    return
+            elif time.monotonic() - last_sent >= 15:
+                last_sent = time.monotonic()
+                yield ': keep-alive\n\n'  # Прокси не закрывают молчащее соединение
+            time.sleep(interval)
+
+    response = Response(stream_with_context(stream()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(change_streams.release)
+    return response
+
+
+@login_required
+def job_download(job_id):
+    if not current_user.is_admin:
+        abort(403)
+    job = job_queue.get(job_id)
+    if job is None or job['kind'] != 'export' or job['status'] != 'done':
+        abort(404)
+    mimetype, _ = EXPORT_FORMATS[job['payload']['format']]
+    return send_file(
+        os.path.join(current_app.config['JOBS_EXPORT_FOLDER'], job['result']['file']),
+        mimetype=mimetype, as_attachment=True, download_name=job['result']['file']
+    )
+
+
+def change_subscription(args):
+    # ?ids=1,2&race=Elf&character_class=Wizard (параметры можно повторять)
+    ids = set()
+    for value in args.getlist('ids'):
+        for part in value.split(','):
+            if part.strip():
+                try:
+                    ids.add(int(part))
+                except ValueError:
+                    abort(400)
+    if len(ids) > current_app.config['CHANGE_FEED_MAX_IDS']:
+        abort(400)
+    return {'ids': ids, 'races': set(args.getlist('race')), 'classes': set(args.getlist('character_class'))}
+
+
+@login_required
+def changes():
+    # Лента изменений персонажей (Server-Sent Events): событие change на каждую запись
+    # с id = seq журнала. После обрыва EventSource присылает Last-Event-ID и получает
+    # пропущенное из буфера; если буфер уже ушёл дальше — событие reset, и клиент
+    # перечитывает данные целиком. Без Last-Event-ID (или ?since=seq) поток начинается
+    # с текущего места событием ready.
+    subscription = change_subscription(request.args)
+    last_id = request.headers.get('Last-Event-ID') or request.args.get('since')
+    try:
+        last_id = int(last_id) if last_id else None
+    except ValueError:
+        last_id = None
+    change_feed.start()
+    config = current_app.config
+    if not change_streams.acquire(blocking=False):
+        # Все потоки для ленты заняты (CHANGE_FEED_MAX_STREAMS): держать ещё один — значит
+        # отнять поток у обычных запросов. EventSource после 503 не переподключается сам,
+        # страница повторяет попытку через Retry-After
+        response = make_response('Too many open change streams, retry later.', 503)
+        response.headers['Retry-After'] = str(config['CHANGE_FEED_RETRY_AFTER'])
+        return response
+    keepalive = config['CHANGE_FEED_KEEPALIVE']
+    deadline = time.monotonic() + config['CHANGE_FEED_TIMEOUT']
+
+    def stream():
+        yield 'retry: 1000\n\n'
+        position = last_id
+        if position is None:
+            position = change_feed.head
+            yield sse_message(position, 'ready', {'seq': position})
+        sent = time.monotonic()
+        while time.monotonic() < deadline and not change_feed.stopped:
+            events = change_feed.since(position)
+            if events is None:
+                position = change_feed.head
+                yield sse_message(position, 'reset', {'seq': position})
+                sent = time.monotonic()
+                continue
+            for change in events:
+                if matches(change.data, **subscription):
+                    yield change.message
+                    sent = time.monotonic()
+            if events:
+                position = events[-1].seq
+            else:
+                change_feed.wait(position, min(keepalive, max(deadline - time.monotonic(), 0)))
+            if time.monotonic() - sent >= keepalive:
+                # Сообщение только с id: браузер запоминает место, даже если под фильтр
+                # давно ничего не попадало, а прокси не закрывают молчащее соединение
+                yield f'id: {position}\n\n'
+                sent = time.monotonic()
+
+    response = Response(stream_with_context(stream()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Слот освобождается, когда сервер закрывает ответ: по концу потока или обрыву клиента
+    response.call_on_close(change_streams.release)
+    return response
+
+
+def main_reader():
+    return db.engines.get(READER, db.engines[None])
+
+
+def campaign_list():
+    # Все кампании, включая основную базу (DEFAULT_CAMPAIGN), для запросов по всем сразу
+    return [DEFAULT_CAMPAIGN] + [campaign.slug for campaign in active_campaigns()]
+
+
+@login_required
+def campaigns_view():
+    # Кампании с числом персонажей (сводки всех баз читаются параллельно); создаёт администратор
+    if request.method == 'POST':
+        if not current_user.is_admin:
+            abort(403)
+        try:
+            campaign = create_campaign(campaigns, request.form.get('slug'), request.form.get('name'))
+        except CampaignError as error:
+            flash(str(error), 'danger')
+        else:
+            flash(f'Campaign {campaign.name} created.', 'success')
+            return redirect(url_for('index', campaign=campaign.slug))
+    active = active_campaigns()
+    totals = dict(campaigns.fan_out(campaign_list(), character_total, main_reader()))
+    current = session.get('campaign') or DEFAULT_CAMPAIGN
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({
+            'current': current,
+            'campaigns': [{'slug': DEFAULT_CAMPAIGN, 'name': 'Default', 'characters': totals[DEFAULT_CAMPAIGN]}] + [
+                {'slug': campaign.slug, 'name': campaign.name, 'characters': totals[campaign.slug]}
+                for campaign in active
+            ],
+            'engines': campaigns.stats(),
+        })
+    return render_template('campaigns.html', campaigns=active, totals=totals, current=current,
+                           default=DEFAULT_CAMPAIGN)
+
+
+@login_required
+def use_campaign_view(slug):
+    # Кампания для адресов без префикса /c/<slug>/ до выхода или смены
+    if slug == DEFAULT_CAMPAIGN:
+        session.pop('campaign', None)
+    elif campaigns.get(slug) is None:
+        abort(404)
+    else:
+        session['campaign'] = slug
+    return redirect(url_for('index'))
+
+
+def fan_out_limit():
+    limit = request.args.get('limit', current_app.config['CHARACTERS_PER_PAGE'], type=int)
+    return max(1, min(limit, current_app.config['CAMPAIGN_FANOUT_LIMIT']))
+
+
+def campaign_rows(rows, result):
+    # [(slug, строка)] -> словари с кампанией и ссылкой на карточку в ней
+    items = []
+    for slug, row in rows:
+        item = result(row)
+        item['campaign'] = slug
+        item['url'] = url_for('character_details', id=row.id,
+                              campaign=None if slug == DEFAULT_CAMPAIGN else slug)
+        items.append(item)
+    return items
+
+
+@login_required
+def campaign_characters():
+    # Персонажи всех кампаний одним списком (сортировка и фильтры — как у списка): каждая
+    # база отдаёт свои первые limit строк в пуле потоков, отсортированные списки сливаются
+    if not current_user.is_admin:
+        abort(403)
+    args = request.args.copy()  # Потоки пула не видят контекст запроса
+    limit = fan_out_limit()
+    sort_column, descending = get_sort(args)
+
+    def first_rows(reader_session):
+        query, _, _ = character_list_query(args, session=reader_session)
+        return keyset_query(query, sort_column, Character.id, descending, None, limit).all()
+
+    results = campaigns.fan_out(campaign_list(), first_rows, main_reader())
+    rows = merge_sorted(results, lambda row: (getattr(row, sort_column.key), row.id), descending, limit)
+    items = campaign_rows(rows, lambda row: dict(row._mapping))
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({'items': items})
+    return render_template('campaign_results.html', items=items, query=None)
+
+
+@login_required
+def campaign_search():
+    # Поиск по всем кампаниям: лучшие limit совпадений каждой базы, слитые по релевантности
+    if not current_user.is_admin:
+        abort(403)
+    text = request.args.get('q', '').strip()
+    filters = MultiDict([(key, value) for key, value in request.args.items(multi=True) if key in SEARCH_FILTERS])
+    limit = fan_out_limit()
+    items = []
+    if text:
+        results = campaigns.fan_out(
+            campaign_list(), lambda reader_session: search_characters(reader_session, text, filters, limit),
+            main_reader()
+        )
+        items = campaign_rows(merge_sorted(results, lambda row: (row.rank, -row.id), limit=limit), search_result)
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({'items': items})
+    return render_template('campaign_results.html', items=items, query=text)
+
+
+def current_version(character_id):
+    # Версия персонажа в базе; None — удалён
+    return db.session.query(Character.version).filter(Character.id == character_id).scalar()
+
+
+def version_json(character_id, entry):
+    data = {'id': character_id, 'version': entry.version, 'created_at': format_time(entry.created_at), 'op': entry.op}
+    if entry.changes is not None:
+        data['changes'] = public_changes(entry.changes)
+    return data
+
+
+@login_required
+def character_history(id):
+    # Версии персонажа от новых к старым; ?before=N — более старая страница
+    per_page = current_app.config['HISTORY_PER_PAGE']
+    entries = character_versions(db.session, id, per_page, request.args.get('before', type=int))
+    if not entries and 'before' not in request.args:
+        abort(404)
+    current = current_version(id)
+    older = entries[-1].version if len(entries) == per_page and entries[-1].version > 1 else None
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({
+            'id': id,
+            'current_version': current,
+            'items': [version_json(id, entry) for entry in entries],
+            'next_before': older,
+        })
+    items = [(entry, public_changes(entry.changes) if entry.changes is not None else None) for entry in entries]
+    return render_template('character_history.html', character_id=id, items=items, current=current, older=older,
+                           name=entries[0].state['name'] if entries else None)
+
+
+@login_required
+def character_version_view(id, version):
+    # Персонаж в прошлой версии (собирается из истории правок)
+    entry = character_version(db.session, id, version)
+    if entry is None:
+        abort(404)
+    current = current_version(id)
+    if request.accept_mimetypes.best == 'application/json':
+        data = version_json(id, entry)
+        data.update(current_version=current, state=public_state(entry.state))
+        return jsonify(data)
+    # Несохраняемый объект: карточка та же, что у текущей версии
+    character = Character(id=id, version=version, **entry.state)
+    return render_template('character_version.html', character=character, entry=entry, current=current)
+
+
+@login_required
+def character_as_of(id):
+    # ?at=2026-10-01T18:30 (UTC) -> версия, действовавшая в тот момент
+    try:
+        timestamp = parse_time(request.args.get('at'))
+    except HistoryError as error:
+        abort(400, description=str(error))
+    version = version_at(db.session, id, timestamp)
+    if version is None:
+        abort(404, description=f'Character {id} has no recorded version at that time.')
+    return redirect(url_for('character_version_view', id=id, version=version))
+
+
+@login_required
+def character_diff(id):
+    # ?from=N&to=M (по умолчанию до текущей версии): поля, которые различаются
+    current = current_version(id)
+    old_version = request.args.get('from', type=int)
+    new_version = request.args.get('to', current, type=int)
+    old = character_version(db.session, id, old_version) if old_version else None
+    new = character_version(db.session, id, new_version) if new_version else None
+    if old is None or new is None:
+        abort(404)
+    changes = public_changes(diff_states(old.state, new.state))
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({'id': id, 'from': old.version, 'to': new.version, 'changes': changes})
+    return render_template('character_diff.html', character_id=id, old=old, new=new, changes=changes,
+                           current=current)
+
+
+@login_required
+def revert_character_view(id):
+    # Новая версия с полями версии version; откат последней правки — version = текущая - 1
+    if not current_user.is_admin:
+        abort(403)
+    character = Character.query.get_or_404(id)
+    version = request.form.get('version', type=int)
+    try:
+        changes = revert_character(db.session, character, version, request.form.get('expected_version', type=int))
+        db.session.commit()
+    except HistoryError as error:
+        db.session.rollback()
+        flash(str(error), 'danger')
+    except (VersionConflict, StaleDataError):
+        db.session.rollback()
+        flash('This character was changed by someone else. Review the history and try again.', 'danger')
+    else:
+        if changes:
+            flash(f'Character reverted to version {version}.', 'success')
+        else:
+            flash(f'Version {version} has the same values as the current one.', 'info')
+    return redirect(url_for('character_history', id=id))
+
+
+@login_required
+def restore_character_view(id):
+    # Удалённый персонаж возвращается с тем же id (в версии version, по умолчанию — как при удалении)
+    if not current_user.is_admin:
+        abort(403)
+    try:
+        restore_character(db.session, id, request.form.get('version', type=int))
+        db.session.commit()
+    except HistoryError as error:
+        db.session.rollback()
+        flash(str(error), 'danger')
+        return redirect(url_for('deleted_characters_view'))
+    flash('Character restored.', 'success')
+    return redirect(url_for('character_details', id=id))
+
+
+@login_required
+def deleted_characters_view():
+    # Недавно удалённые персонажи, которых можно восстановить
+    if not current_user.is_admin:
+        abort(403)
+    rows = deleted_characters(db.session, current_app.config['HISTORY_PER_PAGE'])
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({'items': [
+            {'id': row.character_id, 'name': row.name, 'version': row.version,
+             'deleted_at': format_time(row.created_at)}
+            for row in rows
+        ]})
+    return render_template('deleted_characters.html', rows=rows)
+
+
+# (правило, функция, методы); имя endpoint — имя функции, как у @app.route
+ROUTES = [
+    ('/', index, ['GET']),
+    ('/register', register, ['GET', 'POST']),
+    ('/login', login, ['GET', 'POST']),
+    ('/logout', logout, ['GET']),
+    ('/add', add_character, ['GET', 'POST']),
+    ('/generate', generate_character, ['GET']),
+    ('/character/<int:id>', character_details, ['GET']),
+    ('/stats', character_stats, ['GET']),
+    ('/admin', admin, ['GET']),
+    ('/cache/stats', cache_stats, ['GET']),
+    ('/download/<int:id>', download_character, ['GET']),
+    ('/export', export_characters, ['GET']),
+    ('/upload', upload_character, ['GET', 'POST']),
+    ('/uploads/<path:filename>', uploaded_image, ['GET']),
+    ('/delete/<int:id>', delete_character, ['GET']),
+    ('/edit/<int:character_id>', edit_character, ['GET', 'POST']),
+    ('/character/<int:id>/history', character_history, ['GET']),
+    ('/character/<int:id>/history/<int:version>', character_version_view, ['GET']),
+    ('/character/<int:id>/as-of', character_as_of, ['GET']),
+    ('/character/<int:id>/diff', character_diff, ['GET']),
+    ('/character/<int:id>/revert', revert_character_view, ['POST']),
+    ('/character/<int:id>/restore', restore_character_view, ['POST']),
+    ('/deleted', deleted_characters_view, ['GET']),
+    ('/search', search, ['GET']),
+    ('/bulk-update', bulk_update_characters, ['GET', 'POST']),
+    ('/simulate', simulate_encounter, ['GET']),
+    ('/jobs', jobs, ['GET']),
+    ('/jobs/<kind>', enqueue_job, ['POST']),
+    ('/jobs/<int:job_id>', job_status, ['GET']),
+    ('/jobs/<int:job_id>/events', job_events, ['GET']),
+    ('/jobs/<int:job_id>/download', job_download, ['GET']),
+    ('/changes', changes, ['GET']),
+    ('/campaigns', campaigns_view, ['GET', 'POST']),
+    ('/campaigns/<slug>/use', use_campaign_view, ['POST']),
+    ('/campaigns/characters', campaign_characters, ['GET']),
+    ('/campaigns/search', campaign_search, ['GET']),
+]
+
+# Страницы без персонажей кампании; остальные доступны ещё и как /c/<slug>/...
+SHARED_VIEWS = {register, login, logout, campaigns_view, use_campaign_view, campaign_characters, campaign_search,
+                uploaded_image}
+
+
+def register_views(app):
+    for rule, view, methods in ROUTES:
+        app.add_url_rule(rule, view_func=view, methods=methods)
+        if view not in SHARED_VIEWS:
+            # Тот же endpoint: url_for выбирает правило с префиксом, если передан campaign
+            app.add_url_rule(URL_PREFIX + rule, view_func=view, methods=methods)
+    app.url_value_preprocessor(select_campaign)
+    app.url_defaults(add_campaign_to_url)
+    app.add_template_global(image_variants)
+    app.add_template_global(image_url)
+    app.add_template_filter(format_time)
+    app.after_request(cache_static_files)
+
+    # JSON API: /api/characters и /api/characters/<id>
+    api = Api(app, prefix='/api')
+    api.add_resource(
+        CharacterListResource, '/characters', URL_PREFIX + '/characters',
+        resource_class_kwargs={
+            'session': db.session, 'model': Character,
+            'list_query': character_list_query, 'get_per_page': get_per_page,
+            'bulk_update': bulk_update,
+        }
+    )
+    api.add_resource(
+        CharacterResource, '/characters/<int:id>', URL_PREFIX + '/characters/<int:id>',
+        resource_class_kwargs={'session': db.session, 'model': Character}
+    )
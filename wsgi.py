@@ -0,0 +1,13 @@
+import os
+
+# Точка входа WSGI для продакшена:
+#
+#   gunicorn -c gunicorn.conf.py wsgi:application
+#
+# Процессов сервера обычно несколько, поэтому кэш по умолчанию общий (config.py, CACHE_BACKEND).
+# Переменная задаётся до импорта приложения: Config читает окружение при импорте
+os.environ.setdefault('CACHE_BACKEND', 'sqlite')
+
+from app import create_app
+
+application = create_app()